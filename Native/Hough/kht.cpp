@@ -33,6 +33,9 @@
 
 #include "stdio.h"
 #include <time.h>
+#include <atomic>
+#include <thread>
+#include <vector>
 #include "kht.h"
 #include "linking.h"
 #include "subdivision.h"
@@ -45,9 +48,10 @@ kht(lines_list_t &lines, unsigned char *binary_image, const size_t image_width,
 		const size_t cluster_min_size, const double cluster_min_deviation, const double delta, const double kernel_min_height,
 		const double n_sigmas)
 {
-	static strings_list_t strings;
-	static clusters_list_t clusters;
-	static accumulator_t accumulator;
+	// Work buffers are kept per thread, so several images can be processed in parallel
+	static thread_local strings_list_t strings;
+	static thread_local clusters_list_t clusters;
+	static thread_local accumulator_t accumulator;
 
 	// Group feature pixels from an input binary into clusters of approximately collinear pixels.
 	find_strings( strings, binary_image, image_width, image_height, cluster_min_size );
@@ -66,7 +70,7 @@ kht_wrapper(double (*lines_array)[2], unsigned char *binary_image, const size_t
 			const size_t cluster_min_size, const double cluster_min_deviation, const double delta, const double kernel_min_height,
 			const double n_sigmas)
 {
-	static lines_list_t lines;
+	static thread_local lines_list_t lines;
 
     /*struct timespec before;
     clock_gettime(CLOCK_MONOTONIC, &before);*/
@@ -98,3 +102,80 @@ kht_wrapper(double (*lines_array)[2], unsigned char *binary_image, const size_t
 
 	return lines_count;
 }
+
+
+// Run the KHT on a stack of images of the same size, distributing the images over a pool of threads.
+// The found lines are returned as [rho, theta, image index] rows, ordered by the image index and with at most
+// lines_max lines per image. The lines array must have space for images_count*lines_max rows.
+extern "C" size_t
+kht_batch_wrapper(double (*lines_array)[3], unsigned char *binary_images, const size_t images_count, const size_t image_width,
+			const size_t image_height, const size_t lines_max, const size_t cluster_min_size, const double cluster_min_deviation,
+			const double delta, const double kernel_min_height, const double n_sigmas, size_t threads_count)
+{
+	const size_t image_size = image_width*image_height;
+
+	std::vector<size_t> lines_counts(images_count, 0);
+	std::atomic<size_t> next_image(0);
+
+	// Each thread takes the next unprocessed image and writes its lines to the part of the output array
+	// reserved for that image
+	auto worker = [&]() {
+
+		lines_list_t lines;
+
+		for (size_t i = next_image++; i < images_count; i = next_image++)
+		{
+			kht( lines, &binary_images[i*image_size], image_width, image_height, cluster_min_size,
+				 cluster_min_deviation, delta, kernel_min_height, n_sigmas );
+
+			size_t lines_count = lines.size();
+
+			// Limit the number of lines to a max number
+			if (lines_count > lines_max)
+				lines_count = lines_max;
+
+			for (size_t j=0; j<lines_count; j++) {
+				line_t &line = lines[j];
+				lines_array[i*lines_max + j][0] = line.rho;
+				lines_array[i*lines_max + j][1] = line.theta;
+				lines_array[i*lines_max + j][2] = static_cast<double>( i );
+			}
+
+			lines_counts[i] = lines_count;
+		}
+	};
+
+	// 0 threads means that all available cores are used
+	if (threads_count == 0)
+		threads_count = std::thread::hardware_concurrency();
+
+	if (threads_count > images_count)
+		threads_count = images_count;
+
+	if (threads_count <= 1)
+		worker();
+
+	else {
+
+		std::vector<std::thread> threads;
+		for (size_t t=0; t<threads_count; t++)
+			threads.emplace_back( worker );
+
+		for (std::thread &thread : threads)
+			thread.join();
+	}
+
+	// Move the lines of all images to the beginning of the array, the destination is never after the source
+	size_t total_count = 0;
+	for (size_t i=0; i<images_count; i++) {
+		for (size_t j=0; j<lines_counts[i]; j++, total_count++) {
+			if (total_count != i*lines_max + j) {
+				lines_array[total_count][0] = lines_array[i*lines_max + j][0];
+				lines_array[total_count][1] = lines_array[i*lines_max + j][1];
+				lines_array[total_count][2] = lines_array[i*lines_max + j][2];
+			}
+		}
+	}
+
+	return total_count;
+}
@@ -87,6 +87,17 @@ void kht(lines_list_t &lines, unsigned char *binary_image, const size_t image_wi
 		const double cluster_min_deviation = 2.0, const double delta = 0.5,
 		const double kernel_min_height = 0.002, const double n_sigmas = 2.0);
 
+/* Runs kht() on a stack of 'images_count' binary images of the same size, using a pool of 'threads_count'
+ * threads (0 uses all available cores). The found lines are written to 'lines_array' as [rho theta index]
+ * rows, where index is the position of the image in the stack. The rows are ordered by the image index,
+ * with at most 'lines_max' rows per image, so 'lines_array' must have space for images_count*lines_max
+ * rows. Returns the total number of lines. As with kht(), the input images are destroyed.
+ */
+extern "C" size_t kht_batch_wrapper(double (*lines_array)[3], unsigned char *binary_images, const size_t images_count,
+		const size_t image_width, const size_t image_height, const size_t lines_max, const size_t cluster_min_size,
+		const double cluster_min_deviation, const double delta, const double kernel_min_height, const double n_sigmas,
+		size_t threads_count);
+
 //size_t kht_wrapper(lines_list_t &lines, unsigned char *binary_image, const size_t image_width, const size_t image_height, const size_t cluster_min_size = 10, const double cluster_min_deviation = 2.0, const double delta = 0.5, const double kernel_min_height = 0.002, const double n_sigmas = 2.0);
 
 #endif // !_KHT_
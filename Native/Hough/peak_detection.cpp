@@ -141,7 +141,7 @@ peak_detection(lines_list_t &lines, const accumulator_t &accumulator)
 	const double *theta = accumulator.theta();
 
 	// Create a list with all cells that receive at least one vote.
-	static bins_list_t used_bins;
+	static thread_local bins_list_t used_bins;
 	
 	size_t used_bins_count = 0;
 	for (size_t theta_index=1, theta_end=accumulator.height()+1; theta_index!=theta_end; ++theta_index)
@@ -177,7 +177,7 @@ peak_detection(lines_list_t &lines, const accumulator_t &accumulator)
 	std::qsort( used_bins.items(), used_bins_count, sizeof( bin_t ), (int(*)(const void*, const void*))compare_bins );
 	
 	// Use a sweep plane that visits each cell of the list.
-	static visited_map_t visited;
+	static thread_local visited_map_t visited;
 	visited.init( accumulator.width(), accumulator.height() );
 
 	lines.clear();
@@ -197,8 +197,9 @@ voting(accumulator_t &accumulator, const clusters_list_t &clusters, const double
 	 *
 	 * Algorithm 2
 	 */
-	static kernels_list_t kernels;
-	static pkernels_list_t used_kernels;
+	// Work lists are kept per thread, so several images can be processed in parallel
+	static thread_local kernels_list_t kernels;
+	static thread_local pkernels_list_t used_kernels;
 
 	kernels.resize( clusters.size() );
 	used_kernels.resize( clusters.size() );
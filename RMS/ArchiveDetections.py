@@ -7,6 +7,7 @@ from RMS.Misc import archiveDir
 
 from Utils.GenerateThumbnails import generateThumbnails
 from RMS.Formats.FFfile import validFFName
+from RMS.Formats import FFnight
 
 
 
@@ -31,6 +32,10 @@ def selectFiles(dir_path, ff_detected):
 
     selected_list = []
 
+    # FF files in the night directory and in its night container. The field sums in the container are not
+    #   taken, as they were already archived by archiveFieldsums
+    ff_files = [file_name for file_name in FFnight.listFiles(dir_path) if validFFName(file_name)]
+
     # Go through all files in the night directory
     for file_name in os.listdir(dir_path):
 
@@ -60,9 +65,9 @@ def selectFiles(dir_path, ff_detected):
             ff_match = None
 
             # Locate the parent FF bin file
-            for ff_file_name in os.listdir(dir_path):
+            for ff_file_name in ff_files:
 
-                if validFFName(ff_file_name) and (fr_id in ff_file_name):
+                if fr_id in ff_file_name:
                     
                     ff_match = ff_file_name
                     break
@@ -75,7 +80,8 @@ def selectFiles(dir_path, ff_detected):
                 selected_list.append(ff_match)
 
 
-        # Add FF file which contain detections to the list
+    # Add FF file which contain detections to the list
+    for file_name in ff_files:
         if file_name in ff_detected:
             selected_list.append(file_name)
 
@@ -94,13 +100,17 @@ def archiveFieldsums(dir_path):
     fieldsum_files = []
 
     # Find all fieldsum FS files
-    for file_name in os.listdir(dir_path):
+    for file_name in FFnight.listFiles(dir_path):
 
         # Take all field sum files
         if ('FS' in file_name) and ('fieldsum' in file_name):
             fieldsum_files.append(file_name)
 
 
+    # Write the field sums stored in the night container as individual files, so they can be archived
+    FFnight.exportMissing(dir_path, fieldsum_files)
+
+
     # Path to the fieldsum directory
     fieldsum_archive_dir = os.path.abspath(os.path.join(dir_path, 'Fieldsums'))
 
@@ -154,6 +164,12 @@ def archiveDetections(captured_path, archived_path, ff_detected, config, extra_f
     file_list.append(mosaic_file)
 
 
+    # Write the selected files stored in the night container as individual files, so they can be archived
+    exported_files = FFnight.exportMissing(captured_path, file_list)
+
+
+    archive_name = None
+
     if file_list:
 
         # Create the archive ZIP in the parent directory of the archive directory
@@ -164,9 +180,13 @@ def archiveDetections(captured_path, archived_path, ff_detected, config, extra_f
         archive_name = archiveDir(captured_path, file_list, archived_path, archive_name, \
             extra_files=extra_files)
 
-        return archive_name
 
-    return None
+    # Delete the files exported from the night container, they are kept only in the container
+    for file_name in exported_files:
+        os.remove(os.path.join(captured_path, file_name))
+
+
+    return archive_name
 
 
 
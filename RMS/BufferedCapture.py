@@ -18,31 +18,96 @@ from __future__ import print_function, division, absolute_import
 
 import re
 import time
+import bisect
 import logging
 from multiprocessing import Process, Event
 
 import cv2
+import numpy as np
 
+from RMS.FrameSource import openFrameSource
+from RMS import Metrics
 from RMS.Misc import ping
 
 # Get the logger from the main module
 log = logging.getLogger("logger")
 
 
+class TimingHistogram(object):
+    """ Histogram of durations of an operation, used for profiling the capture loop. """
+
+    # Upper edges of histogram bins in milliseconds, the last bin holds everything slower
+    BIN_EDGES = [0.5, 1, 2, 5, 10, 20, 40, 80, 160]
+
+    def __init__(self, name):
+        """
+        Arguments:
+            name: [str] Name of the measured operation.
+        """
+
+        self.name = name
+        self.reset()
+
+
+
+    def reset(self):
+        """ Clear all measurements. """
+
+        self.counts = [0]*(len(self.BIN_EDGES) + 1)
+        self.total = 0.0
+        self.max = 0.0
+        self.n = 0
+
+
+
+    def add(self, dt):
+        """ Add one measurement.
+
+        Arguments:
+            dt: [float] Duration in seconds.
+        """
+
+        dt_ms = 1000*dt
+
+        self.counts[bisect.bisect_left(self.BIN_EDGES, dt_ms)] += 1
+        self.total += dt_ms
+        self.n += 1
+
+        if dt_ms > self.max:
+            self.max = dt_ms
+
+
+
+    def __str__(self):
+
+        mean = self.total/self.n if self.n else 0
+
+        bins = []
+        for i, count in enumerate(self.counts):
+
+            if i < len(self.BIN_EDGES):
+                bins.append("<{:g}ms: {:d}".format(self.BIN_EDGES[i], count))
+            else:
+                bins.append(">{:g}ms: {:d}".format(self.BIN_EDGES[-1], count))
+
+        return "{:s} - mean {:.2f}ms, max {:.2f}ms, ".format(self.name, mean, self.max) + ", ".join(bins)
+
+
+
+
 class BufferedCapture(Process):
     """ Capture from device to buffer in memory.
     """
     
     running = False
     
-    def __init__(self, array1, startTime1, array2, startTime2, config, video_file=None):
-        """ Populate arrays with (startTime, frames) after startCapture is called.
+    def __init__(self, frame_ring, config, video_file=None):
+        """ Populate the blocks of the frame ring with frames after startCapture is called.
         
         Arguments:
-            array1: numpy array in shared memory that is going to be filled with frames
-            startTime1: float in shared memory that holds time of first frame in array1
-            array2: second numpy array in shared memory
-            startTime2: float in shared memory that holds time of first frame in array2
+            frame_ring: [FrameRing object] Ring of frame blocks in shared memory which will be filled with
+                frames.
+            config: [Config object] Configuration.
 
         Keyword arguments:
             video_file: [str] Path to the video file, if it was given as the video source. None by default.
@@ -50,13 +115,7 @@ class BufferedCapture(Process):
         """
         
         super(BufferedCapture, self).__init__()
-        self.array1 = array1
-        self.startTime1 = startTime1
-        self.array2 = array2
-        self.startTime2 = startTime2
-        
-        self.startTime1.value = 0
-        self.startTime2.value = 0
+        self.frame_ring = frame_ring
         
         self.config = config
 
@@ -66,6 +125,11 @@ class BufferedCapture(Process):
         self.time_for_drop = 1.5*(1.0/config.fps)
 
         self.dropped_frames = 0
+
+        # Histograms of per-frame times for grabbing, converting and assigning the frames to shared memory
+        self.grab_hist = TimingHistogram('grab')
+        self.convert_hist = TimingHistogram('convert')
+        self.assign_hist = TimingHistogram('assign')
     
 
 
@@ -110,9 +174,9 @@ class BufferedCapture(Process):
 
         device = None
 
-        # use a file as the video source
+        # Use a file or a synthetic camera as the video source
         if self.video_file is not None:
-            device = cv2.VideoCapture(self.video_file)
+            device = openFrameSource(self.config, self.video_file)
 
         # Use a device as the video source
         else:
@@ -221,9 +285,10 @@ class BufferedCapture(Process):
             device.read()
 
 
-        first = True
-
         wait_for_reconnect = False
+
+        # Buffer which OpenCV reuses for every frame in the zero-copy mode
+        frame_buffer = None
         
         # Run until stopped from the outside
         while not self.exit.is_set():
@@ -231,11 +296,6 @@ class BufferedCapture(Process):
 
             lastTime = 0
             
-            if first:
-                self.startTime1.value = 0
-            else:
-                self.startTime2.value = 0
-            
 
             # If the video device was disconnected, wait 5s for reconnection
             if wait_for_reconnect:
@@ -275,6 +335,17 @@ class BufferedCapture(Process):
                 wait_for_reconnect = False
 
 
+            # Take a free block of the frame ring. When the frames are replayed from a file as fast as possible,
+            # wait for the compression instead of overwriting the blocks
+            block = self.frame_ring.acquireFree(self.exit, overwrite=((self.video_file is None) \
+                or self.config.replay_real_time))
+
+            if block is None:
+                break
+
+            frames = self.frame_ring.arrays[block]
+
+
             t_frame = 0
             t_assignment = 0
             t_convert = 0
@@ -284,8 +355,30 @@ class BufferedCapture(Process):
 
                 # Read the frame
                 t1_frame = time.time()
-                ret, frame = device.read()
+
+                if self.config.zero_copy_capture:
+
+                    # Only grab the frame, it will be decoded into the preallocated buffer after the timing
+                    # was checked
+                    ret = device.grab()
+                    frame = frame_buffer
+
+                else:
+                    ret, frame = device.read()
+
                 t_frame = time.time() - t1_frame
+                self.grab_hist.add(t_frame)
+                Metrics.addTime('capture_grab', t_frame)
+
+
+                # If the end of the video file was reached, stop the capture
+                if (not ret) and (self.video_file is not None) and (not device.isOpened()):
+
+                    log.info('End of video file! Press Ctrl+C to finish.')
+
+                    self.exit.set()
+
+                    break
 
 
                 # If the video device was disconnected, wait for reconnection
@@ -299,7 +392,7 @@ class BufferedCapture(Process):
 
 
                 # If the end of the file was reached, stop the capture
-                if (self.video_file is not None) and (frame is None):
+                if (self.video_file is not None) and (frame is None) and (not self.config.zero_copy_capture):
 
                     log.info('End of video file! Press Ctrl+C to finish.')
 
@@ -325,6 +418,7 @@ class BufferedCapture(Process):
                         log.info(str(n_dropped) + " frames dropped! Time for frame: {:.3f}, convert: {:.3f}, assignment: {:.3f}".format(t_frame, t_convert, t_assignment))
 
                     self.dropped_frames += n_dropped
+                    Metrics.increment('capture_dropped_frames', n_dropped)
 
                     
 
@@ -332,6 +426,19 @@ class BufferedCapture(Process):
                 
                 t1_convert = time.time()
 
+                # Decode the grabbed frame, reusing the buffer from the previous frame
+                if self.config.zero_copy_capture:
+
+                    ret, frame = device.retrieve(frame_buffer)
+
+                    if not ret:
+                        log.info('Frame retrieving failed, video device is probably disconnected!')
+
+                        wait_for_reconnect = True
+                        break
+
+                    frame_buffer = frame
+
                 # Convert the frame to grayscale
                 #gray = cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY)
 
@@ -356,51 +463,53 @@ class BufferedCapture(Process):
 
 
                 t_convert = time.time() - t1_convert
+                self.convert_hist.add(t_convert)
 
 
-                # Assign the frame to shared memory
+                # Assign the frame to shared memory (the grayscale and the ROI are views of the frame, so
+                # this is the only copy)
                 t1_assign = time.time()
-                if first:
-                    self.array1[i, :gray.shape[0], :gray.shape[1]] = gray
-                else:
-                    self.array2[i, :gray.shape[0], :gray.shape[1]] = gray
+                np.copyto(frames[i, :gray.shape[0], :gray.shape[1]], gray)
 
                 t_assignment = time.time() - t1_assign
+                self.assign_hist.add(t_assignment)
 
-                # If video is loaded from a file, simulate real FPS
-                if self.video_file is not None:
-
-                    time.sleep(1.0/self.config.fps)
-
-                    # If the video finished, stop the capture
-                    if not device.isOpened():
-                        self.exit.set()
+                # Report the number of frames in the block
+                self.frame_ring.frameAdded(block, i + 1)
 
 
 
             if self.exit.is_set():
+                self.frame_ring.release(block)
                 wait_for_reconnect = False
                 log.info('Capture exited!')
                 break
 
 
-            if not wait_for_reconnect:
+            # Free the unfinished block
+            if wait_for_reconnect:
+                self.frame_ring.release(block)
 
-                # Set the starting value of the frame block, which indicates to the compression that the
-                # block is ready for processing
-                if first:
-                    self.startTime1.value = startTime
+            else:
 
-                else:
-                    self.startTime2.value = startTime
+                # Mark the block as ready, which indicates to the compression that the block is ready for 
+                # processing
+                self.frame_ring.markReady(block, startTime)
+                Metrics.increment('capture_blocks')
 
                 log.info('New block of raw frames available for compression with starting time: {:s}'.format(str(startTime)))
 
-            
-            # Switch the frame block buffer flags
-            first = not first
+                # Report the distribution of per-frame times so far
+                for hist in [self.grab_hist, self.convert_hist, self.assign_hist]:
+                    log.debug('Capture timing: ' + str(hist))
+
         
 
+        for hist in [self.grab_hist, self.convert_hist, self.assign_hist]:
+            log.info('Capture timing: ' + str(hist))
+
+        Metrics.flush()
+
         log.info('Releasing video device...')
         device.release()
         log.info('Video device released!')
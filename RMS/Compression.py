@@ -23,14 +23,16 @@ import numpy as np
 import multiprocessing
 
 
-from RMS.VideoExtraction import Extractor
+from RMS import Metrics
+from RMS.VideoExtraction import ExtractorWorker
 from RMS.Formats import FFfile, FFStruct
 from RMS.Formats import FieldIntensities
+from RMS.Formats import FFnight
 
 # Import Cython functions
 import pyximport
 pyximport.install(setup_args={'include_dirs':[np.get_include()]})
-from RMS.CompressionCy import compressFrames
+from RMS.CompressionCy import compressFrames, compressFramesParallel, FrameCompressor
 
 
 # Get the logger from the main module
@@ -47,20 +49,19 @@ class Compressor(multiprocessing.Process):
 
     running = False
     
-    def __init__(self, data_dir, array1, startTime1, array2, startTime2, config, detector=None, 
-        live_view=None, flat_struct=None):
+    def __init__(self, data_dir, frame_ring, config, detector=None, live_view=None, flat_struct=None):
         """
 
         Arguments:
-            array1: first numpy array in shared memory of grayscale video frames
-            startTime1: float in shared memory that holds time of first frame in array1
-            array2: second numpy array in shared memory
-            startTime1: float in shared memory that holds time of first frame in array2
+            data_dir: [str] Path to the directory where the FF files will be saved.
+            frame_ring: [FrameRing object] Ring of frame blocks in shared memory which are filled by the
+                capture.
             config: configuration class
 
         Keyword arguments:
-            detector: [Detector object] Handle to Detector object used for running star extraction and
-                meteor detection.
+            detector: [QueuedPool object] Pool used for running star extraction and meteor detection. The
+                jobs only give the directory and the FF file name, the config and the flat are given to
+                the pool when it is created.
             live_view: [LiveViewer object] Handle to the LiveViewer object which will show in real time 
                 the latest maxpixel on the screen.
             flat_struct: [Flat struct] Structure containing the flat field. None by default.
@@ -70,16 +71,15 @@ class Compressor(multiprocessing.Process):
         super(Compressor, self).__init__()
         
         self.data_dir = data_dir
-        self.array1 = array1
-        self.startTime1 = startTime1
-        self.array2 = array2
-        self.startTime2 = startTime2
+        self.frame_ring = frame_ring
         self.config = config
 
         self.detector = detector
         self.live_view = live_view
         self.flat_struct = flat_struct
 
+        self.extractor = None
+
         self.exit = multiprocessing.Event()
 
         self.run_exited = multiprocessing.Event()
@@ -101,18 +101,22 @@ class Compressor(multiprocessing.Process):
 
         """
         
-        # Run cythonized compression
-        ftp_array, fieldsum = compressFrames(frames, self.config.deinterlace_order)
+        # Run cythonized compression, in parallel threads if more than one thread is used
+        if self.config.compression_threads != 1:
+            ftp_array, fieldsum = compressFramesParallel(frames, self.config.deinterlace_order, 
+                self.config.compression_threads)
+
+        else:
+            ftp_array, fieldsum = compressFrames(frames, self.config.deinterlace_order)
 
         return ftp_array, fieldsum
     
 
 
-    def saveFF(self, arr, startTime, N):
-        """ Write metadata and data array to FF file.
+    def makeFilename(self, startTime, N):
+        """ Return the name of the FF file without the prefix and the extension.
         
         Arguments:
-            arr: [3D ndarray] 3D numpy array in format: (N, y, x) where N is [0, 4)
             startTime: [float] seconds and fractions of a second from epoch to first frame
             N: [int] frame counter (ie. 0000512)
         """
@@ -124,9 +128,27 @@ class Compressor(multiprocessing.Process):
         millis = int((startTime - floor(startTime))*1000)
         
 
-        filename = str(self.config.stationID).zfill(3) +  "_" + date_string + "_" + str(millis).zfill(3) \
+        return str(self.config.stationID).zfill(3) +  "_" + date_string + "_" + str(millis).zfill(3) \
             + "_" + str(N).zfill(7)
 
+
+
+    def saveFF(self, arr, startTime, N, filename=None):
+        """ Write metadata and data array to FF file.
+        
+        Arguments:
+            arr: [3D ndarray] 3D numpy array in format: (N, y, x) where N is [0, 4)
+            startTime: [float] seconds and fractions of a second from epoch to first frame
+            N: [int] frame counter (ie. 0000512)
+
+        Keyword arguments:
+            filename: [str] Name of the FF file without the prefix and the extension. Generated from the start
+                time and the frame counter if not given.
+        """
+        
+        if filename is None:
+            filename = self.makeFilename(startTime, N)
+
         ff = FFStruct.FFStruct()
         ff.array = arr
         ff.nrows = arr.shape[1]
@@ -137,13 +159,74 @@ class Compressor(multiprocessing.Process):
         ff.camno = self.config.stationID
         ff.fps = self.config.fps
         
-        # Write the FF file
-        FFfile.write(ff, self.data_dir, filename, fmt=self.config.ff_format)
+        # Write the FF file, or append it to the night container
+        if self.config.ff_night_container:
+            FFnight.getContainer(self.data_dir, create=True).appendFF("FF_" + filename + "." \
+                + FFfile.formatExtension(self.config.ff_format), ff, startTime)
+
+        else:
+            FFfile.write(ff, self.data_dir, filename, fmt=self.config.ff_format)
         
         return filename
     
 
 
+    def streamBlock(self, frame_compressor):
+        """ Compress the frames of the oldest uncompressed block of the frame ring as they are being 
+            captured.
+
+        Arguments:
+            frame_compressor: [FrameCompressor object] Incremental compressor used for the block.
+
+        Return:
+            (block, startTime): [tuple] Index of the compressed block in the frame ring and the time of its 
+                first frame, or None if the block was abandoned or overwritten by the capture, or the 
+                compression was stopped.
+        """
+
+        # Wait for the capture to start filling a block
+        next_block = self.frame_ring.nextBlock(self.exit)
+
+        if next_block is None:
+            return None
+
+        block, sequence = next_block
+
+        frame_compressor.frames = self.frame_ring.arrays[block]
+        frame_compressor.reset()
+
+        n = 0
+        while not self.exit.is_set():
+
+            # Wait for new frames
+            filled = self.frame_ring.waitFrames(block, sequence, n, self.exit)
+
+            # The capture has abandoned or overwritten this block
+            if filled < 0:
+                log.debug('Frame block abandoned by the capture, skipping it...')
+                return None
+
+            # Add all frames which have been captured so far
+            with Metrics.timer('compression_add_frames'):
+                while n < filled:
+                    frame_compressor.addFrame(frame_compressor.frames[n], n)
+                    n += 1
+
+            # The block is done when all frames were added and the capture has marked it as ready
+            if n == self.frame_ring.frames_num:
+
+                startTime = self.frame_ring.takeReady(block, sequence)
+
+                if startTime is None:
+                    continue
+
+                return block, startTime
+
+
+        return None
+
+
+
     def stop(self):
         """ Stop compression.
         """
@@ -192,103 +275,141 @@ class Compressor(multiprocessing.Process):
         """
         
         n = 0
+
+        # Start the extractor which will process the blocks after they are compressed
+        self.extractor = ExtractorWorker(self.config, self.data_dir, self.frame_ring, 
+            buffers_num=self.config.extraction_buffers)
+        self.extractor.start()
+
+        # Compress the frames as they arrive, unless the whole blocks should be compressed in parallel threads
+        streaming = self.config.compression_threads == 1
+
+        if streaming:
+            frame_compressor = FrameCompressor(self.frame_ring.arrays[0], self.config.deinterlace_order)
+
         
         # Repeat until the compressor is killed from the outside
         while not self.exit.is_set():
 
-            # Block until frames are available
-            while self.startTime1.value == 0 and self.startTime2.value == 0: 
+            if streaming:
 
-                # Exit function if process was stopped from the outside
-                if self.exit.is_set():
+                # Compress the frames while they are being captured
+                compressed_block = self.streamBlock(frame_compressor)
 
-                    log.debug('Compression run exit')
-                    self.run_exited.set()
+                if compressed_block is None:
+                    continue
 
-                    return None
+                block, startTime = compressed_block
 
-                time.sleep(0.1)
+                t = time.time()
 
-                
+                log.debug("Compression frame block with start time at: {:s}".format(str(startTime)))
 
-            t = time.time()
+                # Compute the compressed frames from the accumulated values
+                compressed, field_intensities = frame_compressor.finish()
 
-            
-            if self.startTime1.value != 0:
-
-                # Retrieve time of first frame
-                startTime = float(self.startTime1.value)
-
-                # Copy frames
-                frames = self.array1 
-                self.startTime1.value = 0
 
             else:
 
-                # Retrieve time of first frame
-                startTime = float(self.startTime2.value)
+                # Wait until a block of frames is available
+                ready_block = self.frame_ring.acquireReady(self.exit)
 
-                # Copy frames
-                frames = self.array2 
-                self.startTime2.value = 0
+                if ready_block is None:
+                    continue
 
-            
+                block, startTime = ready_block
 
-            log.debug("Compression frame block with start time at: {:s}".format(str(startTime)))
+                log.debug("Compression frame block with start time at: {:s}".format(str(startTime)))
+
+                t = time.time()
+                
+                # Run the compression
+                compressed, field_intensities = self.compress(self.frame_ring.arrays[block])
 
-            #log.debug("memory copy: " + str(time.time() - t) + "s")
-            t = time.time()
-            
-            # Run the compression
-            compressed, field_intensities = self.compress(frames)
 
             # Cut out the compressed frames to the proper size
             compressed = compressed[:, :self.config.height, :self.config.width]
             
             log.debug("compression: " + str(time.time() - t) + "s")
-            t = time.time()
-            
-            # Save the compressed image
-            filename = self.saveFF(compressed, startTime, n*256)
+            Metrics.addTime('compression', time.time() - t)
+
+            self.processCompressed(block, compressed, field_intensities, startTime, n)
             n += 1
-            
-            log.debug("saving: " + str(time.time() - t) + "s")
 
 
-            # Save the extracted intensitites per every field
-            FieldIntensities.saveFieldIntensitiesBin(field_intensities, self.data_dir, filename)
 
+        log.debug('Compression run exit')
+        self.extractor.stop(timeout=30)
 
-            # Run the extractor
-            extractor = Extractor(self.config, self.data_dir)
-            extractor.start(frames, compressed, filename)
+        Metrics.flush()
+        self.run_exited.set()
 
-            # Fully format the filename (this could not have been done before as the extractor will add
-            # the FR prefix)
-            filename = "FF_" + filename + "." + self.config.ff_format
 
 
-            log.debug('Extractor started for: ' + filename)
+    def processCompressed(self, block, compressed, field_intensities, startTime, n):
+        """ Hand the raw frames over to the extractor, which frees the block of the frame ring or keeps it
+            until the extraction is done, then save the compressed block and hand it over to the detector 
+            and the live view.
 
+        Arguments:
+            block: [int] Index of the frame ring block which holds the raw frames.
+            compressed: [3D ndarray] FTP compressed frames.
+            field_intensities: [ndarray] Sums of intensities per every field.
+            startTime: [float] Time of the first frame in the block.
+            n: [int] Index of the block.
 
-            # Run the detection on the file, if the detector handle was given
-            if self.detector is not None:
+        """
 
-                # Add the file to the detector queue
-                self.detector.addJob([self.data_dir, filename, self.config, self.flat_struct])
-                log.info('Added file for detection: {:s}'.format(filename))
+        filename = self.makeFilename(startTime, n*256)
 
+        # Add the block to the extractor queue before anything else is done. The extractor keeps the block 
+        #   only if the capture has a spare one, otherwise it copies the raw frames (or skips them if it is 
+        #   behind) and frees the block, so the capture is never held up by the extraction or by saving the 
+        #   files
+        self.extractor.addJob(block, startTime, compressed, filename)
 
-            # Refresh the maxpixel currently shown on the screen
-            if self.live_view is not None:
 
-                # Add the image to the image queue
-                self.live_view.updateImage(compressed[0], filename + " maxpixel")
-                log.debug('Updated maxpixel on the screen: {:s}'.format(filename))
+        t = time.time()
+            
+        # Save the compressed image
+        self.saveFF(compressed, startTime, n*256, filename=filename)
+        
+        log.debug("saving: " + str(time.time() - t) + "s")
+        Metrics.addTime('ff_save', time.time() - t)
+        Metrics.increment('compressed_blocks')
 
 
+        # Save the extracted intensitites per every field
+        if self.config.ff_night_container:
+            FFnight.getContainer(self.data_dir, create=True).appendFieldSums("FS_" + filename \
+                + '_fieldsum.bin', field_intensities, startTime)
+
+        else:
+            FieldIntensities.saveFieldIntensitiesBin(field_intensities, self.data_dir, filename)
+
+
+        # Fully format the filename (this could not have been done before as the extractor will add
+        # the FR prefix)
+        filename = "FF_" + filename + "." + FFfile.formatExtension(self.config.ff_format)
+
+
+        backlog = self.extractor.getBacklog()
+        Metrics.setGauge('extractor_backlog', backlog)
+
+        log.debug('Extractor job added for: {:s}, extractor backlog: {:d}'.format(filename, backlog))
+
+
+        # Run the detection on the file, if the detector handle was given
+        if self.detector is not None:
+
+            # Add the file to the detector queue
+            self.detector.addJob([self.data_dir, filename])
+            log.info('Added file for detection: {:s}'.format(filename))
 
-        log.debug('Compression run exit')
-        self.run_exited.set()
 
+        # Refresh the maxpixel currently shown on the screen
+        if self.live_view is not None:
 
+            # Add the image to the image queue
+            self.live_view.updateImage(compressed[0], filename + " maxpixel")
+            log.debug('Updated maxpixel on the screen: {:s}'.format(filename))
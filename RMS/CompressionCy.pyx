@@ -3,6 +3,8 @@ import numpy as np
 # Cython import
 cimport numpy as np
 cimport cython
+cimport openmp
+from cython.parallel import prange
 
 # Define numpy types
 INT8_TYPE = np.uint8
@@ -16,10 +18,35 @@ ctypedef np.float64_t FLOAT_TYPE_t
 
 
 # Declare math functions
-cdef extern from "math.h":
+cdef extern from "math.h" nogil:
     double sqrt(double)
 
 
+
+def generateRandomN():
+    """ Generate the table of 2**16 pseudorandom numbers which is used for choosing the max frame when several
+        frames have the same maximum pixel value. The table is seeded with 0, so the selection is
+        reproducible between runs.
+
+    Return:
+        randomN: [ndarray] Array of uint8 random numbers.
+    """
+
+    cdef np.ndarray[INT8_TYPE_t, ndim=1] randomN = np.zeros(shape=[65536], dtype=INT8_TYPE)
+    cdef unsigned int arand = randomN[0]
+    cdef unsigned int n
+
+    for n in range(65536):
+        arand = (arand*32719 + 3)%32749
+        randomN[n] = <unsigned char>(32767.0/<double>(1 + arand%32767))
+
+    return randomN
+
+
+# Random numbers shared by all compression routines
+RANDOM_N = generateRandomN()
+
+
 @cython.cdivision(True)
 @cython.boundscheck(False)
 @cython.wraparound(False)
@@ -61,14 +88,8 @@ def compressFrames(np.ndarray[INT8_TYPE_t, ndim=3] frames, int deinterlace_order
 
     cdef unsigned int fieldsum_indx
     
-    # Populate the randomN array with 2**16 random numbers
-    cdef np.ndarray[INT8_TYPE_t, ndim=1] randomN = np.empty(shape=[65536], dtype=INT8_TYPE)
-    cdef unsigned int arand = randomN[0]
-
-
-    for n in range(65536):
-        arand = (arand*32719 + 3)%32749
-        randomN[n] = <unsigned char>(32767.0/<double>(1 + arand%32767))
+    # Get the table of 2**16 random numbers used for breaking max pixel ties
+    cdef np.ndarray[INT8_TYPE_t, ndim=1] randomN = RANDOM_N
 
 
     for y in range(height):
@@ -140,4 +161,507 @@ def compressFrames(np.ndarray[INT8_TYPE_t, ndim=3] frames, int deinterlace_order
             ftp_array[3, y, x] = var
 
 
-    return ftp_array, fieldsum[:frames_num*deinterlace_multiplier]
\ No newline at end of file
+    return ftp_array, fieldsum[:frames_num*deinterlace_multiplier]
+
+
+
+@cython.boundscheck(False)
+@cython.wraparound(False)
+@cython.cdivision(True)
+cdef inline unsigned int selectMaxFrame(INT8_TYPE_t[:, :, :] frames, INT8_TYPE_t[:] randomN, unsigned int y, 
+    unsigned int x, unsigned int frames_num, unsigned int max_val, unsigned int max_frame, 
+    unsigned int num_equal, unsigned int ties, unsigned int rand_count) nogil:
+    """ Choose the max frame between the frames with the same maximum value of the pixel, taking the random 
+        numbers in the same order as compressFrames does.
+
+    Arguments:
+        frames: [3D ndarray] Block of frames.
+        randomN: [ndarray] Table of random numbers.
+        y, x: [int] Coordinates of the pixel.
+        frames_num: [int] Number of frames in the block.
+        max_val: [int] Maximum value of the pixel.
+        max_frame: [int] First frame with the maximum value.
+        num_equal: [int] Number of frames in the run of the final maximum value (see compressFrames).
+        ties: [int] Number of all ties of the running maximum value of the pixel.
+        rand_count: [int] Index of the last random number used before this pixel.
+
+    Return:
+        [int] Chosen max frame.
+    """
+
+    cdef unsigned int m, k, run_ties, equal_start, chosen_tie, first_run_frame
+    cdef int j
+
+    # The run of the final maximum value starts with one equal pixel if the maximum is larger than 0, 
+    # otherwise all frames were 0 and all of them were taken as ties
+    if max_val > 0:
+        equal_start = 1
+        first_run_frame = max_frame + 1
+    else:
+        equal_start = 0
+        first_run_frame = 0
+
+    # Number of ties in the run of the final maximum value
+    run_ties = num_equal - equal_start
+
+    # Find the last tie which would have been selected (ties before the final run only advance the random 
+    # index)
+    chosen_tie = 0
+    for j in range(run_ties, 0, -1):
+        if equal_start + j <= randomN[(rand_count + ties - run_ties + j)%65536]:
+            chosen_tie = j
+            break
+
+    # Find the frame of the chosen tie
+    if chosen_tie > 0:
+
+        k = 0
+        for m in range(first_run_frame, frames_num):
+            if frames[m, y, x] == max_val:
+                k += 1
+
+                if k == chosen_tie:
+                    return m
+
+    return max_frame
+
+
+
+@cython.boundscheck(False)
+@cython.wraparound(False)
+@cython.cdivision(True)
+cdef void compressRows(INT8_TYPE_t[:, :, :] frames, INT8_TYPE_t[:, :, :] ftp_array, 
+    np.uint16_t[:, :] num_equal_arr, np.uint16_t[:, :] tie_count_arr, INT32_TYPE_t[:] row_ties, 
+    INT32_TYPE_t[:, :] fieldsum_bands, int band, unsigned int y_beg, unsigned int y_end, 
+    int deinterlace_order, unsigned int deinterlace_multiplier) nogil:
+    """ Compress the rows [y_beg, y_end) of the frame block, without choosing the max frame between the
+        frames with the same maximum value, which is done by selectRowsMaxFrames. The ties of the maximum 
+        value are counted for every pixel and every row. The field sums are added to the given row of 
+        fieldsum_bands, which belongs only to this band of rows. 
+    """
+
+    cdef unsigned int var, max_val, max_frame, mean, pixel, n, num_equal, ties, field
+    cdef unsigned int x, y, acc
+    cdef unsigned int width = frames.shape[2]
+    cdef unsigned int frames_num = frames.shape[0]
+    cdef unsigned int frames_num_minus_one = frames_num - 1
+    cdef unsigned int frames_num_minus_two = frames_num - 2
+
+    for y in range(y_beg, y_end):
+
+        row_ties[y] = 0
+
+        # Field of this row (0 if there's no deinterlacing)
+        field = (deinterlace_multiplier - 1)*((y + deinterlace_order)%2)
+
+        for x in range(width):
+        
+            acc = 0
+            var = 0
+            max_val = 0
+            max_frame = 0
+            num_equal = 0
+            ties = 0
+            
+            # Calculate mean, stddev, max_val, and max_val frame
+            for n in range(frames_num):
+            
+                pixel = frames[n, y, x]
+                acc += pixel
+                var += pixel*pixel
+                
+                # Assign the maximum value
+                if pixel > max_val:
+                
+                    max_val = pixel
+                    max_frame = n
+                    num_equal = 1
+                
+
+                # Count the ties of the maximum value, the max frame will be chosen when the random number 
+                # index of the row is known
+                elif max_val == pixel:
+                
+                    num_equal += 1
+                    ties += 1
+
+
+                # Sum intensity per every field
+                fieldsum_bands[band, deinterlace_multiplier*n + field] += pixel
+
+            
+            # Calculate mean
+            acc -= max_val    # remove max_val pixel from average
+            mean = acc/frames_num_minus_one
+            
+            # Calculate stddev
+            var -= max_val*max_val;     # remove max_val pixel
+            var -= acc*mean;    # subtract average squared sum of all values
+            var = <unsigned int> sqrt(var/frames_num_minus_two)
+
+            # Make sure that the stddev is not 0, to prevent divide by zero afterwards
+            if var == 0:
+                var = 1
+            
+            
+            # Output results
+            ftp_array[0, y, x] = max_val
+            ftp_array[1, y, x] = max_frame
+            ftp_array[2, y, x] = mean
+            ftp_array[3, y, x] = var
+
+            num_equal_arr[y, x] = num_equal
+            tie_count_arr[y, x] = ties
+            row_ties[y] += ties
+
+
+
+@cython.boundscheck(False)
+@cython.wraparound(False)
+@cython.cdivision(True)
+cdef void selectRowsMaxFrames(INT8_TYPE_t[:, :, :] frames, INT8_TYPE_t[:, :, :] ftp_array, 
+    np.uint16_t[:, :] num_equal_arr, np.uint16_t[:, :] tie_count_arr, INT32_TYPE_t[:] row_rand_count, 
+    INT8_TYPE_t[:] randomN, unsigned int y_beg, unsigned int y_end) nogil:
+    """ Choose the max frames of the rows [y_beg, y_end) compressed by compressRows, starting every row at 
+        the index of the random number at which compressFrames would be at the beginning of the row.
+    """
+
+    cdef unsigned int x, y, ties, rand_count
+    cdef unsigned int width = frames.shape[2]
+    cdef unsigned int frames_num = frames.shape[0]
+
+    for y in range(y_beg, y_end):
+
+        rand_count = row_rand_count[y]
+
+        for x in range(width):
+
+            ties = tie_count_arr[y, x]
+
+            if ties > 0:
+
+                ftp_array[1, y, x] = selectMaxFrame(frames, randomN, y, x, frames_num, ftp_array[0, y, x], 
+                    ftp_array[1, y, x], num_equal_arr[y, x], ties, rand_count)
+
+                rand_count = (rand_count + ties)%65536
+
+
+
+@cython.boundscheck(False)
+@cython.wraparound(False)
+@cython.cdivision(True)
+def compressFramesParallel(np.ndarray[INT8_TYPE_t, ndim=3] frames, int deinterlace_order, int num_threads):
+    """ Compress the block of frames to the FTP array, same as compressFrames, but split the image into bands
+        of rows which are compressed in parallel threads without the GIL. 
+
+        Each band keeps its own field sums, which are added together at the end. The ties of the maximum 
+        value are counted in the first pass, and the max frames are chosen in the second pass, in which 
+        every row starts at the same index of the random number sequence as it does in compressFrames. The 
+        result is therefore identical to the one of compressFrames for any number of threads.
+
+    Arguments:
+        frames: [3D ndarray] Grayscale frames, in format (frame, y, x).
+        deinterlace_order: [int] Deinterlacing order, -1 or -2 if there's no deinterlacing.
+        num_threads: [int] Number of threads to use. If < 1, all available cores will be used.
+
+    Return:
+        (ftp_array, fieldsum):
+            ftp_array: [3D ndarray] Array in format (N, y, x) where N is a member of [0, 1, 2, 3].
+            fieldsum: [ndarray] Sums of intensities per every field.
+    """
+
+    cdef unsigned int height = frames.shape[1]
+    cdef unsigned int width = frames.shape[2]
+    cdef unsigned int frames_num = frames.shape[0]
+    cdef unsigned int deinterlace_multiplier, bands_num, band_height, y, rand_count
+    cdef int band
+
+    # Init the output four frame temporal pixel array
+    cdef np.ndarray[INT8_TYPE_t, ndim=3] ftp_array = np.empty([4, height, width], dtype=INT8_TYPE)
+
+    # If there's no deinterlacing, then only the values from the whole frame will be summed up
+    if deinterlace_order < 0:
+        deinterlace_multiplier = 1
+    else:
+        deinterlace_multiplier = 2
+
+
+    # Use all available cores if the number of threads was not given
+    if num_threads < 1:
+        num_threads = openmp.omp_get_num_procs()
+
+    # Split the image into one band of rows per thread
+    bands_num = max(1, min(num_threads, height))
+    band_height = (height + bands_num - 1)//bands_num
+
+    # Field sums of every band
+    cdef np.ndarray[INT32_TYPE_t, ndim=2] fieldsum_bands = np.zeros((bands_num, 2*frames_num), INT32_TYPE)
+
+    # Number of frames with the maximum value and number of ties of every pixel, and the number of ties and
+    # the starting random number index of every row
+    cdef np.ndarray[np.uint16_t, ndim=2] num_equal = np.empty((height, width), np.uint16)
+    cdef np.ndarray[np.uint16_t, ndim=2] tie_count = np.empty((height, width), np.uint16)
+    cdef np.ndarray[INT32_TYPE_t, ndim=1] row_ties = np.empty(height, INT32_TYPE)
+    cdef np.ndarray[INT32_TYPE_t, ndim=1] row_rand_count = np.empty(height, INT32_TYPE)
+
+    # Get the table of 2**16 random numbers used for breaking max pixel ties
+    cdef INT8_TYPE_t[:] randomN = RANDOM_N
+
+    cdef INT8_TYPE_t[:, :, :] frames_view = frames
+    cdef INT8_TYPE_t[:, :, :] ftp_view = ftp_array
+    cdef INT32_TYPE_t[:, :] fieldsum_view = fieldsum_bands
+    cdef np.uint16_t[:, :] num_equal_view = num_equal
+    cdef np.uint16_t[:, :] tie_count_view = tie_count
+    cdef INT32_TYPE_t[:] row_ties_view = row_ties
+    cdef INT32_TYPE_t[:] row_rand_count_view = row_rand_count
+
+
+    for band in prange(bands_num, nogil=True, num_threads=num_threads, schedule='static'):
+        compressRows(frames_view, ftp_view, num_equal_view, tie_count_view, row_ties_view, fieldsum_view, 
+            band, band*band_height, min((band + 1)*band_height, height), deinterlace_order, 
+            deinterlace_multiplier)
+
+
+    # Index of the last used random number at the beginning of every row, compressFrames starts at 1
+    rand_count = 1
+    for y in range(height):
+        row_rand_count[y] = rand_count
+        rand_count = (rand_count + row_ties[y])%65536
+
+
+    for band in prange(bands_num, nogil=True, num_threads=num_threads, schedule='static'):
+        selectRowsMaxFrames(frames_view, ftp_view, num_equal_view, tie_count_view, row_rand_count_view, 
+            randomN, band*band_height, min((band + 1)*band_height, height))
+
+
+    # Reduce the field sums of all bands
+    fieldsum = fieldsum_bands.sum(axis=0, dtype=INT32_TYPE)
+
+    return ftp_array, fieldsum[:frames_num*deinterlace_multiplier]
+
+
+
+cdef class FrameCompressor:
+    """ Incremental FTP compression. Instead of waiting for the whole block of frames and walking through it
+        pixel by pixel, the running maximum, the maximum frame, sums and sums of squares of every pixel are 
+        updated as each frame arrives, in a frame-major order which is friendly to the CPU cache. When all
+        frames are added, finish() produces the FTP array and the field sums which are bit-identical to the
+        ones produced by compressFrames, including the randomized selection of the max frame.
+
+        The frames have to be added in order. They are stored in the given frame block (which is usually the
+        shared memory block the frames are captured to, so no copying is done in that case), as the frames 
+        with ties of the max value have to be revisited when the random max frame selection is done.
+
+    """
+
+    # Block of frames which are being compressed
+    cdef public np.ndarray frames
+
+    cdef public int deinterlace_order
+    cdef public unsigned int frames_added
+    cdef unsigned int deinterlace_multiplier
+
+    # Per-pixel running values
+    cdef np.ndarray max_val, max_frame, num_equal, tie_count, acc, var
+
+    # Intensity sums per every field
+    cdef np.ndarray fieldsum
+
+
+    def __init__(self, frames, deinterlace_order):
+        """
+        Arguments:
+            frames: [3D ndarray] Block of frames (uint8) to which the frames will be added, (N, y, x).
+            deinterlace_order: [int] Deinterlace order, as given in the config file.
+
+        """
+
+        self.frames = frames
+        self.deinterlace_order = deinterlace_order
+
+        # If there's no deinterlacing, then only the values from the whole frame will be summed up
+        if deinterlace_order < 0:
+            self.deinterlace_multiplier = 1
+        else:
+            self.deinterlace_multiplier = 2
+
+        height, width = frames.shape[1], frames.shape[2]
+
+        self.max_val = np.zeros((height, width), dtype=INT8_TYPE)
+        self.max_frame = np.zeros((height, width), dtype=INT8_TYPE)
+        self.num_equal = np.zeros((height, width), dtype=np.uint16)
+        self.tie_count = np.zeros((height, width), dtype=np.uint16)
+        self.acc = np.zeros((height, width), dtype=INT32_TYPE)
+        self.var = np.zeros((height, width), dtype=INT32_TYPE)
+        self.fieldsum = np.zeros((2*frames.shape[0]), dtype=INT32_TYPE)
+
+        self.frames_added = 0
+
+
+
+    def reset(self):
+        """ Clear all accumulated values, so a new block of frames can be compressed. """
+
+        self.max_val.fill(0)
+        self.max_frame.fill(0)
+        self.num_equal.fill(0)
+        self.tie_count.fill(0)
+        self.acc.fill(0)
+        self.var.fill(0)
+        self.fieldsum.fill(0)
+
+        self.frames_added = 0
+
+
+
+    @cython.boundscheck(False)
+    @cython.wraparound(False)
+    def addFrame(self, np.ndarray[INT8_TYPE_t, ndim=2] frame, unsigned int n):
+        """ Add the next frame to the compression.
+
+        Arguments:
+            frame: [2D ndarray] Grayscale uint8 frame. If it is not a view of the frame block already, it 
+                will be copied to the block.
+            n: [int] Index of the frame in the block. Frames have to be added in order.
+
+        """
+
+        if n != self.frames_added:
+            raise ValueError("Frame {:d} was given, but frame {:d} was expected!".format(n, 
+                self.frames_added))
+
+        if n >= self.frames.shape[0]:
+            raise ValueError("The frame block is already full!")
+
+        # Store the frame to the block, if it is not already there
+        if not np.may_share_memory(frame, self.frames[n]):
+            self.frames[n] = frame
+
+        cdef np.ndarray[INT8_TYPE_t, ndim=2] max_val = self.max_val
+        cdef np.ndarray[INT8_TYPE_t, ndim=2] max_frame = self.max_frame
+        cdef np.ndarray[np.uint16_t, ndim=2] num_equal = self.num_equal
+        cdef np.ndarray[np.uint16_t, ndim=2] tie_count = self.tie_count
+        cdef np.ndarray[INT32_TYPE_t, ndim=2] acc = self.acc
+        cdef np.ndarray[INT32_TYPE_t, ndim=2] var = self.var
+        cdef np.ndarray[INT32_TYPE_t, ndim=1] fieldsum = self.fieldsum
+
+        cdef unsigned int x, y, pixel, row_sum, fieldsum_indx
+        cdef unsigned int height = frame.shape[0]
+        cdef unsigned int width = frame.shape[1]
+        cdef unsigned int deinterlace_multiplier = self.deinterlace_multiplier
+        cdef int deinterlace_order = self.deinterlace_order
+
+        for y in range(height):
+
+            row_sum = 0
+
+            for x in range(width):
+
+                pixel = frame[y, x]
+                acc[y, x] += pixel
+                var[y, x] += pixel*pixel
+                row_sum += pixel
+
+                # Assign the maximum value
+                if pixel > max_val[y, x]:
+
+                    max_val[y, x] = pixel
+                    max_frame[y, x] = n
+                    num_equal[y, x] = 1
+
+                # Count the ties of the maximum value, the max frame will be chosen at the end
+                elif pixel == max_val[y, x]:
+
+                    num_equal[y, x] += 1
+                    tie_count[y, x] += 1
+
+
+            # Calculate the index for fieldsum, dependent on the deinterlace order (and if there's any
+            # detinerlacing at all)
+            fieldsum_indx = deinterlace_multiplier*n \
+                + (deinterlace_multiplier - 1)*((y + deinterlace_order)%2)
+
+            # Sum intensity per every field
+            fieldsum[fieldsum_indx] += row_sum
+
+
+        self.frames_added += 1
+
+
+
+    @cython.cdivision(True)
+    @cython.boundscheck(False)
+    @cython.wraparound(False)
+    def finish(self):
+        """ Compute the FTP array from the added frames.
+
+        Return:
+            (ftp_array, fieldsum): 
+                - ftp_array: [3D ndarray] In format: (N, y, x) where N is a member of [0, 1, 2, 3].
+                - fieldsum: [ndarray] Sums of intensities per every field.
+        """
+
+        cdef INT8_TYPE_t[:, :, :] frames = self.frames
+        cdef np.ndarray[INT8_TYPE_t, ndim=2] max_val_arr = self.max_val
+        cdef np.ndarray[INT8_TYPE_t, ndim=2] max_frame_arr = self.max_frame
+        cdef np.ndarray[np.uint16_t, ndim=2] num_equal_arr = self.num_equal
+        cdef np.ndarray[np.uint16_t, ndim=2] tie_count_arr = self.tie_count
+        cdef np.ndarray[INT32_TYPE_t, ndim=2] acc_arr = self.acc
+        cdef np.ndarray[INT32_TYPE_t, ndim=2] var_arr = self.var
+        cdef INT8_TYPE_t[:] randomN = RANDOM_N
+
+        cdef unsigned int height = frames.shape[1]
+        cdef unsigned int width = frames.shape[2]
+        cdef unsigned int frames_num = self.frames_added
+        cdef unsigned int frames_num_minus_one = frames_num - 1
+        cdef unsigned int frames_num_minus_two = frames_num - 2
+
+        # Init the output four frame temporal pixel array
+        cdef np.ndarray[INT8_TYPE_t, ndim=3] ftp_array = np.empty([4, height, width], dtype=INT8_TYPE)
+
+        cdef unsigned int x, y, acc, var, mean, max_val, max_frame, ties
+
+        # Index of the last used random number, the same as in compressFrames
+        cdef unsigned int rand_count = 1
+
+        for y in range(height):
+            for x in range(width):
+
+                max_val = max_val_arr[y, x]
+                max_frame = max_frame_arr[y, x]
+                ties = tie_count_arr[y, x]
+
+
+                # Choose the max frame between the frames with the same maximum value
+                if ties > 0:
+                    max_frame = selectMaxFrame(frames, randomN, y, x, frames_num, max_val, max_frame, 
+                        num_equal_arr[y, x], ties, rand_count)
+
+                    rand_count = (rand_count + ties)%65536
+
+
+                acc = acc_arr[y, x]
+                var = var_arr[y, x]
+
+                # Calculate mean
+                acc -= max_val    # remove max_val pixel from average
+                mean = acc/frames_num_minus_one
+                
+                # Calculate stddev
+                var -= max_val*max_val;     # remove max_val pixel
+                var -= acc*mean;    # subtract average squared sum of all values (acc*mean = acc*acc/frames_num_minus_one)
+                var = <unsigned int> sqrt(var/frames_num_minus_two)
+
+                # Make sure that the stddev is not 0, to prevent divide by zero afterwards
+                if var == 0:
+                    var = 1
+                
+
+                # Output results
+                ftp_array[0, y, x] = max_val
+                ftp_array[1, y, x] = max_frame
+                ftp_array[2, y, x] = mean
+                ftp_array[3, y, x] = var
+
+
+        return ftp_array, self.fieldsum[:frames_num*self.deinterlace_multiplier].copy()
@@ -53,6 +53,18 @@ class Config:
         self.longitude = 0
         self.elevation = 0
         self.cams_code = 0
+
+        # Save the pipeline metrics (stage timings, counters, queue sizes) to files
+        self.metrics_enabled = False
+
+        # Format of the metrics files, either 'prom' (Prometheus text format) or 'jsonl' (JSON lines)
+        self.metrics_format = 'prom'
+
+        # Interval in seconds between writes of the metrics
+        self.metrics_flush_interval = 60.0
+
+        # Directory for the metrics files, relative to the data directory
+        self.metrics_dir = 'Metrics'
         
         ##### Capture
         self.deviceID = 0
@@ -65,6 +77,15 @@ class Config:
 
         self.report_dropped_frames = False
 
+        # Replay the frames from files at the rate given by the FPS, instead of as fast as possible
+        self.replay_real_time = True
+
+        # Decode the frames into a reused buffer instead of allocating a new array for every frame
+        self.zero_copy_capture = False
+
+        # Number of 256-frame blocks in shared memory used for handing over the frames to the compression
+        self.frame_ring_blocks = 2
+
         # Region of interest, -1 disables the range
         self.roi_left = -1
         self.roi_right = -1
@@ -78,6 +99,7 @@ class Config:
         self.gamma = 1.0
 
         self.ff_format = 'fits'
+        self.ff_night_container = False
         
         self.fov_w = 64.0
         self.fov_h = 35.0
@@ -112,10 +134,14 @@ class Config:
 
         ##### Weave compilation arguments
         self.extra_compile_args = ["-O3"]
+
+        ##### Compression
+        self.compression_threads = 1 # number of threads used for compressing a block of frames (0 - use all cores)
         
         ##### FireballDetection
         self.f = 16                    # subsampling factor
         self.max_time = 25             # maximum time for line finding
+        self.extraction_buffers = 1    # number of buffers the blocks are copied to for extraction
         
         # params for Extractor.findPoints()
         self.white_avg_level = 220     # ignore images which have the average frame above this level
@@ -144,6 +170,7 @@ class Config:
         self.line_minimum_frame_range = 3   # minimum range of frames that a line should cover (eliminates flash detections)
         self.line_distance_const = 4   # constant that determines the influence of average point distance on the line quality
         self.point_ratio_threshold = 0.7# ratio of how many points must be close to the line before considering searching for another line
+        self.line_finding_method = 'exhaustive' # 3D line finder, 'exhaustive' tests all point pairs, 'ransac' scales to large point clouds
         self.max_lines = 5             # maximum number of lines
 
         ##### MeteorDetection
@@ -160,6 +187,7 @@ class Config:
         self.line_min_dist = 40 # Minimum distance between KHT lines in Cartesian space to merge them (used for merging similar lines after KHT)
         self.stripe_width = 20 # width of the stripe around the line
         self.kht_lib_path = "build/lib.linux-x86_64-2.7/kht_module.so" # path to the compiled KHT module
+        self.kht_threads = 1 # number of threads the KHT runs on for the time windows of one FF file (0 - use all cores)
 
         # 3D line finding for meteor detection
         self.max_points_det = 600 # maximumum number of points during 3D line search in faint meteor detection (used to minimize runtime)
@@ -169,6 +197,7 @@ class Config:
         self.line_minimum_frame_range_det = 4 # minimum number of frames per one detection
         self.line_distance_const_det = 4 # constant that determines the influence of average point distance on the line quality
         self.max_time_det = 10 # maximum time in seconds for which line finding algorithm can run
+        self.line_finding_method_det = 'exhaustive' # 3D line finder used in faint meteor detection ('exhaustive' or 'ransac')
 
         # 3D line merging parameters
         self.vect_angle_thresh = 20 # angle similarity between 2 lines in a stripe to be merged
@@ -198,6 +227,12 @@ class Config:
         self.roundness_threshold = 0.5 # minimum ratio of 2D Gaussian sigma X and sigma Y to be taken as a stars (hot pixels are narrow, while stars are round)
         self.max_feature_ratio = 0.8 # maximum ratio between 2 sigma of the star and the image segment area
 
+        # Star tracking between consecutive FF files
+        self.star_tracking = False # re-fit the stars from the previous FF file instead of searching the whole image
+        self.star_tracking_full_search_every = 10 # search the whole image on every Nth FF file
+        self.star_tracking_min_match_ratio = 0.8 # search the whole image if a smaller ratio of tracked stars is confirmed
+        self.star_tracking_max_gap = 60 # maximum time in seconds between FF files for tracking stars
+
 
         ##### Calibration
         self.use_flat = True
@@ -310,6 +345,19 @@ def parseSystem(config, parser):
         config.cams_code = parser.getint(section, "cams_code")
 
 
+    if parser.has_option(section, "metrics_enabled"):
+        config.metrics_enabled = parser.getboolean(section, "metrics_enabled")
+
+    if parser.has_option(section, "metrics_format"):
+        config.metrics_format = parser.get(section, "metrics_format").strip().lower()
+
+    if parser.has_option(section, "metrics_flush_interval"):
+        config.metrics_flush_interval = parser.getfloat(section, "metrics_flush_interval")
+
+    if parser.has_option(section, "metrics_dir"):
+        config.metrics_dir = parser.get(section, "metrics_dir")
+
+
 
 def parseCapture(config, parser):
     section = "Capture"
@@ -356,6 +404,15 @@ def parseCapture(config, parser):
     if parser.has_option(section, "report_dropped_frames"):
         config.report_dropped_frames = parser.getboolean(section, "report_dropped_frames")
 
+    if parser.has_option(section, "replay_real_time"):
+        config.replay_real_time = parser.getboolean(section, "replay_real_time")
+
+    if parser.has_option(section, "zero_copy_capture"):
+        config.zero_copy_capture = parser.getboolean(section, "zero_copy_capture")
+
+    if parser.has_option(section, "frame_ring_blocks"):
+        config.frame_ring_blocks = parser.getint(section, "frame_ring_blocks")
+
 
     # Parse the region of interest boundaries
     if parser.has_option(section, "roi_left"):
@@ -426,6 +483,9 @@ def parseCapture(config, parser):
     if parser.has_option(section, "ff_format"):
         config.ff_format = parser.get(section, "ff_format")
 
+    if parser.has_option(section, "ff_night_container"):
+        config.ff_night_container = parser.getboolean(section, "ff_night_container")
+
     if parser.has_option(section, "fov_w"):
         config.fov_w = parser.getfloat(section, "fov_w")
 
@@ -500,7 +560,12 @@ def parseBuildArgs(config, parser):
 
 def parseCompression(config, parser):
     section = "Compression"
-    pass
+    
+    if not parser.has_section(section):
+        return
+
+    if parser.has_option(section, "compression_threads"):
+        config.compression_threads = parser.getint(section, "compression_threads")
 
 
 
@@ -516,6 +581,9 @@ def parseFireballDetection(config, parser):
     if parser.has_option(section, "max_time"):
         config.max_time = parser.getint(section, "max_time")
 
+    if parser.has_option(section, "extraction_buffers"):
+        config.extraction_buffers = parser.getint(section, "extraction_buffers")
+
     if parser.has_option(section, "white_avg_level"):
         config.white_avg_level = parser.getint(section, "white_avg_level")
     
@@ -579,6 +647,9 @@ def parseFireballDetection(config, parser):
     
     if parser.has_option(section, "point_ratio_threshold"):
         config.point_ratio_threshold = parser.getfloat(section, "point_ratio_threshold")        
+
+    if parser.has_option(section, "line_finding_method"):
+        config.line_finding_method = parser.get(section, "line_finding_method").strip().lower()
     
     if parser.has_option(section, "max_lines"):
         config.max_lines = parser.getint(section, "max_lines")
@@ -615,6 +686,9 @@ def parseMeteorDetection(config, parser):
     if parser.has_option(section, "max_lines_det"):
         config.max_lines_det = parser.getint(section, "max_lines_det")
 
+    if parser.has_option(section, "kht_threads"):
+        config.kht_threads = parser.getint(section, "kht_threads")
+
     if parser.has_option(section, "line_min_dist"):
         config.line_min_dist = parser.getint(section, "line_min_dist")
 
@@ -640,6 +714,9 @@ def parseMeteorDetection(config, parser):
     if parser.has_option(section, "max_time_det"):
         config.max_time_det = parser.getint(section, "max_time_det")
 
+    if parser.has_option(section, "line_finding_method_det"):
+        config.line_finding_method_det = parser.get(section, "line_finding_method_det").strip().lower()
+
     if parser.has_option(section, "stripe_width"):
         config.stripe_width = parser.getint(section, "stripe_width")
 
@@ -719,6 +796,18 @@ def parseStarExtraction(config, parser):
     if parser.has_option(section, "max_feature_ratio"):
         config.max_feature_ratio = parser.getfloat(section, "max_feature_ratio")
 
+    if parser.has_option(section, "star_tracking"):
+        config.star_tracking = parser.getboolean(section, "star_tracking")
+
+    if parser.has_option(section, "star_tracking_full_search_every"):
+        config.star_tracking_full_search_every = parser.getint(section, "star_tracking_full_search_every")
+
+    if parser.has_option(section, "star_tracking_min_match_ratio"):
+        config.star_tracking_min_match_ratio = parser.getfloat(section, "star_tracking_min_match_ratio")
+
+    if parser.has_option(section, "star_tracking_max_gap"):
+        config.star_tracking_max_gap = parser.getfloat(section, "star_tracking_max_gap")
+
 
 
 def parseCalibration(config, parser):
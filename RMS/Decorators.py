@@ -2,6 +2,7 @@
 
 
 import functools
+import collections
 
 
 class memoizeAll(object):
@@ -90,4 +91,56 @@ class memoizeSingle(object):
     def __get__(self, obj, objtype):
         """ Support instance methods. """
 
-        return functools.partial(self.__call__, obj)
\ No newline at end of file
+        return functools.partial(self.__call__, obj)
+
+
+
+class memoizeLRU(object):
+    """ Decorator. Caches a function's return value each time it is called. If called later with the same 
+        arguments, the cached value is returned (not reevaluated). 
+
+        This version caches up to the given number of inputs, the least recently used one is discarded when 
+        the cache is full.
+
+    Usage:
+
+        @memoizeLRU(maxsize=64)
+        def func(...):
+            ...
+
+    """
+
+    def __init__(self, maxsize=128):
+        self.maxsize = maxsize
+
+
+    def __call__(self, func):
+
+        cache = collections.OrderedDict()
+
+        @functools.wraps(func)
+        def wrapper(*args):
+
+            # Check if arguments already cached, and mark them as the most recently used
+            if args in cache:
+                value = cache.pop(args)
+                cache[args] = value
+
+                return value
+
+
+            # If not, compute the function value and store in cache
+            value = func(*args)
+            cache[args] = value
+
+            # Discard the least recently used value
+            if len(cache) > self.maxsize:
+                cache.popitem(last=False)
+
+            return value
+
+
+        # Expose the cache so it can be cleared
+        wrapper.cache = cache
+
+        return wrapper
@@ -25,9 +25,11 @@ import argparse
 
 # RMS imports
 import RMS.ConfigReader as cr
+from RMS import Metrics
 from RMS.Formats import FTPdetectinfo
 from RMS.Formats import CALSTARS
 from RMS.Formats.FFfile import validFFName
+from RMS.Formats import FFnight
 from RMS.ExtractStars import extractStars
 from RMS.Detection import detectMeteors
 from RMS.QueuedPool import QueuedPool
@@ -57,8 +59,11 @@ def detectStarsAndMeteors(ff_directory, ff_name, config, flat_struct=None):
 
     log.info('Running detection on file: ' + ff_name)
 
+    t1 = time.time()
+
     # Run star extraction on the FF bin
-    star_list = extractStars(ff_directory, ff_name, config, flat_struct=flat_struct)
+    with Metrics.timer('star_extraction'):
+        star_list = extractStars(ff_directory, ff_name, config, flat_struct=flat_struct)
 
     log.info('Detected stars: ' + str(len(star_list[0])))
 
@@ -67,7 +72,8 @@ def detectStarsAndMeteors(ff_directory, ff_name, config, flat_struct=None):
 
         log.debug('More than ' + str(config.ff_min_stars) + ' stars, detecting meteors...')
 
-        meteor_list = detectMeteors(ff_directory, ff_name, config, flat_struct=flat_struct)
+        with Metrics.timer('meteor_detection'):
+            meteor_list = detectMeteors(ff_directory, ff_name, config, flat_struct=flat_struct)
 
         log.info(ff_name + ' detected meteors: ' + str(len(meteor_list)))
 
@@ -75,6 +81,10 @@ def detectStarsAndMeteors(ff_directory, ff_name, config, flat_struct=None):
         meteor_list = []
 
 
+    # Total detection time per FF file
+    Metrics.addTime('detection', time.time() - t1)
+
+
     return ff_name, star_list, meteor_list
 
 
@@ -180,7 +190,10 @@ def detectStarsAndMeteorsDirectory(dir_path, config):
     # Get paths to every FF bin file in a directory 
     ff_dir = dir_path
     ff_dir = os.path.abspath(ff_dir)
-    ff_list = [ff_name for ff_name in sorted(os.listdir(ff_dir)) if validFFName(ff_name)]
+    ff_list = [ff_name for ff_name in os.listdir(ff_dir) if validFFName(ff_name)]
+
+    # Add the FF files stored in the night container
+    ff_list = sorted(set(ff_list + FFnight.listFF(ff_dir)))
 
 
     # Check if there are any file in the directory
@@ -205,13 +218,13 @@ def detectStarsAndMeteorsDirectory(dir_path, config):
 
     print('Starting detection...')
 
-    # Initialize the detector
-    detector = QueuedPool(detectStarsAndMeteors, cores=-1, log=log, backup_dir=ff_dir)
+    # Initialize the detector, the config and the flat are sent to every worker only once
+    detector = QueuedPool(detectStarsAndMeteors, cores=-1, log=log, backup_dir=ff_dir, \
+        func_extra_args=[config, flat_struct])
 
     # Give detector jobs
-    for ff_name in ff_list:
-        print('Adding for detection:', ff_name)
-        detector.addJob([ff_dir, ff_name, config, flat_struct], wait_time=0)
+    print('Adding {:d} files for detection...'.format(len(ff_list)))
+    detector.addJobs([[ff_dir, ff_name] for ff_name in ff_list])
 
 
     # Start the detection
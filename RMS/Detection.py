@@ -19,10 +19,8 @@ from __future__ import print_function, absolute_import, division
 import logging
 from time import time
 import sys, os
-import ctypes
 
 import numpy as np
-import numpy.ctypeslib as npct
 import cv2
 
 # Plotting
@@ -39,6 +37,8 @@ from RMS.Routines.CompareLines import compareLines
 from RMS.Routines import MaskImage
 from RMS.Routines import Image
 from RMS.Routines import RollingShutterCorrection
+from RMS.DetectionContext import getDetectionContext
+from RMS.Decorators import memoizeLRU
 
 # Morphology - Cython init
 import pyximport
@@ -108,6 +108,55 @@ def selectFrames(img_thres, ff, frame_min, frame_max):
 
 
 
+def sortByFrame(img_thres, ff):
+    """ Sort the threshold passers by the frame in which they reached the maximum, so the pixels in any frame 
+        range can be selected without going through the whole image again.
+    
+    Arguments:
+        img_thres: [ndarray] 2D numpy array containing the thresholded image
+        ff: [FF object] FF image object
+
+    Return:
+        (pixel_indices, pixel_frames): [tuple of ndarrays] flat indices of the threshold passers and their
+            frames, sorted by frame
+    """
+
+    pixel_indices = np.flatnonzero(img_thres)
+    pixel_frames = ff.maxframe.ravel()[pixel_indices]
+
+    # Sort by frame, keeping the pixels of the same frame in the image order
+    order = np.argsort(pixel_frames, kind='stable')
+
+    return pixel_indices[order], pixel_frames[order]
+
+
+
+def selectFramesSorted(pixel_indices, pixel_frames, frame_min, frame_max, img):
+    """ Select only pixels in a given frame range, from the threshold passers sorted by sortByFrame. Gives
+        the same image as selectFrames.
+    
+    Arguments:
+        pixel_indices: [ndarray] flat indices of the threshold passers, sorted by frame
+        pixel_frames: [ndarray] sorted frames of the threshold passers
+        frame_min: [int] first frame in a range to take
+        frame_max: [int] last frame in a range to take
+        img: [ndarray] uint8 image into which the selected pixels will be written, it is cleared first
+
+    Return:
+        [ndarray] the given image with pixels only from the given frame range
+    """
+
+    # Find the range of the threshold passers in the given frame range
+    start = np.searchsorted(pixel_frames, frame_min, side='left')
+    end = np.searchsorted(pixel_frames, frame_max, side='right')
+
+    img.fill(0)
+    img.ravel()[pixel_indices[start:end]] = 1
+
+    return img
+
+
+
 def getPolarLine(x1, y1, x2, y2, img_h, img_w):
     """ Calculate polar line coordinates (Hough transform coordinates) rho and theta given the 2 points that 
         define a line in Cartesian coordinates. Coordinate system starts in the image center, to replicate 
@@ -144,8 +193,13 @@ def getPolarLine(x1, y1, x2, y2, img_h, img_w):
 
 
 
+@memoizeLRU(maxsize=64)
 def getStripeIndices(rho, theta, stripe_width, img_h, img_w):
     """ Get indices of the stripe centered on a line. Line parameters are in Hough Transform form.
+
+        The stripe is rasterized with array operations, one span of pixels per image row (or column for 
+        lines closer to the horizontal). The results are cached for the last few lines, as the same line is
+        usually requested more than once.
     
     Arguments:
         rho: [float] Line distance from the center in HT space (pixels).
@@ -155,7 +209,7 @@ def getStripeIndices(rho, theta, stripe_width, img_h, img_w):
         img_w: [int] Original image width in pixels.
 
     Return:
-        (indicesy, indicesx): [tuple] a tuple of x and y indices of stripe pixels
+        (indicesy, indicesx): [tuple] a tuple of y and x indices of stripe pixels (read-only integer arrays)
 
     """
 
@@ -172,9 +226,8 @@ def getStripeIndices(rho, theta, stripe_width, img_h, img_w):
     hh = img_h/2.0
     hw = img_w/2.0
 
-    indicesy = []
-    indicesx = []
-     
+    # The stripe is computed along the axis which is closer to the line direction (the "major" axis), and
+    # for every position along it a span of pixels across the other ("minor") axis is taken
     if theta < 45 or (theta > 90 and theta < 135):
 
         theta = np.radians(theta)
@@ -182,27 +235,10 @@ def getStripeIndices(rho, theta, stripe_width, img_h, img_w):
 
         a = -np.tan(theta)
         b = rho/np.cos(theta)
-         
-        for y in range(int(-hh), int(hh)):
-
-            x0 = a*y + b
-             
-            x1 = int(x0 - half_limit + hw)
-            x2 = int(x0 + half_limit + hw)
-             
-            if x1 > x2:
-                x1, x2 = x2, x1
-             
-            if x2 < 0 or x1 >= img_w:
-                continue
-            
-            for x in range(x1, x2):
-                if x < 0 or x >= img_w:
-                    continue
-                 
-                indicesy.append(y + hh)
-                indicesx.append(x)
-                 
+
+        rows_major = True
+        major_half, minor_half, minor_size = hh, hw, img_w
+        
     else:
 
         theta = np.radians(theta)
@@ -210,29 +246,40 @@ def getStripeIndices(rho, theta, stripe_width, img_h, img_w):
 
         a = -1/np.tan(theta)
         b = rho/np.sin(theta)
-         
-        for x in range(int(-hw), int(hw)):
-            y0 = a*x + b
-             
-            y1 = int(y0 - half_limit + hh)
-            y2 = int(y0 + half_limit + hh)
-             
-            if y1 > y2:
-                y1, y2 = y2, y1
-             
-            if y2 < 0 or y1 >= img_h:
-                continue
-                
-            for y in range(y1, y2):
-                if y < 0 or y >= img_h:
-                    continue
-                 
-                indicesy.append(y)
-                indicesx.append(x + hw)
 
-    # Convert indices to integer
-    indicesx = list(map(int, indicesx))
-    indicesy = list(map(int, indicesy))
+        rows_major = False
+        major_half, minor_half, minor_size = hw, hh, img_h
+
+
+    # Positions along the major axis, relative to the image centre
+    major = np.arange(int(-major_half), int(major_half))
+
+    # Line position on the minor axis
+    minor0 = a*major + b
+
+    # Span limits, truncated towards zero in the same way as int()
+    minor1 = np.trunc(minor0 - half_limit + minor_half).astype(np.int64)
+    minor2 = np.trunc(minor0 + half_limit + minor_half).astype(np.int64)
+
+    # Order the limits and clip them to the image
+    span_start = np.clip(np.minimum(minor1, minor2), 0, minor_size)
+    span_end = np.clip(np.maximum(minor1, minor2), 0, minor_size)
+    span_len = np.maximum(span_end - span_start, 0)
+
+    # Repeat every major axis position by the length of its span, and enumerate the pixels inside the spans
+    major_ind = np.repeat((major + major_half).astype(np.int64), span_len)
+    minor_ind = np.repeat(span_start - np.cumsum(span_len) + span_len, span_len) \
+        + np.arange(np.sum(span_len))
+
+    if rows_major:
+        indicesy, indicesx = major_ind, minor_ind
+    else:
+        indicesy, indicesx = minor_ind, major_ind
+
+
+    # The arrays are shared by the cache, so protect them from being modified
+    indicesy.setflags(write=False)
+    indicesx.setflags(write=False)
 
     return (indicesy, indicesx)
 
@@ -477,7 +524,7 @@ def merge3DLines(line_list, vect_angle_thresh, last_count=0):
 
 
 
-def getLines(ff, k1, j1, time_slide, time_window_size, max_lines, max_white_ratio, kht_lib_path):
+def getLines(ff, k1, j1, time_slide, time_window_size, max_lines, max_white_ratio, kht_lib_path, kht_threads=1):
     """ Get (rho, phi) pairs for each meteor present on the image using KHT.
         
     Arguments:
@@ -489,24 +536,17 @@ def getLines(ff, k1, j1, time_slide, time_window_size, max_lines, max_white_rati
         max_lines: [int] maximum number of lines to find by KHT
         max_white_ratio: [float] max ratio between write and all pixels after thresholding
         kht_lib_path: [string] path to the compiled KHT library
+
+    Keyword arguments:
+        kht_threads: [int] number of threads the KHT runs on when all time windows are processed in one batch 
+            call (0 - use all cores). Ignored if the KHT library was compiled without the batch function.
     
     Return:
         [list] a list of all found lines
     """
 
-    # Load the KHT library
-    kht = ctypes.cdll.LoadLibrary(kht_lib_path)
-    kht.kht_wrapper.argtypes = [npct.ndpointer(dtype=np.double, ndim=2),
-                                npct.ndpointer(dtype=np.byte, ndim=1),
-                                ctypes.c_size_t,
-                                ctypes.c_size_t,
-                                ctypes.c_size_t,
-                                ctypes.c_size_t,
-                                ctypes.c_double,
-                                ctypes.c_double,
-                                ctypes.c_double,
-                                ctypes.c_double]
-    kht.kht_wrapper.restype = ctypes.c_size_t
+    # Get the KHT library, it is loaded only once per process
+    kht = getDetectionContext().getKHT(kht_lib_path)
 
     line_results = []
 
@@ -531,13 +571,32 @@ def getLines(ff, k1, j1, time_slide, time_window_size, max_lines, max_white_rati
 
 
     # Subdivide the image by time into overlapping parts (decreases noise when searching for meteors)
-    for i in range(0, int(256/time_slide - 1)):
+    time_windows = [(i*time_slide, i*time_slide + time_window_size) for i in range(0, int(256/time_slide - 1))]
+
+    if not time_windows:
+        return line_results
+
+    # Sort the threshold passers by frame once, so every time window can be selected quickly
+    pixel_indices, pixel_frames = sortByFrame(img_thres, ff)
 
-        frame_min = i*time_slide
-        frame_max = i*time_slide + time_window_size
+    # Buffers which are reused for every time window
+    img_window = np.zeros((ff.nrows, ff.ncols), dtype=np.uint8)
+    morph_buffers = morph.MorphBuffers(ff.nrows, ff.ncols)
+
+    # If the library supports it, the KHT input images of all time windows are stacked and processed in 
+    # one call, otherwise the KHT is run on every time window separately
+    if kht.batch_available:
+        img_stack = np.empty((len(time_windows), ff.nrows*ff.ncols), dtype=np.byte)
+
+    else:
+        img_flatten = np.empty(ff.nrows*ff.ncols, dtype=np.byte)
+        lines = np.empty((max_lines, 2), np.double)
+
+
+    for i, (frame_min, frame_max) in enumerate(time_windows):
 
         # Select the time range of the thresholded image
-        img = selectFrames(img_thres, ff, frame_min, frame_max)
+        img = selectFramesSorted(pixel_indices, pixel_frames, frame_min, frame_max, img_window)
 
         # Show thresholded image
         # show(str(frame_min) + "-" + str(frame_max) + " threshold", img)
@@ -555,7 +614,7 @@ def getLines(ff, k1, j1, time_slide, time_window_size, max_lines, max_white_rati
             # 3 - close (Close surrounded pixels)
             # 4 - thin (Thin all lines to 1px width)
             # 1 - Remove lonely pixels
-        img = morph.morphApply(img, [1, 2, 3, 4, 1])
+        img = morph.morphApply(img, [1, 2, 3, 4, 1], morph_buffers)
 
         # # Show morphed over maxpixel
         # temp = ff.maxpixel - img.astype(np.int16)*255
@@ -567,36 +626,125 @@ def getLines(ff, k1, j1, time_slide, time_window_size, max_lines, max_white_rati
 
         ###
 
-        # Get image shape
-        w, h = img.shape[1], img.shape[0]
+        # Convert the image to feed it into the KHT (white pixels are 255)
+        if kht.batch_available:
+            np.multiply(img.ravel(), 255, out=img_stack[i], casting='unsafe')
+            continue
 
-        # Convert the image to feed it into the KHT
-        img_flatten = (img.flatten().astype(np.byte)*255).astype(np.byte)
-        
-        # Predefine the line output
-        lines = np.empty((max_lines, 2), np.double)
+        np.multiply(img.ravel(), 255, out=img_flatten, casting='unsafe')
         
         # Call the KHT line finding
         # Parameters: cluster_min_size (px), cluster_min_deviation, delta, kernel_min_height, n_sigmas
-        length = kht.kht_wrapper(lines, img_flatten, w, h, max_lines, 9, 2, 0.1, 0.004, 1)
+        length = kht.kht_wrapper(lines, img_flatten, ff.ncols, ff.nrows, max_lines, 9, 2, 0.1, 0.004, 1)
         
         # Cut the line array to the number of found lines
-        lines = lines[:length]
+        found_lines = lines[:length]
 
 
         # Skip further operations if there are no lines
-        if lines.any():
-            for rho, theta in lines:
+        if found_lines.any():
+            for rho, theta in found_lines:
                 line_results.append([rho, theta, frame_min, frame_max])
 
 
-        # if line_results:
-        #     plotLines(ff, line_results)
+    if kht.batch_available:
+
+        # Run the KHT on all time windows, every found line is tagged with the index of its time window
+        # Parameters: cluster_min_size (px), cluster_min_deviation, delta, kernel_min_height, n_sigmas, threads
+        lines = np.empty((len(time_windows)*max_lines, 3), np.double)
+        length = kht.kht_batch_wrapper(lines, img_stack, len(time_windows), ff.ncols, ff.nrows, max_lines, 9, 
+            2, 0.1, 0.004, 1, kht_threads)
+
+        for rho, theta, window_index in lines[:length]:
+            frame_min, frame_max = time_windows[int(window_index)]
+            line_results.append([rho, theta, frame_min, frame_max])
+
+
+    # if line_results:
+    #     plotLines(ff, line_results)
 
 
     return line_results
 
 
+def computeCentroids(line_points, stripe_points, frame_min, frame_max, weights, intensity_img, 
+    deinterlace_order, n_rows):
+    """ Compute weighted centroids of the line points and the intensity of the stripe on every frame (or field, 
+        for interlaced video) in one pass. The points are grouped by frame and field, and all sums are done 
+        with bincount.
+
+    Arguments:
+        line_points: [ndarray] (X, Y, frame) points belonging to the line
+        stripe_points: [ndarray] (X, Y, frame) threshold passers in the whole stripe around the line
+        frame_min: [int] first frame to centroid
+        frame_max: [int] last frame to centroid
+        weights: [ndarray] image of centroiding weights
+        intensity_img: [ndarray] image of pixel intensities, summed over the stripe pixels of every frame
+        deinterlace_order: [int] -2 = global shutter, -1 = rolling shutter, 0 = even first, 1 = odd first
+        n_rows: [int] image height, used for the rolling shutter correction
+    
+    Return:
+        centroids: [list] a list of [frame, X, Y, intensity] centroids, ordered by frame, one per every frame 
+            or field which has line points
+
+    """
+
+    def _groupKeys(points):
+        """ Index of the frame or field every point belongs to, in the order of time. """
+
+        keys = 2*points[:, 2].astype(np.int64)
+
+        # Fields are told apart by the parity of the image row
+        if deinterlace_order >= 0:
+            keys += (points[:, 1].astype(np.int64) - deinterlace_order)%2
+
+        return keys
+
+
+    # Take only the line points inside the frame range
+    line_points = line_points[(line_points[:, 2] >= frame_min) & (line_points[:, 2] <= frame_max)]
+
+    if not len(line_points):
+        return []
+
+    # Group the line points by frame and field
+    keys, groups = np.unique(_groupKeys(line_points), return_inverse=True)
+
+    xs = line_points[:, 0].astype(np.int64)
+    ys = line_points[:, 1].astype(np.int64)
+
+    # Calculate weighted centroids
+    point_weights = weights[ys, xs]
+    weight_sums = np.bincount(groups, weights=point_weights, minlength=len(keys))
+    x_centroids = np.bincount(groups, weights=xs*point_weights, minlength=len(keys))/weight_sums
+    y_centroids = np.bincount(groups, weights=ys*point_weights, minlength=len(keys))/weight_sums
+
+
+    # Calculate intensity as the sum of threshold passer pixels on the stripe, only on frames and fields which 
+    # have line points
+    stripe_keys = _groupKeys(stripe_points)
+    stripe_groups = np.minimum(np.searchsorted(keys, stripe_keys), len(keys) - 1)
+    in_groups = keys[stripe_groups] == stripe_keys
+
+    stripe_points = stripe_points[in_groups]
+    intensities = np.bincount(stripe_groups[in_groups], weights=intensity_img[stripe_points[:, 1], 
+        stripe_points[:, 0]], minlength=len(keys))
+
+
+    # Calculate the frame numbers, the second field is half a frame later
+    frame_nos = keys//2 + 0.5*(keys%2)
+
+    # Correct the rolling shutter effect
+    if deinterlace_order == -1:
+
+        # Compute the corrected frame time
+        frame_nos = RollingShutterCorrection.correctRollingShutterTemporal(frame_nos, y_centroids, n_rows)
+
+
+    return np.column_stack([frame_nos, x_centroids, y_centroids, intensities]).tolist()
+
+
+
 def filterCentroids(centroids, centroid_max_deviation, max_distance):
     """ Check for linearity in centroid data and reject the points which are too far off. 
 
@@ -936,11 +1084,11 @@ def detectMeteors(ff_directory, ff_name, config, flat_struct=None):
     if ff is None:
         return []
 
-    # Load the mask file
-    mask = MaskImage.loadMask(config.mask_file)
+    # Get the mask, it is loaded only once per process
+    mask, mask_struct = getDetectionContext().getMask(config.mask_file)
 
     # Mask the FF file
-    ff = MaskImage.applyMask(ff, mask, ff_flag=True)
+    ff = MaskImage.applyMask(ff, mask, ff_flag=True, mask_struct=mask_struct)
 
     # Apply the flat to maxpixel and avepixel
     if flat_struct is not None:
@@ -954,7 +1102,7 @@ def detectMeteors(ff_directory, ff_name, config, flat_struct=None):
 
     # Get lines on the image
     line_list = getLines(ff, config.k1_det, config.j1_det, config.time_slide, config.time_window_size, 
-        config.max_lines_det, config.max_white_ratio, config.kht_lib_path)
+        config.max_lines_det, config.max_white_ratio, config.kht_lib_path, config.kht_threads)
 
     logDebug('List of lines:', line_list)
 
@@ -1163,87 +1311,10 @@ def detectMeteors(ff_directory, ff_name, config, flat_struct=None):
             ang_vel_avg = np.sqrt((x2 - x1)**2 + (y2 - y1)**2)/(z2 - z1)
 
             # Calculate centroids
-            centroids = []
-
-
-            for i in range(frame_min, frame_max+1):
-                
-                # Select pixel indicies belonging to a given frame
-                frame_pixels_inds = np.where(line_points[:,2] == i)
-                
-                # Get pixel positions in a given frame (pixels belonging to a found line)
-                frame_pixels = line_points[frame_pixels_inds].astype(np.int64)
-
-                # Get pixel positions in a given frame (pixels belonging to the whole stripe)
-                frame_pixels_stripe = stripe_points[np.where(stripe_points[:,2] == i)].astype(np.int64)
-
-                # Skip if there are no pixels in the frame
-                if not len(frame_pixels):
-                    continue
-
-                # Calculate centroids by half-frame
-                for half_frame in range(2):
-
-                    # Apply deinterlacing if it is present in the video
-                    if config.deinterlace_order >= 0:
-
-                        # Deinterlace by fields (line lixels)
-                        half_frame_pixels = frame_pixels[frame_pixels[:,1] % 2 == (config.deinterlace_order 
-                            + half_frame) % 2]
-
-                        # Deinterlace by fields (stripe pixels)
-                        half_frame_pixels_stripe = frame_pixels_stripe[frame_pixels_stripe[:,1] % 2 == (config.deinterlace_order 
-                            + half_frame) % 2]
-
-
-                        # Skip if there are no pixels in the half-frame
-                        if not len(half_frame_pixels):
-                            continue
-
-                        # Calculate half-frame value
-                        frame_no = i+half_frame*0.5
-
-
-                    # No deinterlacing
-                    else:
-
-                        # Skip the second half frame
-                        if half_frame == 1:
-                            continue
-
-                        half_frame_pixels = frame_pixels
-                        half_frame_pixels_stripe = frame_pixels_stripe
-                        frame_no = i
-
-
-                    # Get maxpixel-avepixel values of given pixel indices (this will be used as weights)
-                    max_weights = flattened_weights[half_frame_pixels[:,1], half_frame_pixels[:,0]]
-
-                    # Calculate weighted centroids
-                    x_weighted = half_frame_pixels[:,0]*np.transpose(max_weights)
-                    x_centroid = np.sum(x_weighted)/float(np.sum(max_weights))
-
-                    y_weighted = half_frame_pixels[:,1]*np.transpose(max_weights)
-                    y_centroid = np.sum(y_weighted)/float(np.sum(max_weights))
-
-
-                    # Correct the rolling shutter effect
-                    if config.deinterlace_order == -1:
-
-                        # Compute the corrected frame time
-                        frame_no = RollingShutterCorrection.correctRollingShutterTemporal(frame_no, \
-                            y_centroid, ff.maxpixel.shape[0])
-
-
-                    # Calculate intensity as the sum of threshold passer pixels on the stripe
-                    #intensity_values = max_avg_corrected[half_frame_pixels[:,1], half_frame_pixels[:,0]]
-                    intensity_values = max_avg_corrected[half_frame_pixels_stripe[:,1], 
-                        half_frame_pixels_stripe[:,0]]
-                    intensity = np.sum(intensity_values)
-                    
-                    logDebug("centroid: ", frame_no, x_centroid, y_centroid, intensity)
+            centroids = computeCentroids(line_points, stripe_points, frame_min, frame_max, flattened_weights,
+                max_avg_corrected, config.deinterlace_order, ff.maxpixel.shape[0])
 
-                    centroids.append([frame_no, x_centroid, y_centroid, intensity])
+            logDebug("centroids: ", centroids)
 
 
             # Filter centroids
@@ -0,0 +1,178 @@
+""" Per-process cache of the files which are used for every detection job: the mask and the KHT library. 
+    They are loaded only once per worker process, the mask is loaded again if the file has changed. The flat
+    is not cached here, the callers load it once and give it to the detection.
+"""
+
+from __future__ import print_function, division, absolute_import
+
+import os
+import ctypes
+import logging
+
+import numpy as np
+import numpy.ctypeslib as npct
+
+from RMS.Routines import MaskImage
+
+
+# Get the logger from the main module
+log = logging.getLogger("logger")
+
+
+
+def _fileStamp(file_path):
+    """ Return the (modification time, size) of the file, or None if the file does not exist. """
+
+    try:
+        stat = os.stat(file_path)
+
+    except OSError:
+        return None
+
+    return (stat.st_mtime, stat.st_size)
+
+
+
+class DetectionContext(object):
+    """ Holds the mask and the KHT library of one process. """
+
+    def __init__(self):
+
+        # Cached masks, a dictionary of file paths vs. (file stamp, loaded object)
+        self.masks = {}
+
+        # Loaded KHT libraries, a dictionary of file paths vs. libraries
+        self.kht_libs = {}
+
+
+
+    def _cached(self, cache, file_path, loader):
+        """ Return the cached object for the given file, loading it if it was not loaded yet or if the file
+            has changed since.
+
+        Arguments:
+            cache: [dict] Cache of the given type of objects.
+            file_path: [str] Path to the file.
+            loader: [function] Function which loads the object from the file.
+
+        """
+
+        stamp = _fileStamp(file_path)
+
+        entry = cache.get(file_path)
+
+        if (entry is None) or (entry[0] != stamp):
+
+            log.debug('Loading: {:s}'.format(file_path))
+
+            cache[file_path] = (stamp, loader(file_path))
+
+
+        return cache[file_path][1]
+
+
+
+    def getMask(self, mask_file):
+        """ Return the mask, together with the mask structure prepared for masking the FF files.
+
+        Arguments:
+            mask_file: [str] Path to the mask file.
+
+        Return:
+            (mask_tuple, mask_struct):
+                - mask_tuple: [tuple] (mask_flag, mask), as returned by MaskImage.loadMask.
+                - mask_struct: [MaskStruct] Mask structure with the indices of the masked pixels, or None if
+                    there is no mask.
+        """
+
+        def _loadMask(file_path):
+
+            mask_tuple = MaskImage.loadMask(file_path)
+            mask_flag, mask = mask_tuple
+
+            if mask_flag:
+                mask_struct = MaskImage.MaskStruct(mask)
+
+            else:
+                mask_struct = None
+
+            return mask_tuple, mask_struct
+
+
+        return self._cached(self.masks, mask_file, _loadMask)
+
+
+
+    def getKHT(self, kht_lib_path):
+        """ Return the KHT library, with the argument types of the wrapper functions declared. The batch_available
+            attribute of the returned library tells if it has the batch wrapper which runs the KHT on many images.
+
+            The library is loaded only once per process. Loading a rebuilt library from the same path would 
+            return the handle which is already loaded, so the process has to be restarted to use it.
+
+        Arguments:
+            kht_lib_path: [str] Path to the compiled KHT library.
+
+        """
+
+        def _loadKHT(file_path):
+
+            kht = ctypes.cdll.LoadLibrary(file_path)
+            kht.kht_wrapper.argtypes = [npct.ndpointer(dtype=np.double, ndim=2),
+                                        npct.ndpointer(dtype=np.byte, ndim=1),
+                                        ctypes.c_size_t,
+                                        ctypes.c_size_t,
+                                        ctypes.c_size_t,
+                                        ctypes.c_size_t,
+                                        ctypes.c_double,
+                                        ctypes.c_double,
+                                        ctypes.c_double,
+                                        ctypes.c_double]
+            kht.kht_wrapper.restype = ctypes.c_size_t
+
+            # Libraries compiled before the batch function was added only have the single image wrapper
+            try:
+                kht_batch = kht.kht_batch_wrapper
+
+            except AttributeError:
+                kht.batch_available = False
+                return kht
+
+            kht_batch.argtypes = [npct.ndpointer(dtype=np.double, ndim=2, flags='C_CONTIGUOUS'),
+                                  npct.ndpointer(dtype=np.byte, ndim=2, flags='C_CONTIGUOUS'),
+                                  ctypes.c_size_t,
+                                  ctypes.c_size_t,
+                                  ctypes.c_size_t,
+                                  ctypes.c_size_t,
+                                  ctypes.c_size_t,
+                                  ctypes.c_double,
+                                  ctypes.c_double,
+                                  ctypes.c_double,
+                                  ctypes.c_double,
+                                  ctypes.c_size_t]
+            kht_batch.restype = ctypes.c_size_t
+            kht.batch_available = True
+
+            return kht
+
+
+        if kht_lib_path not in self.kht_libs:
+
+            log.debug('Loading: {:s}'.format(kht_lib_path))
+
+            self.kht_libs[kht_lib_path] = _loadKHT(kht_lib_path)
+
+
+        return self.kht_libs[kht_lib_path]
+
+
+
+# Context of the current process, the worker processes inherit the objects already loaded by the parent
+_context = DetectionContext()
+
+
+
+def getDetectionContext():
+    """ Return the detection context of the current process. """
+
+    return _context
@@ -24,7 +24,6 @@ import argparse
 
 import matplotlib.pyplot as plt
 import numpy as np
-import scipy.optimize as opt
 import scipy.ndimage as ndimage
 import scipy.ndimage.filters as filters
 
@@ -35,6 +34,182 @@ from RMS.Formats import CALSTARS
 from RMS.Routines import MaskImage
 from RMS.Routines import Image
 from RMS.QueuedPool import QueuedPool
+from RMS.DetectionContext import getDetectionContext
+
+
+
+class StarTracker(object):
+    """ Keeps the stars confirmed on the last processed FF file, so the star extraction on the next FF file of 
+        the night can re-fit the PSFs around the known stars, shifted by the sidereal drift, instead of 
+        searching the whole image.
+
+        The drift is measured from the stars matched between consecutive FF files. Over a few FF files the 
+        rotation of the sky around the pole makes an affine velocity field on the image, which is fitted to 
+        the star velocities.
+    """
+
+    def __init__(self):
+
+        self.reset()
+
+
+
+    def reset(self):
+        """ Forget all stars, the next FF file will be searched fully. """
+
+        self.ff_dir = None
+        self.ff_time = None
+
+        self.x = np.array([])
+        self.y = np.array([])
+
+        # Affine model of the star velocities in px/s, v = A.(x, y) + b
+        self.velocity_model = None
+
+        # Number of FF files tracked since the last full search
+        self.tracked_files = 0
+
+
+
+    def _timeStep(self, ff_dir, ff_time, config):
+        """ Return the time in seconds since the last FF file, or None if the stars of the last FF file can't
+            be used.
+        """
+
+        if (self.ff_dir != ff_dir) or (self.ff_time is None) or (len(self.x) == 0):
+            return None
+
+        dt = (ff_time - self.ff_time).total_seconds()
+
+        if abs(dt) > config.star_tracking_max_gap:
+            return None
+
+        return dt
+
+
+
+    def _drift(self, x, y, dt):
+        """ Predict positions of stars at (x, y) after dt seconds. """
+
+        if self.velocity_model is None:
+            return x, y
+
+        A, b = self.velocity_model
+
+        vx = A[0, 0]*x + A[0, 1]*y + b[0]
+        vy = A[1, 0]*x + A[1, 1]*y + b[1]
+
+        return x + vx*dt, y + vy*dt
+
+
+
+    def predict(self, ff_dir, ff_time, ff, border, config):
+        """ Predict the positions of the known stars on the given FF file.
+
+        Arguments:
+            ff_dir: [str] Directory of the FF file.
+            ff_time: [datetime] Time of the FF file.
+            ff: [ff bin struct] FF file.
+            border: [int] Stars closer to the image border than this are not tracked.
+            config: [config object] Configuration object.
+
+        Return:
+            (x, y): [tuple of ndarrays] Predicted star positions, or None if a full search should be done.
+        """
+
+        # Run a full search every N files
+        if self.tracked_files >= config.star_tracking_full_search_every - 1:
+            return None
+
+        dt = self._timeStep(ff_dir, ff_time, config)
+
+        if dt is None:
+            return None
+
+        x, y = self._drift(self.x, self.y, dt)
+
+        # Skip the stars which drifted too close to the image border
+        inside = (x >= border) & (x < ff.ncols - border) & (y >= border) & (y < ff.nrows - border)
+
+        if not np.any(inside):
+            return None
+
+        return x[inside], y[inside]
+
+
+
+    def update(self, ff_dir, ff_time, x, y, full_search, config):
+        """ Store the stars confirmed on the given FF file and update the drift model from the stars matched 
+            to the previous FF file.
+
+        Arguments:
+            ff_dir: [str] Directory of the FF file.
+            ff_time: [datetime] Time of the FF file.
+            x: [list] X coordinates of the confirmed stars.
+            y: [list] Y coordinates of the confirmed stars.
+            full_search: [bool] True if the stars were found by searching the whole image.
+            config: [config object] Configuration object.
+        """
+
+        x = np.array(x, dtype=np.float64).ravel()
+        y = np.array(y, dtype=np.float64).ravel()
+
+        dt = self._timeStep(ff_dir, ff_time, config)
+
+        if (dt is not None) and (dt != 0) and len(x):
+
+            # Match every new star to the closest predicted position of a previous star
+            x_pred, y_pred = self._drift(self.x, self.y, dt)
+
+            dist = np.hypot(x[:, np.newaxis] - x_pred, y[:, np.newaxis] - y_pred)
+            closest = np.argmin(dist, axis=1)
+            matched = dist[np.arange(len(x)), closest] < config.segment_radius
+
+            vx = (x[matched] - self.x[closest[matched]])/dt
+            vy = (y[matched] - self.y[closest[matched]])/dt
+
+            # Fit an affine velocity field if there are enough stars, otherwise take a constant velocity
+            if np.count_nonzero(matched) >= 6:
+
+                design = np.column_stack([self.x[closest[matched]], self.y[closest[matched]], 
+                    np.ones(len(vx))])
+
+                coeffs_x = np.linalg.lstsq(design, vx, rcond=None)[0]
+                coeffs_y = np.linalg.lstsq(design, vy, rcond=None)[0]
+
+                A = np.array([coeffs_x[:2], coeffs_y[:2]])
+                b = np.array([coeffs_x[2], coeffs_y[2]])
+
+                self.velocity_model = (A, b)
+
+            elif np.any(matched):
+
+                self.velocity_model = (np.zeros((2, 2)), np.array([np.median(vx), np.median(vy)]))
+
+
+        self.ff_dir = ff_dir
+        self.ff_time = ff_time
+        self.x = x
+        self.y = y
+
+        if full_search:
+            self.tracked_files = 0
+        else:
+            self.tracked_files += 1
+
+
+
+
+# Star tracker of the current process, the FF files of one worker are consecutive
+_star_tracker = StarTracker()
+
+
+
+def getStarTracker():
+    """ Return the star tracker of the current process. """
+
+    return _star_tracker
+
 
 
 
@@ -78,16 +253,16 @@ def extractStars(ff_dir, ff_name, config=None, max_global_intensity=150, border=
     # Load the FF bin file
     ff = FFfile.read(ff_dir, ff_name)
 
-    # Load the mask file
-    mask = MaskImage.loadMask(config.mask_file)
-
-    # Mask the FF file
-    ff = MaskImage.applyMask(ff, mask, ff_flag=True)
-
     # If the FF file could not be read, skip star extraction
     if ff is None:
         return error_return
 
+    # Get the mask, it is loaded only once per process
+    mask, mask_struct = getDetectionContext().getMask(config.mask_file)
+
+    # Mask the FF file
+    ff = MaskImage.applyMask(ff, mask, ff_flag=True, mask_struct=mask_struct)
+
 
     # Apply the flat
     if flat_struct is not None:
@@ -101,6 +276,30 @@ def extractStars(ff_dir, ff_name, config=None, max_global_intensity=150, border=
     if global_mean > max_global_intensity:
         return error_return
 
+    # Re-fit the stars known from the previous FF file if star tracking is enabled
+    if config.star_tracking:
+
+        tracker = getStarTracker()
+        ff_time = FFfile.filenameToDatetime(ff_name)
+
+        predicted = tracker.predict(ff_dir, ff_time, ff, border, config)
+
+        if predicted is not None:
+
+            x_pred, y_pred = predicted
+
+            # Fit a PSF around each known star
+            x2, y2, amplitude, intensity = fitPSF(ff, global_mean, x_pred, y_pred, config)
+
+            # Take the tracked stars only if enough of the known stars were confirmed, otherwise search the 
+            # whole image
+            if len(x2) >= config.star_tracking_min_match_ratio*len(x_pred):
+
+                tracker.update(ff_dir, ff_time, x2, y2, False, config)
+
+                return x2, y2, amplitude, intensity
+
+
     data = ff.avepixel.astype(np.float32)
 
 
@@ -147,6 +346,10 @@ def extractStars(ff_dir, ff_name, config=None, max_global_intensity=150, border=
     x2, y2, amplitude, intensity = fitPSF(ff, global_mean, x, y, config)
     # x2, y2, amplitude, intensity = list(x), list(y), [], [] # Skip PSF fit
 
+    # Keep the found stars for tracking them on the next FF file
+    if config.star_tracking:
+        getStarTracker().update(ff_dir, ff_time, x2, y2, True, config)
+
     # # Plot stars after PSF fit filtering
     # plotStars(ff, x2, y2)
 
@@ -186,6 +389,182 @@ def twoDGaussian(mesh, amplitude, xo, yo, sigma_x, sigma_y, theta, offset):
 
 
 
+def twoDGaussianJacobian(mesh, params):
+    """ Evaluate 2D Gaussians and their derivatives for a batch of parameter sets (see twoDGaussian for the 
+        definition of the parameters).
+
+    Arguments:
+        mesh: [tuple of ndarrays] (x, y) independant variables, flattened
+        params: [ndarray] (N, 7) array of (amplitude, xo, yo, sigma_x, sigma_y, theta, offset) parameters
+
+    Return:
+        (g, jac): 
+            - g: [ndarray] (N, M) values of the Gaussians at the M (x, y) coordinates
+            - jac: [ndarray] (N, M, 7) derivatives of the values by every parameter
+
+    """
+
+    x, y = mesh
+
+    amplitude, xo, yo, sigma_x, sigma_y, theta, offset = [p[:, np.newaxis] for p in params.T]
+
+    cos2 = np.cos(theta)**2
+    sin2 = np.sin(theta)**2
+    sin_2t = np.sin(2*theta)
+    cos_2t = np.cos(2*theta)
+
+    sx2 = sigma_x**2
+    sy2 = sigma_y**2
+    sx3 = sigma_x*sx2
+    sy3 = sigma_y*sy2
+
+    a = cos2/(2*sx2) + sin2/(2*sy2)
+    b = -sin_2t/(4*sx2) + sin_2t/(4*sy2)
+    c = sin2/(2*sx2) + cos2/(2*sy2)
+
+    dx = x - xo
+    dy = y - yo
+    dx2 = dx**2
+    dxdy = dx*dy
+    dy2 = dy**2
+
+    e = np.exp(-(a*dx2 + 2*b*dxdy + c*dy2))
+    ae = amplitude*e
+
+    g = offset + ae
+
+    jac = np.empty(g.shape + (7,))
+    jac[:, :, 0] = e
+    jac[:, :, 1] = ae*(2*a*dx + 2*b*dy)
+    jac[:, :, 2] = ae*(2*b*dx + 2*c*dy)
+    jac[:, :, 3] = ae*(cos2*dx2/sx3 - sin_2t*dxdy/sx3 + sin2*dy2/sx3)
+    jac[:, :, 4] = ae*(sin2*dx2/sy3 + sin_2t*dxdy/sy3 + cos2*dy2/sy3)
+    jac[:, :, 5] = -ae*((sin_2t/(2*sy2) - sin_2t/(2*sx2))*dx2 + (cos_2t/sy2 - cos_2t/sx2)*dxdy \
+        + (sin_2t/(2*sx2) - sin_2t/(2*sy2))*dy2)
+    jac[:, :, 6] = 1
+
+    return g, jac
+
+
+
+def fitTwoDGaussians(segments, valid, initial_guess, maxfev=200, ftol=1.49012e-8, xtol=1.49012e-8):
+    """ Fit 2D Gaussians to a stack of image segments at once, with the Levenberg-Marquardt method. 
+    
+    All segments are iterated together in NumPy, a segment drops out of the iteration as soon as its fit has 
+    converged or has failed. The Jacobian is computed analytically, but the function evaluations are counted 
+    as in scipy.optimize.curve_fit with a numerical Jacobian (7 evaluations per Jacobian), so that maxfev 
+    rejects the same kind of slowly converging candidates.
+
+    Arguments:
+        segments: [ndarray] (N, H, W) stack of image segments, the first axis of the segment is the X axis of 
+            the Gaussian
+        valid: [ndarray] (N, H, W) boolean array of pixels to fit, segments smaller than (H, W) are padded at 
+            the end of both axes
+        initial_guess: [ndarray] (7, ) or (N, 7) initial (amplitude, xo, yo, sigma_x, sigma_y, theta, offset)
+
+    Keyword arguments:
+        maxfev: [int] maximum number of function evaluations per segment
+        ftol: [float] relative reduction of the sum of squares at which the fit is converged
+        xtol: [float] relative change of the parameters at which the fit is converged
+
+    Return:
+        (params, converged):
+            - params: [ndarray] (N, 7) fitted parameters
+            - converged: [ndarray] (N, ) boolean array, False for segments which were not fitted
+    """
+
+    n_segments = segments.shape[0]
+    n_params = 7
+
+    # Flatten the segments, the masked pixels do not contribute to the residuals
+    data = segments.reshape(n_segments, -1).astype(np.float64)
+    weights = valid.reshape(n_segments, -1).astype(np.float64)
+
+    x_ind, y_ind = np.indices(segments.shape[1:])
+    mesh = (x_ind.ravel()[np.newaxis], y_ind.ravel()[np.newaxis])
+
+    params = np.empty((n_segments, n_params))
+    params[:] = initial_guess
+
+    converged = np.zeros(n_segments, dtype=bool)
+
+    if n_segments == 0:
+        return params, converged
+
+
+    def _residuals(p, idx):
+        g, jac = twoDGaussianJacobian(mesh, p)
+        return (g - data[idx])*weights[idx], jac*weights[idx][:, :, np.newaxis]
+
+
+    with np.errstate(all='ignore'):
+
+        # Initial residuals and Jacobian (1 evaluation + 7 for the Jacobian)
+        active = np.arange(n_segments)
+        res, jac = _residuals(params, active)
+        cost = np.sum(res**2, axis=1)
+        damping = np.full(n_segments, 1e-2)
+        nfev = np.full(n_segments, 1 + n_params)
+
+        while len(active):
+
+            # Normal equations of the active segments
+            jtj = np.einsum('bmi,bmj->bij', jac, jac)
+            jtr = np.einsum('bmi,bm->bi', jac, res)
+
+            diag = np.maximum(np.diagonal(jtj, axis1=1, axis2=2), 1e-12)
+            lhs = jtj + damping[active, np.newaxis, np.newaxis]*(diag[:, :, np.newaxis]*np.eye(n_params))
+
+            # Steps of segments with singular normal equations are not taken
+            step = np.zeros_like(jtr)
+            solvable = np.all(np.isfinite(lhs), axis=(1, 2)) & np.all(np.isfinite(jtr), axis=1)
+            solvable[solvable] = np.abs(np.linalg.det(lhs[solvable])) > 0
+            step[solvable] = -np.linalg.solve(lhs[solvable], jtr[solvable][:, :, np.newaxis])[:, :, 0]
+
+            new_params = params[active] + step
+            new_res, new_jac = _residuals(new_params, active)
+            new_cost = np.sum(new_res**2, axis=1)
+            nfev[active] += 1
+
+            # Accept the steps which reduce the sum of squares
+            accepted = solvable & np.isfinite(new_cost) & (new_cost <= cost[active])
+
+            reduction = (cost[active] - new_cost)/np.maximum(cost[active], 1e-300)
+            step_norm = np.linalg.norm(step, axis=1)
+            params_norm = np.linalg.norm(new_params, axis=1)
+            # As in MINPACK, the fit has also converged if the step has become negligible, even if it was not 
+            # accepted
+            done = (accepted & (reduction <= ftol)) | (solvable & (step_norm <= xtol*(params_norm + xtol)))
+
+            acc_idx = active[accepted]
+            params[acc_idx] = new_params[accepted]
+            cost[acc_idx] = new_cost[accepted]
+            res[accepted] = new_res[accepted]
+            jac[accepted] = new_jac[accepted]
+            damping[acc_idx] /= 10
+            damping[active[~accepted]] *= 10
+
+            # A new Jacobian is computed after every accepted step
+            nfev[acc_idx] += n_params
+
+            converged[active[done]] = True
+
+            # Segments which converged, ran out of function evaluations or cannot be improved any more drop out
+            failed = (nfev[active] >= maxfev) | (damping[active] > 1e16)
+            keep = ~done & ~failed
+
+            active = active[keep]
+            res = res[keep]
+            jac = jac[keep]
+
+
+    # The Gaussian only depends on the squares of sigmas, make them positive
+    params[:, 3:5] = np.abs(params[:, 3:5])
+
+    return params, converged
+
+
+
 def fitPSF(ff, avepixel_mean, x2, y2, config):
     """ Fit a 2D Gaussian to the star candidate cutout to check if it's a star.
     
@@ -216,9 +595,17 @@ def fitPSF(ff, avepixel_mean, x2, y2, config):
 
     # Set the initial guess
     initial_guess = (30.0, segment_radius, segment_radius, 1.0, 1.0, 0.0, avepixel_mean)
+
+    seg_size = int(2*segment_radius)
+
+    stars = list(zip(list(y2), list(x2)))
+
+    # Stack the image segments around all stars, segments which are cut by the image edge are padded
+    segments = np.zeros((len(stars), seg_size, seg_size), dtype=np.float64)
+    valid = np.zeros((len(stars), seg_size, seg_size), dtype=bool)
+    segment_bounds = []
     
-    # Go through all stars
-    for star in zip(list(y2), list(x2)):
+    for i, star in enumerate(stars):
 
         y, x = star
 
@@ -245,24 +632,27 @@ def fitPSF(ff, avepixel_mean, x2, y2, config):
         # Extract an image segment around each star
         star_seg = ff.avepixel[y_min:y_max, x_min:x_max]
 
-        # Create x and y indices
-        y_ind, x_ind = np.indices(star_seg.shape)
+        segments[i, :star_seg.shape[0], :star_seg.shape[1]] = star_seg
+        valid[i, :star_seg.shape[0], :star_seg.shape[1]] = True
+
+        segment_bounds.append((y_min, y_max, x_min, x_max))
+
+
+    # Fit a PSF to all stars at once, with the limited number of function evaluations - this reduces the 
+    # processing time and most of the bad star candidates take more iterations to fit
+    popt_all, fitted = fitTwoDGaussians(segments, valid, initial_guess, maxfev=200)
 
-        # Fit a PSF to the star
-        try:
-            # Fit the 2D Gaussian with the limited number of iterations - this reduces the processing time
-            # and most of the bad star candidates take more iterations to fit
-            popt, pcov = opt.curve_fit(twoDGaussian, (y_ind, x_ind), star_seg.ravel(), p0=initial_guess, 
-                maxfev=200)
-            # print(popt)
-        except RuntimeError:
-            # print('Fitting failed!')
 
-            # Skip stars that can't be fitted in 200 iterations
+    for i, (y_min, y_max, x_min, x_max) in enumerate(segment_bounds):
+
+        # Skip stars that can't be fitted in 200 iterations
+        if not fitted[i]:
             continue
 
+        star_seg = ff.avepixel[y_min:y_max, x_min:x_max]
+
         # Unpack fitted gaussian parameters
-        amplitude, yo, xo, sigma_y, sigma_x, theta, offset = popt
+        amplitude, yo, xo, sigma_y, sigma_x, theta, offset = popt_all[i]
 
         # Filter hot pixels by looking at the ratio between x and y sigmas (HPs are very narrow)
         if min(sigma_y/sigma_x, sigma_x/sigma_y) < roundness_threshold:
@@ -306,7 +696,7 @@ def fitPSF(ff, avepixel_mean, x2, y2, config):
             continue
 
         # Gamma correct the star segment
-        star_seg_crop = Image.gammaCorrection(star_seg_crop.astype(np.float32), config.gamma)
+        star_seg_crop = Image.gammaCorrection(star_seg_crop, config.gamma)
 
         # Correct the background for gamma
         bg_corrected = Image.gammaCorrection(offset, config.gamma)
@@ -454,13 +844,13 @@ if __name__ == "__main__":
     star_list = []
 
     # Run the QueuedPool for detection
-    workpool = QueuedPool(extractStars, cores=-1, backup_dir=ff_dir)
+    workpool = QueuedPool(extractStars, cores=-1, backup_dir=ff_dir, func_extra_args=[config], \
+        func_kwargs={'flat_struct': flat_struct})
 
 
     # Add jobs for the pool
-    for ff_name in extraction_list:
-        print('Adding for extraction:', ff_name)
-        workpool.addJob([ff_dir, ff_name, config, flat_struct])
+    print('Adding {:d} files for extraction...'.format(len(extraction_list)))
+    workpool.addJobs([[ff_dir, ff_name] for ff_name in extraction_list])
 
 
     print('Starting pool...')
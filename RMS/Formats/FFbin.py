@@ -26,8 +26,19 @@ from RMS.Formats.FFStruct import FFStruct
 # FFbin handling stolen from FF_bin_suite.py from CMN_binViewer written by Denis Vida
 
 
+# Headers of the FF bin formats. The old CAMS format starts with the number of rows, the new one with -1.
+#   Old: nrows, ncols, nbits, first, camno
+#   New: -1, nrows, ncols, nframes, first, camno, decimation_fact, interleave_flag, 1000*fps
+FF_BIN_HEADER_OLD = struct.Struct('iIIII')
+FF_BIN_HEADER_NEW = struct.Struct('iIIIIIIII')
+
+
+
 def read(directory, filename, array=False, full_filename=False):
     """ Read FF*.bin file from the specified directory.
+
+    The header is parsed in one go and the image planes are memory mapped from the file (copy-on-write), so
+    only the planes which are accessed are read from the disk. Modifying the planes does not change the file.
     
     Arguments:
         directory: [str] Path to directory containing file
@@ -44,58 +55,62 @@ def read(directory, filename, array=False, full_filename=False):
     """
     
     if (filename.startswith("FF") and ('.bin' in filename)) or full_filename:
-        fid = open(os.path.join(directory, filename), "rb")
+        file_path = os.path.join(directory, filename)
     else:
-        fid = open(os.path.join(directory, "FF" + filename + ".bin"), "rb")
+        file_path = os.path.join(directory, "FF" + filename + ".bin")
 
     ff = FFStruct()
+
+    with open(file_path, "rb") as fid:
+        header = fid.read(FF_BIN_HEADER_NEW.size)
     
     # Check if it is the new of the old CAMS data format
-    version_flag = int(np.fromfile(fid, dtype=np.int32, count = 1))
+    version_flag = struct.unpack_from('i', header)[0]
 
     # Old format
     if version_flag > 0:
 
-        ff.nrows = version_flag
-        ff.ncols = int(np.fromfile(fid, dtype=np.uint32, count = 1))
-        ff.nbits = int(np.fromfile(fid, dtype=np.uint32, count = 1))
+        ff.nrows, ff.ncols, ff.nbits, ff.first, ff.camno = FF_BIN_HEADER_OLD.unpack_from(header)
         ff.nframes = 2**ff.nbits
-        ff.first = int(np.fromfile(fid, dtype=np.uint32, count = 1))
-        ff.camno = int(np.fromfile(fid, dtype=np.uint32, count = 1))
 
         ff.decimation_fact = 1
 
-        
+        header_size = FF_BIN_HEADER_OLD.size
 
     # New format
     elif version_flag == -1:
 
-        ff.nrows = int(np.fromfile(fid, dtype=np.uint32, count = 1))
-        ff.ncols = int(np.fromfile(fid, dtype=np.uint32, count = 1))
+        (_, ff.nrows, ff.ncols, ff.nframes, ff.first, ff.camno, ff.decimation_fact, ff.interleave_flag, 
+            fps) = FF_BIN_HEADER_NEW.unpack_from(header)
+
+        ff.fps = float(fps)/1000
 
-        ff.nframes = int(np.fromfile(fid, dtype=np.uint32, count = 1))
-        ff.first = int(np.fromfile(fid, dtype=np.uint32, count = 1))
-        ff.camno = int(np.fromfile(fid, dtype=np.uint32, count = 1))
+        header_size = FF_BIN_HEADER_NEW.size
+
+    else:
+        header_size = 4
 
-        ff.decimation_fact = int(np.fromfile(fid, dtype=np.uint32, count = 1))
 
-        ff.interleave_flag = int(np.fromfile(fid, dtype=np.uint32, count = 1))
+    shape = (4, ff.nrows, ff.ncols)
 
-        ff.fps = float(np.fromfile(fid, dtype=np.uint32, count = 1))/1000
+    if ff.nrows*ff.ncols > 0:
+
+        # Map the image planes, the pages of the file are read when they are first accessed
+        planes = np.memmap(file_path, dtype=np.uint8, mode='c', offset=header_size, shape=shape)
+        planes = planes.view(np.ndarray)
+
+    else:
+        planes = np.zeros(shape, dtype=np.uint8)
 
     
     if array:
-        N = 4*ff.nrows*ff.ncols
-    
-        ff.array = np.reshape(np.fromfile(fid, dtype=np.uint8, count=N), (4, ff.nrows, ff.ncols))
+        ff.array = planes
         
     else:
-        N = ff.nrows*ff.ncols
-    
-        ff.maxpixel = np.reshape(np.fromfile(fid, dtype=np.uint8, count=N), (ff.nrows, ff.ncols))
-        ff.maxframe = np.reshape(np.fromfile(fid, dtype=np.uint8, count=N), (ff.nrows, ff.ncols))
-        ff.avepixel = np.reshape(np.fromfile(fid, dtype=np.uint8, count=N), (ff.nrows, ff.ncols))
-        ff.stdpixel = np.reshape(np.fromfile(fid, dtype=np.uint8, count=N), (ff.nrows, ff.ncols))
+        ff.maxpixel = planes[0]
+        ff.maxframe = planes[1]
+        ff.avepixel = planes[2]
+        ff.stdpixel = planes[3]
 
     return ff
 
@@ -12,12 +12,14 @@ from RMS.Formats.FFbin import read as readFFbin
 from RMS.Formats.FFbin import write as writeFFbin
 from RMS.Formats.FFfits import read as readFFfits
 from RMS.Formats.FFfits import write as writeFFfits
+from RMS.Formats import FFnight
 from RMS.Decorators import memoizeSingle
 
 
 @memoizeSingle
 def read(directory, filename, fmt=None, array=False, full_filename=False):
-    """ Read FF file from the specified directory and choose the proper format for reading.
+    """ Read FF file from the specified directory and choose the proper format for reading. If the file is
+        not stored as an individual file, it is read from the night container of the directory.
     
     Arguments:
         directory: [str] Path to directory containing file
@@ -36,6 +38,20 @@ def read(directory, filename, fmt=None, array=False, full_filename=False):
     """
 
 
+    # Read the file from the night container of the directory if it is not stored as an individual file
+    if not os.path.isfile(os.path.join(directory, filename)):
+
+        ff = FFnight.read(directory, filename, array=array)
+
+        if ff is not None:
+            return ff
+
+
+    # Compressed FITS files are read as any other FITS file
+    if fmt is not None:
+        fmt = formatExtension(fmt)
+
+
     # If the reading format was not given, try to guess the proper format
     if fmt is None:
 
@@ -104,8 +120,9 @@ def write(ff, directory, filename, fmt=None):
         filename: [str] Name of the file which will be written.
 
     Keyword arguments:
-        fmt: [str] Format for writing the file. It should either be 'bin' or 'fits'. If it is not given,
-            the format will be guessed. By default, the format will be 'fits'.
+        fmt: [str] Format for writing the file. It should either be 'bin', 'fits' or 'fits_gzip' (FITS with
+            losslessly compressed images). If it is not given, the format will be guessed. By default, the
+            format will be 'fits'.
     
     Return:
         None
@@ -138,6 +155,22 @@ def write(ff, directory, filename, fmt=None):
     elif fmt == 'fits':
         writeFFfits(ff, directory, filename)
 
+    # RMS fits format with losslessly compressed images
+    elif fmt == 'fits_gzip':
+        writeFFfits(ff, directory, filename, compress=True)
+
+
+def formatExtension(fmt):
+    """ Return the extension of the FF files written in the given format, i.e. 'bin' for the CAMS formats 
+        and 'fits' for the FITS formats.
+    """
+
+    if fmt in ['bin', 'bin1']:
+        return 'bin'
+
+    return 'fits'
+
+
 
 def reconstructFrame(ff, frame_no, avepixel=False):
     """ Reconstruct just a given frame from an FF file.
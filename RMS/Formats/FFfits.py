@@ -3,6 +3,8 @@
 from __future__ import print_function, division, absolute_import
 
 import os
+import zlib
+import struct
 
 import numpy as np
 from astropy.io import fits
@@ -11,8 +13,248 @@ from RMS.Formats.FFStruct import FFStruct
 
 
 
+# FITS files are made of 2880 byte blocks, headers are made of 80 character cards
+FITS_BLOCK_SIZE = 2880
+FITS_CARD_SIZE = 80
+
+# Names of the image HDUs of an FF file, in the order in which they are stored
+FF_IMAGE_NAMES = ['MAXPIXEL', 'MAXFRAME', 'AVEPIXEL', 'STDPIXEL']
+
+# Keywords of the FF parameters in the primary header
+FF_HEADER_KEYS = ['NROWS', 'NCOLS', 'NBITS', 'NFRAMES', 'FIRST', 'CAMNO', 'FPS']
+
+# Preassembled image HDU headers, per image size
+_image_headers = {}
+
+# zlib compression level of the tile compressed FF files, the fastest level is used to keep the write time 
+#   low, higher levels reduce the size of the files only by a few percent
+FF_GZIP_LEVEL = 1
+
+
+
+def _parseCardValue(value_str):
+    """ Parse the value of a FITS header card, i.e. everything after '= '. """
+
+    value_str = value_str.strip()
+
+    # Strings are quoted, quotes inside strings are doubled
+    if value_str.startswith("'"):
+
+        end = 1
+        while True:
+
+            end = value_str.find("'", end)
+
+            if end < 0:
+                return value_str[1:].rstrip()
+
+            if value_str[end + 1:end + 2] == "'":
+                end += 2
+                continue
+
+            return value_str[1:end].replace("''", "'").rstrip()
+
+
+    # Strip the comment
+    value_str = value_str.split('/')[0].strip()
+
+    if value_str == 'T':
+        return True
+
+    if value_str == 'F':
+        return False
+
+    try:
+        return int(value_str)
+
+    except ValueError:
+        pass
+
+    try:
+        return float(value_str.replace('D', 'E'))
+
+    except ValueError:
+        return value_str
+
+
+
+def _parseHeader(buff, offset):
+    """ Parse the FITS header which starts at the given byte offset.
+
+    Arguments:
+        buff: [ndarray] Contents of the FITS file as uint8.
+        offset: [int] Byte offset of the header.
+
+    Return:
+        (header, data_offset): [tuple] Dictionary of header keywords and values, and the byte offset of the 
+            data. (None, None) is returned if the header is not complete.
+    """
+
+    header = {}
+
+    while offset + FITS_BLOCK_SIZE <= len(buff):
+
+        block = buff[offset:offset + FITS_BLOCK_SIZE].tobytes().decode('ascii', 'replace')
+        offset += FITS_BLOCK_SIZE
+
+        for i in range(0, FITS_BLOCK_SIZE, FITS_CARD_SIZE):
+
+            card = block[i:i + FITS_CARD_SIZE]
+            key = card[:8].strip()
+
+            if key == 'END':
+                return header, offset
+
+            if card[8:10] == '= ':
+                header[key] = _parseCardValue(card[10:])
+
+
+    return None, None
+
+
+
+def _mapImage(buff, img_header, data_offset):
+    """ Map the image of an image HDU from the file.
+
+    Return:
+        (image, data_size): [tuple] The image and the size of the HDU data in bytes, or None if the image 
+            is not an 8 bit 2D image without scaling.
+    """
+
+    if (img_header.get('XTENSION') != 'IMAGE') or (img_header.get('BITPIX') != 8) \
+        or (img_header.get('NAXIS') != 2) or (img_header.get('PCOUNT', 0) != 0) \
+        or (img_header.get('GCOUNT', 1) != 1) or ('BZERO' in img_header) or ('BSCALE' in img_header):
+
+        return None
+
+    nrows = img_header.get('NAXIS2')
+    ncols = img_header.get('NAXIS1')
+    size = nrows*ncols
+
+    if data_offset + size > len(buff):
+        return None
+
+    return buff[data_offset:data_offset + size].reshape(nrows, ncols), size
+
+
+
+def _decompressImage(buff, img_header, data_offset):
+    """ Decompress the image of a tile compressed HDU, as written with compress=True.
+
+    Return:
+        (image, data_size): [tuple] The image and the size of the HDU data in bytes, or None if the image is
+            not an 8 bit 2D image compressed with GZIP_1 into a single tile.
+    """
+
+    nrows = img_header.get('ZNAXIS2')
+    ncols = img_header.get('ZNAXIS1')
+
+    if (img_header.get('XTENSION') != 'BINTABLE') or (img_header.get('ZCMPTYPE') != 'GZIP_1') \
+        or (img_header.get('ZBITPIX') != 8) or (img_header.get('ZNAXIS') != 2) \
+        or (img_header.get('ZTILE1', ncols) != ncols) or (img_header.get('ZTILE2', 1) != nrows) \
+        or (img_header.get('TFIELDS') != 1) or (img_header.get('TTYPE1') != 'COMPRESSED_DATA') \
+        or (img_header.get('NAXIS2') != 1) or ('ZSCALE' in img_header) or ('ZZERO' in img_header):
+
+        return None
+
+    # The table has one row, with the size and the heap offset of the compressed tile
+    table_size = img_header.get('NAXIS1')*img_header.get('NAXIS2')
+    data_size = table_size + img_header.get('PCOUNT', 0)
+
+    if data_offset + data_size > len(buff):
+        return None
+
+    tile_size, tile_offset = struct.unpack('>ii', buff[data_offset:data_offset + 8].tobytes())
+
+    heap_offset = data_offset + img_header.get('THEAP', table_size) + tile_offset
+
+    image = np.frombuffer(zlib.decompress(buff[heap_offset:heap_offset + tile_size].tobytes(), 
+        zlib.MAX_WBITS | 16), dtype=np.uint8)
+
+    if image.size != nrows*ncols:
+        return None
+
+    return image.reshape(nrows, ncols).copy(), data_size
+
+
+
+def _readFast(file_path):
+    """ Read an FF FITS file with the layout written by RMS, without going through astropy. The image planes 
+        are memory mapped from the file (copy-on-write), or decompressed if the file is tile compressed.
+
+    Return:
+        (header, planes): [tuple] Dictionary of the primary header and the list of maxpixel, maxframe,
+            avepixel and stdpixel, or None if the file does not have the expected layout.
+    """
+
+    if os.path.getsize(file_path) < FITS_BLOCK_SIZE:
+        return None
+
+    buff = np.memmap(file_path, dtype=np.uint8, mode='c').view(np.ndarray)
+
+    # Read the FF parameters from the primary header
+    header, offset = _parseHeader(buff, 0)
+
+    if (header is None) or (header.get('NAXIS') != 0) or any(key not in header for key in FF_HEADER_KEYS):
+        return None
+
+
+    planes = []
+
+    for name in FF_IMAGE_NAMES:
+
+        img_header, data_offset = _parseHeader(buff, offset)
+
+        if (img_header is None) or (img_header.get('EXTNAME') != name):
+            return None
+
+        if img_header.get('ZIMAGE') is True:
+            image_data = _decompressImage(buff, img_header, data_offset)
+
+        else:
+            image_data = _mapImage(buff, img_header, data_offset)
+
+        if image_data is None:
+            return None
+
+        plane, data_size = image_data
+
+        planes.append(plane)
+
+        # The data is padded to full blocks
+        offset = data_offset + FITS_BLOCK_SIZE*int(np.ceil(data_size/FITS_BLOCK_SIZE))
+
+
+    return header, planes
+
+
+
+def _readAstropy(file_path):
+    """ Read an FF FITS file using astropy.
+
+    Return:
+        (header, planes): [tuple] Primary header and the list of maxpixel, maxframe, avepixel and stdpixel.
+    """
+
+    # Read in the FITS
+    hdulist = fits.open(file_path)
+
+    # Read the header
+    header = hdulist[0].header
+
+    # Read in the image data
+    planes = [hdulist[i + 1].data for i in range(len(FF_IMAGE_NAMES))]
+
+    # Close the FITS file
+    hdulist.close()
+
+    return header, planes
+
+
+
 def read(directory, filename, array=False, full_filename=False):
-    """ Read a FF structure from a FITS file. 
+    """ Read a FF structure from a FITS file. Files with the layout written by RMS are parsed directly and
+        their image planes are memory mapped, other files are read using astropy.
     
     Arguments:
         directory: [str] Path to directory containing file
@@ -30,18 +272,20 @@ def read(directory, filename, array=False, full_filename=False):
 
     # Make sure the file starts with "FF_"
     if (filename.startswith('FF') and ('.fits' in filename)) or full_filename:
-        fid = open(os.path.join(directory, filename), "rb")
+        file_path = os.path.join(directory, filename)
     else:
-        fid = open(os.path.join(directory, "FF_" + filename + ".fits"), "rb")
+        file_path = os.path.join(directory, "FF_" + filename + ".fits")
 
     # Init an empty FF structure
     ff = FFStruct()
 
-    # Read in the FITS
-    hdulist = fits.open(fid)
+    # Read the file
+    ff_data = _readFast(file_path)
 
-    # Read the header
-    head = hdulist[0].header
+    if ff_data is None:
+        ff_data = _readAstropy(file_path)
+
+    head, planes = ff_data
 
     # Read in the data from the header
     ff.nrows = head['NROWS']
@@ -53,31 +297,242 @@ def read(directory, filename, array=False, full_filename=False):
     ff.fps = head['FPS']
 
     # Read in the image data
-    ff.maxpixel = hdulist[1].data
-    ff.maxframe = hdulist[2].data
-    ff.avepixel = hdulist[3].data
-    ff.stdpixel = hdulist[4].data
+    ff.maxpixel, ff.maxframe, ff.avepixel, ff.stdpixel = planes
 
     if array:
-        ff.array = np.dstack([ff.maxpixel, ff.maxframe, ff.avepixel, ff.stdpixel])
+        ff.array = np.stack(planes, axis=0)
 
-        ff.array = np.swapaxes(ff.array, 0, 1)
-        ff.array = np.swapaxes(ff.array, 0, 2)
+    return ff
 
-    # CLose the FITS file
-    hdulist.close()
 
-    return ff
 
+def _formatCard(key, value, comment=None):
+    """ Format a FITS header card in the same way as astropy does.
+
+    Arguments:
+        key: [str] Keyword.
+        value: [bool, int, float or str] Value.
+
+    Keyword arguments:
+        comment: [str] Comment, not written if None.
+
+    Return:
+        [str] 80 character card.
+    """
+
+    if isinstance(value, (bool, np.bool_)):
+        value_str = '{:>20s}'.format('T' if value else 'F')
+
+    elif isinstance(value, (int, np.integer)):
+        value_str = '{:>20d}'.format(int(value))
+
+    elif isinstance(value, (float, np.floating)):
+
+        value_str = str(float(value)).replace('e', 'E')
+
+        if ('.' not in value_str) and ('E' not in value_str):
+            value_str += '.0'
+
+        elif 'E' in value_str:
+            significand, exponent = value_str.split('E')
+            value_str = '{:s}E{:s}{:02d}'.format(significand, '-' if exponent.startswith('-') else '', 
+                abs(int(exponent)))
+
+        value_str = '{:>20s}'.format(value_str)
+
+    elif isinstance(value, str):
+        value_str = '{:20s}'.format("'{:8s}'".format(value.replace("'", "''")))
+
+    else:
+        raise TypeError('Unsupported FITS header value: {:s}'.format(repr(value)))
+
+
+    card = '{:8s}= {:s}'.format(key, value_str)
+
+    if comment is not None:
+        card += ' / ' + comment
+
+    if len(card) > FITS_CARD_SIZE:
+        raise ValueError('FITS header card too long: {:s}'.format(card))
+
+    return '{:80s}'.format(card)
+
+
+
+def _headerBlocks(cards):
+    """ Join the header cards, add the END card and pad the header to full blocks. """
+
+    header = ''.join(cards) + '{:80s}'.format('END')
+    header += ' '*(-len(header)%FITS_BLOCK_SIZE)
+
+    return header.encode('ascii')
+
+
+
+def _imageHeaders(nrows, ncols):
+    """ Return the preassembled headers of the image HDUs for the given image size. """
+
+    key = (nrows, ncols)
+
+    if key not in _image_headers:
+
+        _image_headers[key] = [_headerBlocks([
+            _formatCard('XTENSION', 'IMAGE', 'Image extension'),
+            _formatCard('BITPIX', 8, 'array data type'),
+            _formatCard('NAXIS', 2, 'number of array dimensions'),
+            _formatCard('NAXIS1', ncols),
+            _formatCard('NAXIS2', nrows),
+            _formatCard('PCOUNT', 0, 'number of parameters'),
+            _formatCard('GCOUNT', 1, 'number of groups'),
+            _formatCard('EXTNAME', name, 'extension name')]) for name in FF_IMAGE_NAMES]
+
+
+    return _image_headers[key]
+
+
+
+def _compressedImageHDU(plane, name):
+    """ Return the tile compressed image HDU of the given 8 bit image, the whole image is compressed with 
+        GZIP_1 as a single tile.
+    """
+
+    nrows, ncols = plane.shape
+
+    compressor = zlib.compressobj(FF_GZIP_LEVEL, zlib.DEFLATED, zlib.MAX_WBITS | 16)
+    tile = compressor.compress(np.ascontiguousarray(plane).tobytes()) + compressor.flush()
+
+    header = _headerBlocks([
+        _formatCard('XTENSION', 'BINTABLE', 'binary table extension'),
+        _formatCard('BITPIX', 8, 'array data type'),
+        _formatCard('NAXIS', 2, 'number of array dimensions'),
+        _formatCard('NAXIS1', 8, 'width of table in bytes'),
+        _formatCard('NAXIS2', 1, 'number of rows in table'),
+        _formatCard('PCOUNT', len(tile), 'number of group parameters'),
+        _formatCard('GCOUNT', 1, 'number of groups'),
+        _formatCard('TFIELDS', 1, 'number of fields in each row'),
+        _formatCard('TTYPE1', 'COMPRESSED_DATA'),
+        _formatCard('TFORM1', '1PB({:d})'.format(len(tile))),
+        _formatCard('ZIMAGE', True, 'extension contains compressed image'),
+        _formatCard('ZTENSION', 'IMAGE', 'Image extension'),
+        _formatCard('ZBITPIX', 8, 'array data type'),
+        _formatCard('ZNAXIS', 2, 'number of array dimensions'),
+        _formatCard('ZNAXIS1', ncols),
+        _formatCard('ZNAXIS2', nrows),
+        _formatCard('ZPCOUNT', 0, 'number of parameters'),
+        _formatCard('ZGCOUNT', 1, 'number of groups'),
+        _formatCard('ZTILE1', ncols, 'size of tiles to be compressed'),
+        _formatCard('ZTILE2', nrows, 'size of tiles to be compressed'),
+        _formatCard('ZCMPTYPE', 'GZIP_1', 'compression algorithm'),
+        _formatCard('EXTNAME', name, 'name of this binary table extension')])
+
+    # The table row holds the size and the heap offset of the tile, the heap follows the table
+    data = struct.pack('>ii', len(tile), 0) + tile
+
+    return header + data + b'\0'*(-len(data)%FITS_BLOCK_SIZE)
+
+
+
+def _writeFast(ff, file_path, planes, compress=False):
+    """ Write the FF file directly, with the same layout as astropy writes it. Only 8 bit images can be 
+        written this way.
+
+    Keyword arguments:
+        compress: [bool] Compress the images losslessly, see write.
+
+    Return:
+        [bool] True if the file was written, False if it has to be written by astropy.
+    """
+
+    if any((plane.dtype != np.uint8) or (plane.ndim != 2) or (plane.shape != planes[0].shape) 
+        for plane in planes):
+
+        return False
+
+    try:
+        primary_header = _headerBlocks([
+            _formatCard('SIMPLE', True, 'conforms to FITS standard'),
+            _formatCard('BITPIX', 8, 'array data type'),
+            _formatCard('NAXIS', 0, 'number of array dimensions'),
+            _formatCard('EXTEND', True),
+            _formatCard('NROWS', ff.nrows),
+            _formatCard('NCOLS', ff.ncols),
+            _formatCard('NBITS', ff.nbits),
+            _formatCard('NFRAMES', ff.nframes),
+            _formatCard('FIRST', ff.first),
+            _formatCard('CAMNO', ff.camno),
+            _formatCard('FPS', ff.fps)])
+
+    except (TypeError, ValueError):
+        return False
 
 
-def write(ff, directory, filename):
-    """ Write a FF structure to a FITS file in specified directory.
+    nrows, ncols = planes[0].shape
+    padding = b'\0'*(-nrows*ncols%FITS_BLOCK_SIZE)
+
+    with open(file_path, 'wb') as fid:
+
+        fid.write(primary_header)
+
+        if compress:
+            for plane, name in zip(planes, FF_IMAGE_NAMES):
+                fid.write(_compressedImageHDU(plane, name))
+
+        else:
+            for img_header, plane in zip(_imageHeaders(nrows, ncols), planes):
+
+                fid.write(img_header)
+                fid.write(np.ascontiguousarray(plane).tobytes())
+                fid.write(padding)
+
+
+    return True
+
+
+
+def _writeAstropy(ff, file_path, planes, compress=False):
+    """ Write the FF file using astropy. """
+
+    # Create the header
+    head = fits.Header()
+    head['NROWS'] = ff.nrows
+    head['NCOLS'] = ff.ncols
+    head['NBITS'] = ff.nbits
+    head['NFRAMES'] = ff.nframes
+    head['FIRST'] = ff.first
+    head['CAMNO'] = ff.camno
+    head['FPS'] = ff.fps
+
+    # Add the images to the list
+    if compress:
+        image_hdus = [fits.CompImageHDU(plane, name=name, compression_type='GZIP_1') for plane, name \
+            in zip(planes, FF_IMAGE_NAMES)]
+
+    else:
+        image_hdus = [fits.ImageHDU(plane, name=name) for plane, name in zip(planes, FF_IMAGE_NAMES)]
+    
+    # Create the primary part
+    prim = fits.PrimaryHDU(header=head)
+    
+    # Combine everything into into FITS
+    hdulist = fits.HDUList([prim] + image_hdus)
+
+    # Save the FITS
+    hdulist.writeto(file_path, overwrite=True)
+
+
+
+def write(ff, directory, filename, compress=False):
+    """ Write a FF structure to a FITS file in specified directory. 8 bit images are written directly with
+        preassembled headers, other images are written using astropy.
     
     Arguments:
         ff: [ff bin struct] FF bin file loaded in the FF structure
         directory: [str] path to the directory where the file will be written
         filename: [str] name of the file which will be written
+
+    Keyword arguments:
+        compress: [bool] Losslessly compress the images using the FITS tile compression (GZIP_1), which can
+            be read by astropy and other FITS readers. False by default.
     
     Return:
         None
@@ -91,18 +546,6 @@ def write(ff, directory, filename):
     else:
         file_path = os.path.join(directory, "FF_" + filename + ".fits")
 
-    # Create a new FITS file
-    
-    # Create the header
-    head = fits.Header()
-    head['NROWS'] = ff.nrows
-    head['NCOLS'] = ff.ncols
-    head['NBITS'] = ff.nbits
-    head['NFRAMES'] = ff.nframes
-    head['FIRST'] = ff.first
-    head['CAMNO'] = ff.camno
-    head['FPS'] = ff.fps
-
     # Deconstruct the 3D array into individual images
     if ff.array is not None:
         ff.maxpixel, ff.maxframe, ff.avepixel, ff.stdpixel = np.split(ff.array, 4, axis=0)
@@ -111,20 +554,12 @@ def write(ff, directory, filename):
         ff.avepixel = ff.avepixel[0]
         ff.stdpixel = ff.stdpixel[0]
 
-    # Add the maxpixle to the list
-    maxpixel_hdu = fits.ImageHDU(ff.maxpixel, name='MAXPIXEL')
-    maxframe_hdu = fits.ImageHDU(ff.maxframe, name='MAXFRAME')
-    avepixel_hdu = fits.ImageHDU(ff.avepixel, name='AVEPIXEL')
-    stdpixel_hdu = fits.ImageHDU(ff.stdpixel, name='STDPIXEL')
-    
-    # Create the primary part
-    prim = fits.PrimaryHDU(header=head)
-    
-    # Combine everything into into FITS
-    hdulist = fits.HDUList([prim, maxpixel_hdu, maxframe_hdu, avepixel_hdu, stdpixel_hdu])
+    planes = [np.asarray(ff.maxpixel), np.asarray(ff.maxframe), np.asarray(ff.avepixel), 
+        np.asarray(ff.stdpixel)]
 
-    # Save the FITS
-    hdulist.writeto(file_path, overwrite=True)
+    # Write the FITS
+    if not _writeFast(ff, file_path, planes, compress=compress):
+        _writeAstropy(ff, file_path, planes, compress=compress)
 
 
 
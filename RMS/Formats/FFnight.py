@@ -0,0 +1,718 @@
+""" Night container, a single file which holds all FF files and field sums of one night.
+
+Storing thousands of small files per night on an SD card makes the file system metadata the bottleneck, so
+the FF files and field sums can instead be appended to one container file per night directory. The container
+starts with a header, followed by blocks of fixed size index entries. Each index entry stores the name of
+the file, its start time, the offset and size of its data and the FF parameters. When an index block is
+full, a new one is appended to the end of the file and linked from the previous one. The data of each FF
+file is stored as the 4 x nrows x ncols array of maxpixel, maxframe, avepixel and stdpixel, the field sums
+are stored in the same layout as the FS*_fieldsum.bin files.
+
+The container is written by a single process (the compression), but it can be read by other processes
+while it is being appended to. The entry count of an index block is updated only after the data and the
+entry were written, so readers never see partial entries.
+
+FFfile.read reads the FF files from the container of the directory if they are not stored as individual
+files. The processing of the night (flat, thumbnails, field sums and archiving) lists the files with
+listFiles, and the files which are archived are exported as individual files when they are archived. All
+files can be exported back to individual CAMS compatible files:
+
+    python -m RMS.Formats.FFnight export DIR_PATH [OUTPUT_DIR]
+
+and the individual files of a directory can be packed into a container:
+
+    python -m RMS.Formats.FFnight pack DIR_PATH
+"""
+
+
+from __future__ import print_function, division, absolute_import
+
+import os
+import struct
+
+import numpy as np
+
+from RMS.Formats.FFStruct import FFStruct
+from RMS.Formats.FFbin import write as writeFFbin
+from RMS.Formats.FFfits import write as writeFFfits
+
+
+# Extension of the night container files
+FF_NIGHT_EXTENSION = '.ffn'
+
+FF_NIGHT_MAGIC = b'RMSFFN01'
+
+# Header: magic, version, number of entries per index block, offset of the first index block
+FF_NIGHT_HEADER = struct.Struct('<8sIIQ')
+
+# Index block header: number of used entries, number of entries, offset of the next index block (0 if none)
+FF_NIGHT_INDEX_HEADER = struct.Struct('<IIQ')
+
+# Index entry: name, kind, start time (Unix seconds), data offset, data size, nrows, ncols, nbits, nframes,
+#   first, decimation_fact, interleave_flag, fps, camno
+FF_NIGHT_ENTRY = struct.Struct('<64sB7xdQQ7id16s')
+
+# Kinds of the stored files
+KIND_FF = 0
+KIND_FIELDSUM = 1
+
+# Default number of entries in an index block, one block covers about 3 hours of FF files and field sums
+INDEX_BLOCK_ENTRIES = 2048
+
+
+
+class FFNightEntry(object):
+    def __init__(self, name, kind, start_time, offset, size, nrows=0, ncols=0, nbits=0, nframes=0, first=0,
+        decimation_fact=0, interleave_flag=0, fps=0, camno=''):
+        """ Index entry of a file stored in the night container. """
+
+        self.name = name
+        self.kind = kind
+        self.start_time = start_time
+        self.offset = offset
+        self.size = size
+
+        self.nrows = nrows
+        self.ncols = ncols
+        self.nbits = nbits
+        self.nframes = nframes
+        self.first = first
+        self.decimation_fact = decimation_fact
+        self.interleave_flag = interleave_flag
+        self.fps = fps
+        self.camno = camno
+
+
+    def pack(self):
+        """ Return the binary representation of the entry. """
+
+        return FF_NIGHT_ENTRY.pack(self.name.encode('ascii'), self.kind, self.start_time, self.offset,
+            self.size, self.nrows, self.ncols, self.nbits, self.nframes, self.first, self.decimation_fact,
+            self.interleave_flag, self.fps, str(self.camno).encode('ascii'))
+
+
+    @staticmethod
+    def unpack(data):
+        """ Init the entry from its binary representation. """
+
+        values = list(FF_NIGHT_ENTRY.unpack(data))
+
+        values[0] = values[0].rstrip(b'\0').decode('ascii')
+        values[-1] = values[-1].rstrip(b'\0').decode('ascii')
+
+        return FFNightEntry(*values)
+
+
+
+class FFNightContainer(object):
+    def __init__(self, file_path):
+        """ Night container file, see the module description.
+
+        Arguments:
+            file_path: [str] Path to the container file.
+
+        """
+
+        self.file_path = file_path
+
+        # Entries in the order in which they were stored
+        self.entries = []
+
+        # Entries by name
+        self.names = {}
+
+        # Index blocks as lists of [offset, used entries, entries]
+        self.index_blocks = []
+
+        # Start times and names of FF files sorted by time, computed when needed
+        self.ff_times = None
+        self.ff_names = None
+
+        self.stamp = None
+
+        self.loadIndex()
+
+
+    @staticmethod
+    def create(file_path, index_entries=INDEX_BLOCK_ENTRIES):
+        """ Create an empty container file.
+
+        Arguments:
+            file_path: [str] Path to the container file.
+
+        Keyword arguments:
+            index_entries: [int] Number of entries in an index block.
+
+        Return:
+            [FFNightContainer] The new container.
+        """
+
+        with open(file_path, 'wb') as fid:
+
+            fid.write(FF_NIGHT_HEADER.pack(FF_NIGHT_MAGIC, 1, index_entries, FF_NIGHT_HEADER.size))
+            fid.write(_emptyIndexBlock(index_entries))
+
+
+        return FFNightContainer(file_path)
+
+
+    def loadIndex(self):
+        """ Read the index of the container. """
+
+        self.entries = []
+        self.names = {}
+        self.index_blocks = []
+        self.ff_times = None
+        self.ff_names = None
+
+        self.stamp = _fileStamp(self.file_path)
+
+        with open(self.file_path, 'rb') as fid:
+
+            magic, _, _, block_offset = FF_NIGHT_HEADER.unpack(fid.read(FF_NIGHT_HEADER.size))
+
+            if magic != FF_NIGHT_MAGIC:
+                raise IOError('{:s} is not an FF night container!'.format(self.file_path))
+
+            # Read all index blocks
+            while block_offset:
+
+                fid.seek(block_offset)
+                used, capacity, next_offset = FF_NIGHT_INDEX_HEADER.unpack(
+                    fid.read(FF_NIGHT_INDEX_HEADER.size))
+
+                index_data = fid.read(used*FF_NIGHT_ENTRY.size)
+
+                for i in range(used):
+                    self._addEntry(FFNightEntry.unpack(index_data[i*FF_NIGHT_ENTRY.size:\
+                        (i + 1)*FF_NIGHT_ENTRY.size]))
+
+                self.index_blocks.append([block_offset, used, capacity])
+
+                block_offset = next_offset
+
+
+    def _addEntry(self, entry):
+
+        self.entries.append(entry)
+        self.names[entry.name] = entry
+
+        self.ff_times = None
+        self.ff_names = None
+
+
+    def findEntry(self, name):
+        """ Return the entry of the file with the given name, or None if it is not in the container. File
+            names without the extension are also matched.
+        """
+
+        if name in self.names:
+            return self.names[name]
+
+        for extension in ['.fits', '.bin']:
+            if (name + extension) in self.names:
+                return self.names[name + extension]
+
+        return None
+
+
+    def listFF(self):
+        """ Return the names of all FF files in the container, sorted by time. """
+
+        self._sortFF()
+
+        return list(self.ff_names)
+
+
+    def _sortFF(self):
+
+        if self.ff_names is None:
+
+            ff_entries = sorted([entry for entry in self.entries if entry.kind == KIND_FF],
+                key=lambda entry: (entry.start_time, entry.name))
+
+            self.ff_times = np.array([entry.start_time for entry in ff_entries])
+            self.ff_names = [entry.name for entry in ff_entries]
+
+
+    def findFF(self, unix_time):
+        """ Return the name of the last FF file which started before the given time.
+
+        Arguments:
+            unix_time: [float] Time in seconds since the Unix epoch.
+
+        Return:
+            [str] Name of the FF file, or None if there is no FF file started before the given time.
+        """
+
+        self._sortFF()
+
+        i = np.searchsorted(self.ff_times, unix_time, side='right') - 1
+
+        if i < 0:
+            return None
+
+        return self.ff_names[i]
+
+
+    def append(self, entry, data):
+        """ Append a file to the container.
+
+        Arguments:
+            entry: [FFNightEntry] Index entry of the file, its offset and size are set here.
+            data: [bytes] Contents of the file.
+
+        """
+
+        if entry.name in self.names:
+            raise ValueError('{:s} is already stored in {:s}!'.format(entry.name, self.file_path))
+
+        with open(self.file_path, 'r+b') as fid:
+
+            # Write the data to the end of the file
+            fid.seek(0, os.SEEK_END)
+
+            entry.offset = fid.tell()
+            entry.size = len(data)
+
+            # Pack the entry before writing anything, in case its values can't be stored
+            entry_data = entry.pack()
+
+            fid.write(data)
+
+
+            # If the last index block is full, add a new one to the end of the file and link it
+            block = self.index_blocks[-1]
+
+            if block[1] == block[2]:
+
+                new_block = [fid.tell(), 0, block[2]]
+
+                fid.write(_emptyIndexBlock(block[2]))
+                fid.flush()
+
+                fid.seek(block[0] + 8)
+                fid.write(struct.pack('<Q', new_block[0]))
+
+                self.index_blocks.append(new_block)
+
+                block = new_block
+
+
+            # Write the entry, and only then increase the number of used entries
+            fid.seek(block[0] + FF_NIGHT_INDEX_HEADER.size + block[1]*FF_NIGHT_ENTRY.size)
+            fid.write(entry_data)
+            fid.flush()
+
+            block[1] += 1
+
+            fid.seek(block[0])
+            fid.write(struct.pack('<I', block[1]))
+
+
+        self._addEntry(entry)
+
+        self.stamp = _fileStamp(self.file_path)
+
+
+    def appendFF(self, name, ff, start_time):
+        """ Append an FF file to the container.
+
+        Arguments:
+            name: [str] Name of the FF file, e.g. FF_XX0001_20180101_010203_456_0001024.fits.
+            ff: [ff bin struct] FF file.
+            start_time: [float] Time of the first frame in seconds since the Unix epoch.
+
+        """
+
+        if ff.array is not None:
+            planes = ff.array
+
+        else:
+            planes = np.stack([ff.maxpixel, ff.maxframe, ff.avepixel, ff.stdpixel], axis=0)
+
+        planes = np.ascontiguousarray(planes, dtype=np.uint8)
+
+        entry = FFNightEntry(name, KIND_FF, start_time, 0, 0, nrows=planes.shape[1], ncols=planes.shape[2],
+            nbits=ff.nbits, nframes=ff.nframes, first=ff.first, decimation_fact=ff.decimation_fact,
+            interleave_flag=ff.interleave_flag, fps=ff.fps, camno=ff.camno)
+
+        self.append(entry, planes.tobytes())
+
+
+    def appendFieldSums(self, name, intensity_array, start_time):
+        """ Append the field sums to the container, in the same layout as the FS*_fieldsum.bin files.
+
+        Arguments:
+            name: [str] Name of the field sum file, e.g. FS_XX0001_20180101_010203_456_0001024_fieldsum.bin.
+            intensity_array: [ndarray] Sums of intensities per every field.
+            start_time: [float] Time of the first frame in seconds since the Unix epoch.
+
+        """
+
+        data = np.array(len(intensity_array)).astype(np.uint16).tobytes() \
+            + np.asarray(intensity_array).astype(np.uint32).tobytes()
+
+        self.append(FFNightEntry(name, KIND_FIELDSUM, start_time, 0, 0), data)
+
+
+    def readData(self, entry):
+        """ Return the contents of the given entry as a uint8 array, memory mapped from the file
+            (copy-on-write).
+        """
+
+        if entry.size == 0:
+            return np.zeros(0, dtype=np.uint8)
+
+        return np.memmap(self.file_path, dtype=np.uint8, mode='c', offset=entry.offset,
+            shape=(entry.size,)).view(np.ndarray)
+
+
+    def readFF(self, name, array=False):
+        """ Read an FF file from the container.
+
+        Arguments:
+            name: [str] Name of the FF file.
+
+        Keyword arguments:
+            array: [bool] True in order to populate structure's array element (default is False)
+
+        Return:
+            [ff structure] FF file, or None if it is not in the container.
+        """
+
+        entry = self.findEntry(name)
+
+        if (entry is None) or (entry.kind != KIND_FF):
+            return None
+
+        ff = FFStruct()
+
+        ff.nrows = entry.nrows
+        ff.ncols = entry.ncols
+        ff.nbits = entry.nbits
+        ff.nframes = entry.nframes
+        ff.first = entry.first
+        ff.camno = entry.camno
+        ff.decimation_fact = entry.decimation_fact
+        ff.interleave_flag = entry.interleave_flag
+        ff.fps = entry.fps
+
+        planes = self.readData(entry).reshape(4, entry.nrows, entry.ncols)
+
+        if array:
+            ff.array = planes
+
+        else:
+            ff.maxpixel = planes[0]
+            ff.maxframe = planes[1]
+            ff.avepixel = planes[2]
+            ff.stdpixel = planes[3]
+
+        return ff
+
+
+    def readFieldSums(self, name):
+        """ Read the field sums from the container.
+
+        Arguments:
+            name: [str] Name of the field sum file.
+
+        Return:
+            [ndarray] Sums of intensities per every field, or None if they are not in the container.
+        """
+
+        entry = self.findEntry(name)
+
+        if (entry is None) or (entry.kind != KIND_FIELDSUM):
+            return None
+
+        data = self.readData(entry)
+
+        n_entries = int(data[:2].view(np.uint16)[0])
+
+        return data[2:2 + 4*n_entries].view(np.uint32)
+
+
+    def export(self, dir_path, names=None):
+        """ Write the files in the container as individual CAMS compatible files. FF files are written in
+            the format given by the extension of their name.
+
+        Arguments:
+            dir_path: [str] Directory where the files will be written.
+
+        Keyword arguments:
+            names: [list] Names of the files to export. All files are exported if not given.
+
+        Return:
+            [list] Names of the exported files.
+        """
+
+        if names is None:
+            names = [entry.name for entry in self.entries]
+
+        exported = []
+
+        for name in names:
+
+            entry = self.findEntry(name)
+
+            if entry is None:
+                continue
+
+            if entry.kind == KIND_FF:
+
+                ff = self.readFF(entry.name, array=True)
+
+                if entry.name.endswith('.bin'):
+                    writeFFbin(ff, dir_path, entry.name)
+
+                else:
+                    writeFFfits(ff, dir_path, entry.name)
+
+            else:
+
+                with open(os.path.join(dir_path, entry.name), 'wb') as fid:
+                    fid.write(self.readData(entry).tobytes())
+
+
+            exported.append(entry.name)
+
+
+        return exported
+
+
+
+
+def _emptyIndexBlock(index_entries):
+    """ Return an empty index block with the given number of entries. """
+
+    return FF_NIGHT_INDEX_HEADER.pack(0, index_entries, 0) + b'\0'*(index_entries*FF_NIGHT_ENTRY.size)
+
+
+
+def _fileStamp(file_path):
+    """ Return the modification time and the size of the file, which change when it is appended to. """
+
+    stat = os.stat(file_path)
+
+    return (stat.st_mtime, stat.st_size)
+
+
+
+def containerPath(dir_path):
+    """ Return the path of the night container of the given directory. If a path to a container file is
+        given, it is returned as it is.
+    """
+
+    if dir_path.endswith(FF_NIGHT_EXTENSION):
+        return dir_path
+
+    return os.path.join(dir_path, os.path.basename(os.path.normpath(dir_path)) + FF_NIGHT_EXTENSION)
+
+
+
+# Containers opened in this process
+_containers = {}
+
+
+
+def getContainer(dir_path, create=False):
+    """ Return the night container of the given directory. The index of the container is read only once
+        per process and it is reread when the container has been appended to by another process.
+
+    Arguments:
+        dir_path: [str] Path to the night directory, or to the container file itself.
+
+    Keyword arguments:
+        create: [bool] Create the container if it does not exist. False by default.
+
+    Return:
+        [FFNightContainer] The container, or None if it does not exist and was not created.
+    """
+
+    file_path = containerPath(dir_path)
+
+    if not os.path.isfile(file_path):
+
+        _containers.pop(file_path, None)
+
+        if not create:
+            return None
+
+        _containers[file_path] = FFNightContainer.create(file_path)
+
+
+    container = _containers.get(file_path)
+
+    if (container is None) or (container.stamp != _fileStamp(file_path)):
+        container = FFNightContainer(file_path)
+        _containers[file_path] = container
+
+
+    return container
+
+
+
+def read(dir_path, name, array=False):
+    """ Read an FF file from the night container of the given directory.
+
+    Arguments:
+        dir_path: [str] Path to the night directory, or to the container file itself.
+        name: [str] Name of the FF file.
+
+    Keyword arguments:
+        array: [bool] True in order to populate structure's array element (default is False)
+
+    Return:
+        [ff structure] FF file, or None if there is no container or the file is not in it.
+    """
+
+    container = getContainer(dir_path)
+
+    if container is None:
+        return None
+
+    return container.readFF(name, array=array)
+
+
+
+def listFF(dir_path):
+    """ Return the names of the FF files in the night container of the given directory, sorted by time. An
+        empty list is returned if there is no container.
+    """
+
+    container = getContainer(dir_path)
+
+    if container is None:
+        return []
+
+    return container.listFF()
+
+
+
+def listFiles(dir_path):
+    """ Return the sorted names of the files in the given directory, together with the names of the files
+        stored in its night container. Used instead of os.listdir by the tools which look for the FF files
+        and the field sums of a night.
+    """
+
+    file_names = set(os.listdir(dir_path))
+
+    container = getContainer(dir_path)
+
+    if container is not None:
+        file_names.update(entry.name for entry in container.entries)
+
+    return sorted(file_names)
+
+
+
+def exportMissing(dir_path, names):
+    """ Write the given files which are stored only in the night container of the directory as individual
+        files into the directory, e.g. before they are archived.
+
+    Arguments:
+        dir_path: [str] Path to the night directory.
+        names: [list] Names of the files which are needed as individual files.
+
+    Return:
+        [list] Names of the exported files.
+    """
+
+    container = getContainer(dir_path)
+
+    if container is None:
+        return []
+
+    missing = [name for name in names if not os.path.isfile(os.path.join(dir_path, name))]
+
+    return container.export(dir_path, missing)
+
+
+
+
+if __name__ == "__main__":
+
+    import argparse
+    import calendar
+
+    from RMS.Formats import FFfile
+
+
+    ### COMMAND LINE ARGUMENTS
+
+    # Init the command line arguments parser
+    arg_parser = argparse.ArgumentParser(description="""Pack the FF files and field sums of a night directory
+        into a night container, or export them from the container to individual files.""")
+
+    arg_parser.add_argument('action', choices=['pack', 'export'], \
+        help='pack - store the individual files in the container, export - write the individual files.')
+
+    arg_parser.add_argument('dir_path', metavar='DIR_PATH', type=str, \
+        help='Path to the night directory or to the container file.')
+
+    arg_parser.add_argument('output_dir', metavar='OUTPUT_DIR', type=str, nargs='?', \
+        help='Directory the files are exported to. The night directory by default.')
+
+    # Parse the command line arguments
+    cml_args = arg_parser.parse_args()
+
+    #########################
+
+
+    dir_path = cml_args.dir_path
+
+    if cml_args.action == 'pack':
+
+        container = getContainer(dir_path, create=True)
+
+        for file_name in sorted(os.listdir(dir_path)):
+
+            is_ff = FFfile.validFFName(file_name)
+            is_fieldsum = file_name.startswith('FS') and file_name.endswith('_fieldsum.bin')
+
+            if not (is_ff or is_fieldsum) or (container.findEntry(file_name) is not None):
+                continue
+
+            dt = FFfile.filenameToDatetime(file_name)
+            start_time = calendar.timegm(dt.timetuple()) + dt.microsecond/1e6
+
+            if is_ff:
+                ff = FFfile.read(dir_path, file_name)
+
+                if ff is None:
+                    print('Could not read {:s}, skipping...'.format(file_name))
+                    continue
+
+                container.appendFF(file_name, ff, start_time)
+
+            else:
+                with open(os.path.join(dir_path, file_name), 'rb') as fid:
+                    data = fid.read()
+
+                container.append(FFNightEntry(file_name, KIND_FIELDSUM, start_time, 0, 0), data)
+
+
+            print('Packed {:s}'.format(file_name))
+
+
+    else:
+
+        container = getContainer(dir_path)
+
+        if container is None:
+            print('No night container found in {:s}!'.format(dir_path))
+
+        else:
+
+            output_dir = cml_args.output_dir
+
+            if output_dir is None:
+                output_dir = os.path.dirname(containerPath(dir_path))
+
+            if not os.path.exists(output_dir):
+                os.makedirs(output_dir)
+
+            for name in container.export(output_dir):
+                print('Exported {:s}'.format(name))
@@ -34,8 +34,14 @@ class fr_struct:
         
 
 
+# Header of every frame cutout: y and x of the cutout center, time (frame index) and the cutout size
+FR_FRAME_HEADER = struct.Struct('IIII')
+
+
+
 def read(dir_path, filename):
-    """ Read FRF*.bin file from specified directory.
+    """ Read FRF*.bin file from specified directory. The whole file is read at once and the frame cutouts are
+        views into the read buffer.
     
     @param dir: path to directory containing file
     @param filename: name of FR*.bin file (either with FR and extension or without)
@@ -44,16 +50,22 @@ def read(dir_path, filename):
     """
     
     if filename[:2] == "FR":
-        fid = open(os.path.join(dir_path, filename), "rb")
+        file_path = os.path.join(dir_path, filename)
     else:
-        fid = open(os.path.join(dir_path, "FR_" + filename + ".bin"), "rb")
+        file_path = os.path.join(dir_path, "FR_" + filename + ".bin")
+
+    data = np.fromfile(file_path, dtype=np.uint8)
     
     fr = fr_struct()
     
-    fr.lines = np.fromfile(fid, dtype=np.uint32, count=1)[0]
+    fr.lines = struct.unpack_from('I', data, 0)[0]
+    offset = 4
     
     for i in range(fr.lines):
-        frameNum = np.fromfile(fid, dtype=np.uint32, count=1)[0]
+
+        frameNum = struct.unpack_from('I', data, offset)[0]
+        offset += 4
+
         yc = []
         xc = []
         t = []
@@ -61,11 +73,17 @@ def read(dir_path, filename):
         frames = []
         
         for z in range(frameNum):
-            yc.append(int(np.fromfile(fid, dtype=np.uint32, count=1)))
-            xc.append(int(np.fromfile(fid, dtype=np.uint32, count=1)))
-            t.append(int(np.fromfile(fid, dtype=np.uint32, count=1)))
-            size.append(int(np.fromfile(fid, dtype=np.uint32, count=1)))
-            frames.append(np.reshape(np.fromfile(fid, dtype=np.uint8, count=size[-1]**2), (size[-1], size[-1])))
+
+            y, x, frame_time, frame_size = FR_FRAME_HEADER.unpack_from(data, offset)
+            offset += FR_FRAME_HEADER.size
+
+            yc.append(y)
+            xc.append(x)
+            t.append(frame_time)
+            size.append(frame_size)
+
+            frames.append(data[offset:offset + frame_size**2].reshape(frame_size, frame_size))
+            offset += frame_size**2
         
         fr.frameNum.append(frameNum)
         fr.yc.append(yc)
@@ -78,29 +96,38 @@ def read(dir_path, filename):
 
 
 
+def _packLine(yc, xc, t, size, frames):
+    """ Return the binary representation of one line of frame cutouts, assembled into one buffer. """
+
+    parts = [struct.pack('I', len(frames))]
+
+    for z, frame in enumerate(frames):
+
+        frame_size = int(size[z])
+
+        parts.append(FR_FRAME_HEADER.pack(int(yc[z]), int(xc[z]), int(t[z]), frame_size))
+        parts.append(np.ascontiguousarray(frame[:frame_size, :frame_size]).tobytes())
+
+    return b''.join(parts)
+
+
+
 def write(fr, dir_path, filename):
     """ Write FR*.bin structure to a file in specified directory.
     """
     
 
     if filename[:2] == "FR":
-        file = os.path.join(dir_path, filename)
+        file_path = os.path.join(dir_path, filename)
     else:
-        file = os.path.join(dir_path, "FR_" + filename + ".bin")
+        file_path = os.path.join(dir_path, "FR_" + filename + ".bin")
     
-    file = os.path.join()
-    with open(file, "wb") as fid:
+    with open(file_path, "wb") as fid:
+
         fid.write(struct.pack('I', fr.lines))
     
         for i in range(fr.lines):
-            fid.write(struct.pack('I', fr.frameNum[i]))
-                
-            for z in range(fr.frameNum[i]):
-                fid.write(struct.pack('I', fr.yc[i, z]))
-                fid.write(struct.pack('I', fr.xc[i, z]))
-                fid.write(struct.pack('I', fr.t[i, z]))
-                fid.write(struct.pack('I', fr.size[i, z]))
-                fr.frames[i, z].tofile(fid)
+            fid.write(_packLine(fr.yc[i], fr.xc[i], fr.t[i], fr.size[i], fr.frames[i][:fr.frameNum[i]]))
 
 
 
@@ -109,26 +136,22 @@ def writeArray(arr, dir_path, filename):
     """
 
     if filename[:2] == "FR":
-        file = os.path.join(dir_path, filename)
+        file_path = os.path.join(dir_path, filename)
     else:
-        file = os.path.join(dir_path, "FR_" + filename + ".bin")
+        file_path = os.path.join(dir_path, "FR_" + filename + ".bin")
         
             
-    with open(file, "wb") as f:
-        f.write(struct.pack('I', len(arr)))               # number of extracted lines
+    with open(file_path, "wb") as f:
+
+        # Number of extracted lines
+        f.write(struct.pack('I', len(arr)))
         
+        # Extracted frames, with the center, the time and the size of the cutout
         for frames, sizepos in arr:
-            f.write(struct.pack('I', len(frames)))        # number of extracted frames
-            
-            for i, frame in enumerate(frames):
-                f.write(struct.pack('I', sizepos[i, 0]))  # y of center
-                f.write(struct.pack('I', sizepos[i, 1]))  # x of center
-                f.write(struct.pack('I', sizepos[i, 2]))  # time
-                size = sizepos[i, 3]
-                f.write(struct.pack('I', size))           # cropped frame size
-                frame[:size, :size].tofile(f)             # cropped frame
+            f.write(_packLine(sizepos[:, 0], sizepos[:, 1], sizepos[:, 2], sizepos[:, 3], frames))
                 
 
+
 def validFRName(fr_name):
     """ Checks if the given file is an FR file. 
     
@@ -22,6 +22,8 @@ import os
 
 import numpy as np
 
+from RMS.Formats import FFnight
+
 
 
 def saveFieldIntensitiesText(intensity_array, dir_path, file_name, deinterlace=False):
@@ -93,30 +95,43 @@ def readFieldIntensitiesBin(dir_path, file_name, deinterlace=False):
 		file_name: [str] Name of the file.
 	"""
 
-	with open(os.path.join(dir_path, file_name), 'rb') as fid:
+	intensity_array = None
 
-		# Read the number of entries
-		n_entries = int(np.fromfile(fid, dtype=np.uint16, count = 1))
+	# Read the field sums from the night container if they are not stored as an individual file
+	if not os.path.isfile(os.path.join(dir_path, file_name)):
 
-		intensity_array = np.zeros(n_entries, dtype=np.uint32)
-		half_frames = np.zeros(n_entries)
+		container = FFnight.getContainer(dir_path)
 
-		if deinterlace:
-			deinterlace_flag = 2.0
-		else:
-			deinterlace_flag = 1.0
+		if container is not None:
+			intensity_array = container.readFieldSums(file_name)
 
-		# Read individual entries
-		for i in range(n_entries):
 
-			# Calculate the half frame
-			half_frames[i] = float(i)/deinterlace_flag
+	if intensity_array is None:
+
+		with open(os.path.join(dir_path, file_name), 'rb') as fid:
+
+			# Read the number of entries
+			n_entries = int(np.fromfile(fid, dtype=np.uint16, count = 1)[0])
+
+			intensity_array = np.zeros(n_entries, dtype=np.uint32)
+
+			# Read individual entries
+			for i in range(n_entries):
+
+				# Read the summmed field intensity
+				intensity_array[i] = int(np.fromfile(fid, dtype=np.uint32, count = 1)[0])
+
+
+	if deinterlace:
+		deinterlace_flag = 2.0
+	else:
+		deinterlace_flag = 1.0
 
-			# Read the summmed field intensity
-			intensity_array[i] = int(np.fromfile(fid, dtype=np.uint32, count = 1))
+	# Calculate the half frames
+	half_frames = np.arange(len(intensity_array))/deinterlace_flag
 
 
-		return half_frames, intensity_array
+	return half_frames, np.array(intensity_array)
 
 
 
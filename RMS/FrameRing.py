@@ -0,0 +1,347 @@
+""" Ring of frame blocks in shared memory, used for handing over the captured frames to the compression. """
+
+from __future__ import print_function, division, absolute_import
+
+import ctypes
+import logging
+import multiprocessing
+
+import numpy as np
+
+
+# Get the logger from the main module
+log = logging.getLogger("logger")
+
+
+
+# States of the frame blocks
+FREE = 0
+FILLING = 1
+READY = 2
+COMPRESSING = 3
+EXTRACTING = 4
+
+
+
+class FrameRing(object):
+    """ N blocks of frames in shared memory with explicit ownership of every block.
+
+        The capture takes a FREE block and fills it (FILLING), then marks it as READY. The compression takes
+        the READY blocks in the order they were captured (COMPRESSING), and the block is FREE again when the
+        raw frames are not needed anymore. The compression can also follow the block which is being filled
+        and compress the frames as they arrive. After the compression, the block can be kept for the 
+        extraction of its raw frames (EXTRACTING), but only while the capture has a spare free block.
+
+        If there are no free blocks when the capture needs one, the capture is starved. It will then
+        overwrite the newest block which is waiting for compression (the older ones might already be 
+        compressed as they arrived, so overwriting them could stall the compression), or wait until a block
+        is freed if all blocks are being compressed or overwriting is not allowed. Both cases are counted.
+
+        All state changes are signalled through a condition variable, so no side has to poll.
+
+    """
+
+    def __init__(self, blocks_num, frames_num, height, width):
+        """
+        Arguments:
+            blocks_num: [int] Number of frame blocks in the ring (at least 2).
+            frames_num: [int] Number of frames in every block.
+            height: [int] Height of the frames.
+            width: [int] Width of the frames.
+
+        """
+
+        self.blocks_num = max(2, blocks_num)
+        self.frames_num = frames_num
+
+        # Init the frame blocks in shared memory
+        self.arrays = []
+        for i in range(self.blocks_num):
+
+            shared_array_base = multiprocessing.Array(ctypes.c_uint8, frames_num*height*width)
+            shared_array = np.ctypeslib.as_array(shared_array_base.get_obj())
+            shared_array = shared_array.reshape(frames_num, height, width)
+
+            self.arrays.append(shared_array)
+
+
+        # All values below are only changed while holding the condition lock
+        self.condition = multiprocessing.Condition()
+
+        # State of every block
+        self.states = multiprocessing.Array(ctypes.c_int, self.blocks_num, lock=False)
+
+        # Sequential number of the frame block currently held in every ring block
+        self.sequence = multiprocessing.Array(ctypes.c_long, self.blocks_num, lock=False)
+        self.next_sequence = multiprocessing.Value(ctypes.c_long, 0, lock=False)
+
+        # Time of the first frame and the number of frames written to every block
+        self.start_times = multiprocessing.Array(ctypes.c_double, self.blocks_num, lock=False)
+        self.frame_counts = multiprocessing.Array(ctypes.c_int, self.blocks_num, lock=False)
+
+        # Number of times the capture did not have a free block, and the number of blocks which were
+        # overwritten before they were compressed
+        self.starved = multiprocessing.Value(ctypes.c_int, 0, lock=False)
+        self.overwritten = multiprocessing.Value(ctypes.c_int, 0, lock=False)
+
+
+
+    def _oldest(self, states, newest=False):
+        """ Return the index of the block with the lowest sequential number among the blocks in the given
+            states, or None if there are no such blocks. Must be called while holding the lock.
+
+        Keyword arguments:
+            newest: [bool] Return the block with the highest sequential number instead. False by default.
+        """
+
+        oldest = None
+
+        for i in range(self.blocks_num):
+            if self.states[i] in states:
+                if (oldest is None) or ((self.sequence[i] < self.sequence[oldest]) != newest):
+                    oldest = i
+
+        return oldest
+
+
+
+    def acquireFree(self, exit_event=None, overwrite=True):
+        """ Take a block for filling. Called by the capture.
+
+        Keyword arguments:
+            exit_event: [multiprocessing.Event] If set while waiting for a free block, None is returned.
+            overwrite: [bool] If there are no free blocks, overwrite a block which is waiting for 
+                compression. If False, wait until a block is freed. True by default.
+
+        Return:
+            [int] Index of the block, or None if waiting was interrupted.
+        """
+
+        with self.condition:
+
+            free = self._oldest([FREE])
+
+            if free is None:
+
+                self.starved.value += 1
+
+                # Overwrite the newest block which is waiting for compression
+                if overwrite:
+                    free = self._oldest([READY], newest=True)
+
+                if free is not None:
+                    self.overwritten.value += 1
+                    log.warning('No free frame blocks, overwriting a block which was not compressed! '\
+                        'Overwritten blocks so far: {:d}'.format(self.overwritten.value))
+
+                else:
+                    log.warning('No free frame blocks, waiting for the compression to free one! '\
+                        'Starved {:d} times so far.'.format(self.starved.value))
+
+
+            # Wait until some block is freed
+            while free is None:
+
+                if (exit_event is not None) and exit_event.is_set():
+                    return None
+
+                self.condition.wait(1.0)
+                free = self._oldest([FREE])
+
+
+            self.states[free] = FILLING
+            self.sequence[free] = self.next_sequence.value
+            self.next_sequence.value += 1
+            self.start_times[free] = 0
+            self.frame_counts[free] = 0
+
+            self.condition.notify_all()
+
+        return free
+
+
+
+    def frameAdded(self, block, frames_count):
+        """ Report the number of frames written to the block which is being filled. Called by the capture.
+
+        Arguments:
+            block: [int] Index of the block.
+            frames_count: [int] Number of frames written so far.
+
+        """
+
+        with self.condition:
+            self.frame_counts[block] = frames_count
+            self.condition.notify_all()
+
+
+
+    def markReady(self, block, start_time):
+        """ Mark the filled block as ready for compression. Called by the capture.
+
+        Arguments:
+            block: [int] Index of the block.
+            start_time: [float] Time of the first frame in the block.
+
+        """
+
+        with self.condition:
+            self.start_times[block] = start_time
+            self.states[block] = READY
+            self.condition.notify_all()
+
+
+
+    def release(self, block):
+        """ Mark the block as free. Called by the capture for abandoned blocks, and by the consumer when the
+            raw frames are not needed anymore.
+
+        Arguments:
+            block: [int] Index of the block.
+
+        """
+
+        with self.condition:
+            self.states[block] = FREE
+            self.condition.notify_all()
+
+
+
+    def pinForExtraction(self, block):
+        """ Keep the compressed block for the extraction of its raw frames, if the capture has a spare block,
+            so the capture is not starved by the extraction. The capture needs a block which it is filling or
+            is about to take, and another free block to take after it. The block has to be released when the
+            extraction is done.
+
+        Arguments:
+            block: [int] Index of the block.
+
+        Return:
+            [bool] True if the block was kept, False if there are no spare blocks.
+        """
+
+        with self.condition:
+
+            if len([i for i in range(self.blocks_num) if self.states[i] in [FREE, FILLING]]) < 2:
+                return False
+
+            self.states[block] = EXTRACTING
+            self.condition.notify_all()
+
+        return True
+
+
+
+    def acquireReady(self, exit_event=None):
+        """ Take the oldest block which is ready for compression, waiting until one is available.
+
+        Keyword arguments:
+            exit_event: [multiprocessing.Event] If set while waiting for a block, None is returned.
+
+        Return:
+            (block, start_time): [tuple] Index of the block and the time of its first frame, or None if
+                waiting was interrupted.
+        """
+
+        with self.condition:
+
+            while True:
+
+                block = self._oldest([READY])
+
+                if block is not None:
+                    self.states[block] = COMPRESSING
+                    self.condition.notify_all()
+
+                    return block, self.start_times[block]
+
+
+                if (exit_event is not None) and exit_event.is_set():
+                    return None
+
+                self.condition.wait(1.0)
+
+
+
+    def nextBlock(self, exit_event=None):
+        """ Return the oldest block which is being filled or is ready, waiting until there is one. Used for
+            compressing the frames as they arrive.
+
+        Keyword arguments:
+            exit_event: [multiprocessing.Event] If set while waiting for a block, None is returned.
+
+        Return:
+            (block, sequence): [tuple] Index of the block and the sequential number of the frame block it
+                holds, or None if waiting was interrupted.
+        """
+
+        with self.condition:
+
+            while True:
+
+                block = self._oldest([FILLING, READY])
+
+                if block is not None:
+                    return block, self.sequence[block]
+
+                if (exit_event is not None) and exit_event.is_set():
+                    return None
+
+                self.condition.wait(1.0)
+
+
+
+    def waitFrames(self, block, sequence, frames_count, exit_event=None):
+        """ Wait until more than the given number of frames are written to the block, or until the block is
+            ready.
+
+        Arguments:
+            block: [int] Index of the block.
+            sequence: [int] Sequential number of the frame block, as returned by nextBlock.
+            frames_count: [int] Number of frames which were already processed.
+
+        Keyword arguments:
+            exit_event: [multiprocessing.Event] If set while waiting for frames, -1 is returned.
+
+        Return:
+            [int] Number of frames in the block, or -1 if the block was abandoned or overwritten.
+        """
+
+        with self.condition:
+
+            while True:
+
+                # Check that the block still holds the same frames
+                if (self.sequence[block] != sequence) or (self.states[block] not in [FILLING, READY]):
+                    return -1
+
+                if (self.frame_counts[block] > frames_count) or (self.states[block] == READY):
+                    return self.frame_counts[block]
+
+                if (exit_event is not None) and exit_event.is_set():
+                    return -1
+
+                self.condition.wait(1.0)
+
+
+
+    def takeReady(self, block, sequence):
+        """ Take the given block for compression if it is ready and still holds the same frames.
+
+        Arguments:
+            block: [int] Index of the block.
+            sequence: [int] Sequential number of the frame block, as returned by nextBlock.
+
+        Return:
+            [float] Time of the first frame in the block, or None if the block could not be taken.
+        """
+
+        with self.condition:
+
+            if (self.sequence[block] != sequence) or (self.states[block] != READY):
+                return None
+
+            self.states[block] = COMPRESSING
+            self.condition.notify_all()
+
+            return self.start_times[block]
@@ -0,0 +1,519 @@
+""" Sources of video frames for the capture. Every source has the same interface as cv2.VideoCapture (isOpened,
+    grab, retrieve, read, release), so the capture does not need to know where the frames are coming from.
+
+    Besides the video device, frames can be replayed from a video file, from FF files or a UWO .vid file, or
+    generated by a synthetic camera, which makes it possible to run the whole pipeline without a camera.
+"""
+
+from __future__ import print_function, division, absolute_import
+
+import os
+import time
+import logging
+
+import cv2
+import numpy as np
+
+from RMS.Formats.FFfile import read as readFF
+from RMS.Formats.FFfile import validFFName
+from RMS.Formats.Vid import VidStruct
+from RMS.Formats.Vid import readFrame as readVidFrame
+
+
+# Get the logger from the main module
+log = logging.getLogger("logger")
+
+
+
+class FrameSource(object):
+    """ Base class of frame sources which are not read through OpenCV.
+
+        The subclasses implement nextFrame, which returns the next frame or None when there are no more
+        frames. If the source runs in real time, the frames are given out at the given FPS, otherwise as fast
+        as they are requested.
+    """
+
+    def __init__(self, fps, real_time=False):
+        """
+        Arguments:
+            fps: [float] Frames per second.
+
+        Keyword arguments:
+            real_time: [bool] If True, the frames will be given at the rate given by the FPS. False by default.
+
+        """
+
+        self.fps = fps
+        self.real_time = real_time
+
+        self.opened = True
+
+        # Number of frames grabbed so far
+        self.frame_num = 0
+
+        # Time when the first frame was grabbed
+        self.t_start = None
+
+        # The last grabbed frame
+        self.frame = None
+
+
+
+    def nextFrame(self):
+        """ Return the next frame as a 2D or 3D uint8 array, or None if there are no more frames. """
+
+        raise NotImplementedError
+
+
+
+    def isOpened(self):
+        return self.opened
+
+
+
+    def set(self, prop_id, value):
+        """ Setting the properties is not supported, this is here only for compatibility with OpenCV. """
+
+        return False
+
+
+
+    def grab(self):
+        """ Grab the next frame. If the source runs in real time, wait until it is time for the frame.
+
+        Return:
+            [bool] True if the frame was grabbed, False if there are no more frames.
+        """
+
+        if not self.opened:
+            return False
+
+        # Keep the frame rate on schedule, instead of sleeping for a fixed time after every frame
+        if self.real_time:
+
+            if self.t_start is None:
+                self.t_start = time.time()
+
+            t_wait = self.t_start + self.frame_num/self.fps - time.time()
+
+            if t_wait > 0:
+                time.sleep(t_wait)
+
+
+        self.frame = self.nextFrame()
+
+        if self.frame is None:
+            self.opened = False
+            return False
+
+        self.frame_num += 1
+
+        return True
+
+
+
+    def retrieve(self, image=None):
+        """ Return the grabbed frame.
+
+        Keyword arguments:
+            image: [ndarray] If given and of the right shape, the frame is written into this array.
+
+        Return:
+            (ret, frame): [tuple] True and the frame, or False and None if no frame was grabbed.
+        """
+
+        if self.frame is None:
+            return False, None
+
+        if (image is not None) and (image.shape == self.frame.shape) and (image.dtype == self.frame.dtype):
+            np.copyto(image, self.frame)
+            return True, image
+
+        return True, np.copy(self.frame)
+
+
+
+    def read(self):
+        """ Grab and return the next frame. """
+
+        if not self.grab():
+            return False, None
+
+        return self.retrieve()
+
+
+
+    def release(self):
+        self.opened = False
+
+
+
+
+class VideoFileSource(FrameSource):
+    """ Frames from a video file, read with OpenCV. """
+
+    def __init__(self, file_path, fps, real_time=True):
+        """
+        Arguments:
+            file_path: [str] Path to the video file.
+            fps: [float] Frames per second, used for the real time replay.
+
+        Keyword arguments:
+            real_time: [bool] If True, the frames will be given at the rate given by the FPS. True by default.
+
+        """
+
+        super(VideoFileSource, self).__init__(fps, real_time=real_time)
+
+        self.device = cv2.VideoCapture(file_path)
+        self.opened = self.device.isOpened()
+
+
+
+    def nextFrame(self):
+
+        ret, frame = self.device.read()
+
+        if not ret:
+            return None
+
+        return frame
+
+
+
+    def retrieve(self, image=None):
+
+        # Give out the frame read by OpenCV directly, unless it should be written to the given array
+        if image is None:
+            return (self.frame is not None), self.frame
+
+        return super(VideoFileSource, self).retrieve(image)
+
+
+
+    def release(self):
+
+        super(VideoFileSource, self).release()
+        self.device.release()
+
+
+
+
+class FFReplaySource(FrameSource):
+    """ Replays frames reconstructed from FF files, either all FF files in a directory or a single FF file.
+        Every frame is the average pixel image, with the max pixel values at pixels where the max frame is the
+        current frame.
+    """
+
+    def __init__(self, path, fps, real_time=True):
+        """
+        Arguments:
+            path: [str] Path to the FF file or to a directory with FF files.
+            fps: [float] Frames per second, used for the real time replay.
+
+        Keyword arguments:
+            real_time: [bool] If True, the frames will be given at the rate given by the FPS. True by default.
+
+        """
+
+        super(FFReplaySource, self).__init__(fps, real_time=real_time)
+
+        if os.path.isdir(path):
+            self.dir_path = path
+            self.ff_list = sorted([ff_name for ff_name in os.listdir(path) if validFFName(ff_name)])
+
+        else:
+            self.dir_path, ff_name = os.path.split(path)
+            self.ff_list = [ff_name]
+
+
+        if not self.ff_list:
+            log.info('No FF files found in: ' + path)
+            self.opened = False
+
+        self.ff = None
+        self.ff_frame = 0
+        self.ff_frames_num = 0
+
+
+
+    def nextFrame(self):
+
+        # Load the next FF file when all frames of the previous one were given out
+        if self.ff_frame >= self.ff_frames_num:
+
+            if not self.ff_list:
+                return None
+
+            self.ff = readFF(self.dir_path, self.ff_list.pop(0))
+
+            if self.ff is None:
+                return self.nextFrame()
+
+            self.ff_frames_num = self.ff.nframes if self.ff.nframes > 0 else 256
+            self.ff_frame = 0
+
+
+        # Reconstruct the frame
+        frame = np.copy(self.ff.avepixel)
+        indices = np.where(self.ff.maxframe == self.ff_frame)
+        frame[indices] = self.ff.maxpixel[indices]
+
+        self.ff_frame += 1
+
+        return frame
+
+
+
+
+class VidReplaySource(FrameSource):
+    """ Replays frames from a UWO .vid file. The frames are scaled to 8 bits. """
+
+    def __init__(self, file_path, fps, real_time=True):
+        """
+        Arguments:
+            file_path: [str] Path to the .vid file.
+            fps: [float] Frames per second, used for the real time replay.
+
+        Keyword arguments:
+            real_time: [bool] If True, the frames will be given at the rate given by the FPS. True by default.
+
+        """
+
+        super(VidReplaySource, self).__init__(fps, real_time=real_time)
+
+        self.vid = VidStruct()
+        self.vid_file = open(file_path, 'rb')
+
+
+
+    def nextFrame(self):
+
+        frame = readVidFrame(self.vid, self.vid_file)
+
+        if frame is None:
+            return None
+
+        # The .vid frames are stored in the big-endian byte order
+        frame = frame.byteswap()
+
+        # Scale the frame to 8 bits
+        if self.vid.depth > 8:
+            frame = frame >> (self.vid.depth - 8)
+
+        return np.clip(frame, 0, 255).astype(np.uint8)
+
+
+
+    def release(self):
+
+        super(VidReplaySource, self).release()
+        self.vid_file.close()
+
+
+
+
+class SyntheticSource(FrameSource):
+    """ Deterministic synthetic camera which generates a star field with Gaussian noise and meteors.
+
+        The meteors follow the model used in Tests/CompressSimulatedMeteor.py: a Gaussian PSF moving along a
+        straight line, with a parabolic intensity profile. All random values are drawn from a generator with
+        the given seed, so the same seed always produces the same frames. The noise is drawn from a pool of
+        precomputed noise images, so the generator is fast enough to run the capture at high frame rates.
+    """
+
+    def __init__(self, width, height, fps, real_time=False, seed=0, stars_num=200, meteor_interval=100,
+        noise_sigma=7.0, background=30, frames_num=None):
+        """
+        Arguments:
+            width: [int] Width of the frames.
+            height: [int] Height of the frames.
+            fps: [float] Frames per second.
+
+        Keyword arguments:
+            real_time: [bool] If True, the frames will be given at the rate given by the FPS. False by default.
+            seed: [int] Seed of the random generator. 0 by default.
+            stars_num: [int] Number of stars in the field. 200 by default.
+            meteor_interval: [int] Average number of frames between meteors. 100 by default.
+            noise_sigma: [float] Standard deviation of the Gaussian noise. 7 by default.
+            background: [int] Constant background level. 30 by default.
+            frames_num: [int] Total number of frames to generate. None by default, which will generate
+                frames until the source is released.
+
+        """
+
+        super(SyntheticSource, self).__init__(fps, real_time=real_time)
+
+        self.width = width
+        self.height = height
+        self.meteor_interval = meteor_interval
+        self.frames_num = frames_num
+
+        self.random_state = np.random.RandomState(seed)
+
+
+        # Generate the static star field
+        star_field = np.zeros((height, width), dtype=np.float64) + background
+
+        for i in range(stars_num):
+
+            x = self.random_state.uniform(0, width)
+            y = self.random_state.uniform(0, height)
+            amplitude = self.random_state.uniform(10, 200)
+            sigma = self.random_state.uniform(1.0, 2.0)
+
+            self.addGaussian(star_field, x, y, amplitude, sigma)
+
+        self.star_field = np.clip(star_field, 0, 255).astype(np.uint8)
+
+
+        # Precompute a pool of noise images
+        self.noise_pool = [np.clip(np.abs(self.random_state.normal(0, noise_sigma, (height, width))), 0, 255)\
+            .astype(np.uint8) for i in range(8)]
+
+
+        # Meteors which are currently visible, and the frame when the next meteor will appear
+        self.meteors = []
+        self.next_meteor = self.random_state.randint(0, meteor_interval + 1)
+
+        self.generated = 0
+
+        self.frame_buffer = np.empty((height, width), dtype=np.uint8)
+
+
+
+    @staticmethod
+    def addGaussian(img, x, y, amplitude, sigma):
+        """ Add a 2D Gaussian to the image, in place. Only the neighbourhood of the Gaussian is computed.
+
+        Arguments:
+            img: [2D ndarray] Float image.
+            x: [float] X coordinate of the centre.
+            y: [float] Y coordinate of the centre.
+            amplitude: [float] Peak value.
+            sigma: [float] Standard deviation in pixels.
+        """
+
+        radius = int(np.ceil(4*sigma))
+
+        x_min, x_max = max(0, int(x) - radius), min(img.shape[1], int(x) + radius + 1)
+        y_min, y_max = max(0, int(y) - radius), min(img.shape[0], int(y) + radius + 1)
+
+        if (x_min >= x_max) or (y_min >= y_max):
+            return
+
+        y_ind, x_ind = np.mgrid[y_min:y_max, x_min:x_max]
+
+        img[y_min:y_max, x_min:x_max] += amplitude*np.exp(-((x_ind - x)**2 + (y_ind - y)**2)/(2*sigma**2))
+
+
+
+    def nextFrame(self):
+
+        if (self.frames_num is not None) and (self.generated >= self.frames_num):
+            return None
+
+
+        # Start a new meteor
+        if self.generated >= self.next_meteor:
+
+            duration = self.random_state.randint(10, 60)
+            speed = self.random_state.uniform(2, 15)
+            angle = self.random_state.uniform(0, 2*np.pi)
+
+            self.meteors.append({
+                'start': self.generated,
+                'duration': duration,
+                'x': self.random_state.uniform(0, self.width),
+                'y': self.random_state.uniform(0, self.height),
+                'dx': speed*np.cos(angle),
+                'dy': speed*np.sin(angle),
+                'peak': self.random_state.uniform(60, 255),
+                'sigma': self.random_state.uniform(1.0, 2.5)
+                })
+
+            self.next_meteor = self.generated + self.random_state.randint(self.meteor_interval//2,
+                3*self.meteor_interval//2 + 1)
+
+
+        # Add the noise to the star field
+        frame = self.frame_buffer
+        cv2.add(self.star_field, self.noise_pool[self.generated%len(self.noise_pool)], dst=frame)
+
+
+        # Draw the visible meteors
+        for meteor in list(self.meteors):
+
+            t = self.generated - meteor['start']
+
+            if t >= meteor['duration']:
+                self.meteors.remove(meteor)
+                continue
+
+            # Parabolic intensity profile
+            intensity = meteor['peak']*(1.0 - (2.0*t/meteor['duration'] - 1.0)**2)
+
+            x = meteor['x'] + meteor['dx']*t
+            y = meteor['y'] + meteor['dy']*t
+
+            radius = int(np.ceil(4*meteor['sigma']))
+            x_min, x_max = max(0, int(x) - radius), min(self.width, int(x) + radius + 1)
+            y_min, y_max = max(0, int(y) - radius), min(self.height, int(y) + radius + 1)
+
+            if (x_min >= x_max) or (y_min >= y_max):
+                continue
+
+            # Add the meteor PSF to the frame, saturating at 255
+            segment = frame[y_min:y_max, x_min:x_max].astype(np.float64)
+            self.addGaussian(segment, x - x_min, y - y_min, intensity, meteor['sigma'])
+            frame[y_min:y_max, x_min:x_max] = np.clip(segment, 0, 255).astype(np.uint8)
+
+
+        self.generated += 1
+
+        return frame
+
+
+
+
+def openFrameSource(config, source):
+    """ Open the frame source given by the name or the path.
+
+    Arguments:
+        config: [Config object] Configuration.
+        source: [str] Either 'synthetic' for the synthetic camera (optionally followed by the seed, e.g.
+            'synthetic:5'), a path to a directory with FF files, an FF file, a .vid file or a video file.
+
+    Return:
+        [FrameSource object]
+    """
+
+    real_time = config.replay_real_time
+
+    # Synthetic camera
+    if source.startswith('synthetic'):
+
+        seed = 0
+        if ':' in source:
+            seed = int(source.split(':')[1])
+
+        log.info('Using the synthetic camera with seed {:d}'.format(seed))
+
+        return SyntheticSource(config.width, config.height, config.fps, real_time=real_time, seed=seed)
+
+
+    # FF files
+    if os.path.isdir(source) or validFFName(os.path.basename(source)):
+        log.info('Replaying FF files from: ' + source)
+        return FFReplaySource(source, config.fps, real_time=real_time)
+
+
+    # UWO .vid file
+    if source.lower().endswith('.vid'):
+        log.info('Replaying the vid file: ' + source)
+        return VidReplaySource(source, config.fps, real_time=real_time)
+
+
+    # Any other video file
+    log.info('Replaying the video file: ' + source)
+    return VideoFileSource(source, config.fps, real_time=real_time)
@@ -0,0 +1,360 @@
+""" Timers, counters and gauges for profiling the pipeline stages.
+
+    Every process accumulates its own values in memory, without any locks or inter-process communication,
+    and periodically writes them to a file. The values are cumulative since the start of the process.
+    Two output formats are supported:
+        - 'prom' - Prometheus text format, one file per process which is rewritten on every flush. The
+            directory can be given to the node exporter textfile collector.
+        - 'jsonl' - JSON lines, the values of every process are appended as one line on every flush. A new
+            file is started every day (UTC).
+
+    Usage:
+
+        Metrics.configure(config)
+
+        with Metrics.timer('compression'):
+            compress(frames)
+
+        @Metrics.timer('detection')
+        def detect(...):
+            ...
+
+        Metrics.increment('capture_dropped_frames', n_dropped)
+        Metrics.setGauge('extractor_backlog', backlog)
+
+"""
+
+from __future__ import print_function, division, absolute_import
+
+import os
+import re
+import json
+import time
+import logging
+import functools
+import multiprocessing
+
+
+# Get the logger from the main module
+log = logging.getLogger("logger")
+
+
+
+class MetricsAccumulator(object):
+    """ Values of all metrics of one process. """
+
+    def __init__(self):
+
+        self.pid = os.getpid()
+
+        # Timers hold [count, sum, min, max] of durations in seconds
+        self.timers = {}
+        self.counters = {}
+        self.gauges = {}
+
+        self.last_flush = time.time()
+
+
+
+    def addTime(self, name, dt):
+        """ Add one duration to the timer.
+
+        Arguments:
+            name: [str] Name of the timer.
+            dt: [float] Duration in seconds.
+        """
+
+        timer = self.timers.get(name)
+
+        if timer is None:
+            self.timers[name] = [1, dt, dt, dt]
+
+        else:
+            timer[0] += 1
+            timer[1] += dt
+
+            if dt < timer[2]:
+                timer[2] = dt
+
+            if dt > timer[3]:
+                timer[3] = dt
+
+
+
+    def increment(self, name, value=1):
+        """ Increase the counter by the given value. """
+
+        self.counters[name] = self.counters.get(name, 0) + value
+
+
+
+    def setGauge(self, name, value):
+        """ Set the current value of the gauge. """
+
+        self.gauges[name] = value
+
+
+
+    def snapshot(self):
+        """ Return the current values of all metrics as a dictionary. """
+
+        return {
+            'timers': {name: {'count': t[0], 'sum': t[1], 'min': t[2], 'max': t[3]} for name, t \
+                in self.timers.items()},
+            'counters': dict(self.counters),
+            'gauges': dict(self.gauges)
+            }
+
+
+
+# Output settings, inherited by the child processes
+_settings = {'dir_path': None, 'format': 'prom', 'flush_interval': 60.0}
+
+# Metrics of the current process
+_accumulator = MetricsAccumulator()
+
+
+
+def _getAccumulator():
+    """ Return the accumulator of the current process. A forked process starts with empty values, so the
+        values of the parent process are not reported twice.
+    """
+
+    global _accumulator
+
+    if _accumulator.pid != os.getpid():
+        _accumulator = MetricsAccumulator()
+
+    return _accumulator
+
+
+
+def configure(config):
+    """ Set up the output of metrics. Has to be called before the worker processes are started, so they
+        inherit the settings. Prometheus files left over from earlier runs are removed, as the processes of
+        this run will have different names.
+
+    Arguments:
+        config: [Config object] Configuration, the metrics options are taken from it.
+
+    """
+
+    if not config.metrics_enabled:
+        _settings['dir_path'] = None
+        return
+
+
+    # The metrics directory is relative to the data directory, unless an absolute path is given
+    dir_path = os.path.join(os.path.abspath(config.data_dir), os.path.expanduser(config.metrics_dir))
+
+    if not os.path.exists(dir_path):
+        os.makedirs(dir_path)
+
+
+    for file_name in os.listdir(dir_path):
+        if file_name.startswith('rms_') and file_name.endswith('.prom'):
+            os.remove(os.path.join(dir_path, file_name))
+
+
+    _settings['dir_path'] = dir_path
+    _settings['format'] = config.metrics_format
+    _settings['flush_interval'] = config.metrics_flush_interval
+
+    log.info('Saving metrics to: {:s}'.format(dir_path))
+
+
+
+def addTime(name, dt):
+    """ Add one duration in seconds to the timer with the given name. """
+
+    accumulator = _getAccumulator()
+    accumulator.addTime(name, dt)
+
+    _checkFlush(accumulator)
+
+
+
+def increment(name, value=1):
+    """ Increase the counter with the given name. """
+
+    accumulator = _getAccumulator()
+    accumulator.increment(name, value)
+
+    _checkFlush(accumulator)
+
+
+
+def setGauge(name, value):
+    """ Set the current value of the gauge with the given name. """
+
+    accumulator = _getAccumulator()
+    accumulator.setGauge(name, value)
+
+    _checkFlush(accumulator)
+
+
+
+def snapshot():
+    """ Return the current values of all metrics of this process. """
+
+    return _getAccumulator().snapshot()
+
+
+
+class timer(object):
+    """ Measures the duration of a block of code when used as a context manager, or the duration of every
+        call when used as a function decorator.
+    """
+
+    def __init__(self, name):
+        """
+        Arguments:
+            name: [str] Name of the timer.
+        """
+
+        self.name = name
+        self.t1 = None
+
+
+    def __enter__(self):
+
+        self.t1 = time.time()
+
+        return self
+
+
+    def __exit__(self, exc_type, exc_value, traceback):
+
+        addTime(self.name, time.time() - self.t1)
+
+        return False
+
+
+    def __call__(self, func):
+
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+
+            t1 = time.time()
+
+            try:
+                return func(*args, **kwargs)
+
+            finally:
+                addTime(self.name, time.time() - t1)
+
+        return wrapper
+
+
+
+def _checkFlush(accumulator):
+    """ Flush the metrics if the flush interval has passed since the last flush. """
+
+    if _settings['dir_path'] is None:
+        return
+
+    if (time.time() - accumulator.last_flush) >= _settings['flush_interval']:
+        flush()
+
+
+
+def _processName():
+    """ Return the name of the current process which can be used in file names. """
+
+    return re.sub(r'[^A-Za-z0-9_\-]', '_', multiprocessing.current_process().name)
+
+
+
+def toPrometheus(values, process_name):
+    """ Format the metrics in the Prometheus text format.
+
+    Arguments:
+        values: [dict] Metrics, as returned by snapshot().
+        process_name: [str] Name of the process, given as a label.
+
+    Return:
+        [str] Text which can be read by the Prometheus node exporter.
+    """
+
+    label = '{{process="{:s}"}}'.format(process_name)
+
+    lines = []
+
+    for name, t in sorted(values['timers'].items()):
+
+        metric = 'rms_{:s}_seconds'.format(name)
+
+        lines.append('# TYPE {:s} summary'.format(metric))
+        lines.append('{:s}_count{:s} {:d}'.format(metric, label, t['count']))
+        lines.append('{:s}_sum{:s} {:.6f}'.format(metric, label, t['sum']))
+
+        lines.append('# TYPE {:s}_max gauge'.format(metric))
+        lines.append('{:s}_max{:s} {:.6f}'.format(metric, label, t['max']))
+
+
+    for name, value in sorted(values['counters'].items()):
+
+        metric = 'rms_{:s}_total'.format(name)
+
+        lines.append('# TYPE {:s} counter'.format(metric))
+        lines.append('{:s}{:s} {:s}'.format(metric, label, repr(value)))
+
+
+    for name, value in sorted(values['gauges'].items()):
+
+        metric = 'rms_{:s}'.format(name)
+
+        lines.append('# TYPE {:s} gauge'.format(metric))
+        lines.append('{:s}{:s} {:s}'.format(metric, label, repr(value)))
+
+
+    return '\n'.join(lines) + '\n'
+
+
+
+def flush():
+    """ Write the metrics of this process to the metrics directory. Nothing is done if the metrics were not
+        configured.
+    """
+
+    accumulator = _getAccumulator()
+    accumulator.last_flush = time.time()
+
+    dir_path = _settings['dir_path']
+
+    if dir_path is None:
+        return
+
+
+    values = accumulator.snapshot()
+    process_name = _processName()
+
+    try:
+
+        if _settings['format'] == 'jsonl':
+
+            values['time'] = accumulator.last_flush
+            values['process'] = process_name
+            values['pid'] = accumulator.pid
+
+            # A single write of one line, so the lines of different processes are not mixed
+            file_name = 'rms_metrics_' + time.strftime('%Y%m%d', time.gmtime(accumulator.last_flush)) \
+                + '.jsonl'
+
+            with open(os.path.join(dir_path, file_name), 'a') as f:
+                f.write(json.dumps(values, sort_keys=True) + '\n')
+
+
+        else:
+
+            file_path = os.path.join(dir_path, 'rms_{:s}.prom'.format(process_name))
+
+            # Write to a temporary file first, so the collector never reads a partially written file
+            with open(file_path + '.tmp', 'w') as f:
+                f.write(toPrometheus(values, process_name))
+
+            os.rename(file_path + '.tmp', file_path)
+
+
+    except (IOError, OSError) as e:
+        log.warning('Saving metrics failed: {:s}'.format(str(e)))
@@ -1,71 +1,255 @@
 from __future__ import print_function
 
 import os
+import sys
+import pickle
+import hashlib
 import logging
+import sqlite3
 import traceback
 import time
 import functools
 import multiprocessing
 import multiprocessing.dummy
 
-from RMS.Pickling import savePickle, loadPickle
-from RMS.Misc import randomCharacters, isListKeyInDict, listToTupleRecursive
+try:
+    # Python 2
+    from Queue import Empty
 
+except:
+    # Python 3
+    from queue import Empty
+
+import numpy as np
+
+from RMS import Metrics
+from RMS.Pickling import loadPickle
+
+
+# Python 2 and 3 compatible string types
+try:
+    STRING_TYPES = (str, unicode)
+
+except NameError:
+    STRING_TYPES = (str, )
+
+
+def _hashObject(h, obj):
+    """ Update the hash with the contents of the given object. Lists, tuples, dictionaries, numpy arrays and
+        objects with attributes (e.g. the config or the flat structure) are hashed by their contents.
+
+    Arguments:
+        h: [hashlib hash object] Hash which will be updated.
+        obj: [object] Object to hash.
 
-class SafeValue(object):
-    """ Thread safe value. Uses locks. 
-    
-    Source: http://eli.thegreenplace.net/2012/01/04/shared-counter-with-pythons-multiprocessing
     """
 
-    def __init__(self, initval=0):
-        self.val = multiprocessing.Value('i', initval)
-        self.lock = multiprocessing.Lock()
+    # Include the type, so e.g. 1 and '1' are different
+    h.update(type(obj).__name__.encode('utf-8'))
+
+    if isinstance(obj, (list, tuple)):
+
+        h.update(str(len(obj)).encode('utf-8'))
+
+        for elem in obj:
+            _hashObject(h, elem)
+
+
+    elif isinstance(obj, dict):
+
+        for key in sorted(obj, key=repr):
+            _hashObject(h, key)
+            _hashObject(h, obj[key])
+
+
+    elif isinstance(obj, np.ndarray):
+
+        h.update(str(obj.dtype).encode('utf-8'))
+        h.update(str(obj.shape).encode('utf-8'))
+        h.update(np.ascontiguousarray(obj).tobytes())
+
+
+    elif hasattr(obj, '__dict__') and not callable(obj):
+        _hashObject(h, vars(obj))
+
+
+    else:
+        h.update(repr(obj).encode('utf-8'))
+
+
+
+def inputFingerprint(inputs):
+    """ Compute a stable fingerprint of the inputs of the worker function, which is used as the key of the
+        stored results. 
+        
+        Strings which are paths to files, either alone or joined to the directory given in the previous 
+        input, also include the size and the modification time of the file, so the results are computed 
+        again if the file has changed.
+
+    Arguments:
+        inputs: [list] Arguments of the worker function.
+
+    Return:
+        [str] Hexadecimal SHA-1 digest of the inputs.
+    """
+
+    h = hashlib.sha1()
+
+    for i, arg in enumerate(inputs):
+
+        _hashObject(h, arg)
+
+        if isinstance(arg, STRING_TYPES):
+
+            file_paths = [arg]
+
+            if (i > 0) and isinstance(inputs[i - 1], STRING_TYPES):
+                file_paths.append(os.path.join(inputs[i - 1], arg))
+
+            for file_path in file_paths:
+                if os.path.isfile(file_path):
+                    stat = os.stat(file_path)
+                    h.update('{:d}_{:.6f}'.format(stat.st_size, stat.st_mtime).encode('utf-8'))
+
+
+    return h.hexdigest()
+
+
+
+class ResultStore(object):
+    def __init__(self, file_path):
+        """ Results of the worker function stored in a single SQLite file and keyed by the fingerprint of
+            the inputs, so looking up a result is a single indexed query. Every process opens its own
+            connection, and SQLite handles concurrent writes from multiple workers.
+
+        Arguments:
+            file_path: [str] Path to the database file.
+
+        """
+
+        self.file_path = file_path
+
+        self.conn = None
+        self.pid = None
+
+        # Create the table if it does not exist
+        self._connect()
+
+
+
+    def _connect(self):
+        """ Return the connection to the database, opening a new one in a new process. """
+
+        if (self.conn is None) or (self.pid != os.getpid()):
 
+            self.conn = sqlite3.connect(self.file_path, timeout=60)
+            self.pid = os.getpid()
 
-    def increment(self):
-        with self.lock:
-            self.val.value += 1
+            self.conn.execute("CREATE TABLE IF NOT EXISTS results (key TEXT PRIMARY KEY, outputs BLOB)")
+            self.conn.commit()
 
+        return self.conn
 
-    def decrement(self):
-        with self.lock:
-            self.val.value -= 1
 
 
-    def set(self, n):
-        with self.lock:
-            self.val.value = n
+    def __getstate__(self):
 
+        # The connection cannot be pickled, a new one is opened in the process which unpickles the store
+        state = self.__dict__.copy()
+        state['conn'] = None
+        state['pid'] = None
 
-    def value(self):
-        with self.lock:
-            return self.val.value
+        return state
+
+
+
+    def get(self, key):
+        """ Look up the stored result.
+
+        Arguments:
+            key: [str] Fingerprint of the inputs.
+
+        Return:
+            (status, outputs): [tuple] True and the stored outputs if the result was found, False and None
+                otherwise.
+        """
+
+        row = self._connect().execute("SELECT outputs FROM results WHERE key = ?", (key, )).fetchone()
+
+        if row is None:
+            return False, None
+
+        try:
+            if sys.version_info[0] < 3:
+                return True, pickle.loads(bytes(row[0]))
+
+            else:
+                return True, pickle.loads(bytes(row[0]), encoding='latin1')
+
+        except Exception:
+            return False, None
+
+
+
+    def put(self, key, outputs):
+        """ Store the result.
+
+        Arguments:
+            key: [str] Fingerprint of the inputs.
+            outputs: [object] Outputs of the worker function.
+
+        """
+
+        conn = self._connect()
+        conn.execute("INSERT OR REPLACE INTO results (key, outputs) VALUES (?, ?)", \
+            (key, sqlite3.Binary(pickle.dumps(outputs, protocol=2))))
+        conn.commit()
+
+
+
+    def __len__(self):
+
+        return self._connect().execute("SELECT COUNT(*) FROM results").fetchone()[0]
+
+
+
+    def close(self):
+        """ Close the connection of this process. """
+
+        if (self.conn is not None) and (self.pid == os.getpid()):
+            self.conn.close()
+
+        self.conn = None
+        self.pid = None
 
 
 
 class BackupContainer(object):
     def __init__(self, inputs, outputs):
-        """ Container for storing the inputs and outputs of a certain worker function. This container is 
-            saved to disk when the worker function finishes, and can be later restored. 
+        """ Container of the inputs and outputs of the worker function. Older versions saved every result
+            in this container to a separate pickle file, the class is kept so these files can be loaded and
+            imported into the result store.
         """
 
-        # Take the input list a tuple, as it has to be imutable to be a dictionary key
-        self.inputs = listToTupleRecursive(inputs)
+        self.inputs = inputs
 
         self.outputs = outputs
 
 
 
 class QueuedPool(object):
-    def __init__(self, func, cores=None, log=None, delay_start=0, worker_timeout=2000, backup_dir='.'):
+    def __init__(self, func, cores=None, log=None, delay_start=0, worker_timeout=2000, backup_dir='.', 
+        func_extra_args=None, func_kwargs=None):
         """ Provides capability of creating a pool of workers which will process jobs in a given queue, and 
-        the input queue can be updated in another thread. 
+        the input queue can be updated in another thread or process. 
 
         The workers will process the queue until the pool is deliberately closed. All results are stored in an 
         output queue. It is also possible to change the number of workers in a pool during runtime.
 
-        The default worker timeout time is 1000 seconds.
+        The jobs and the results are sent through pipes directly between the processes, and the workers are
+        woken up by the arriving jobs, so there are no manager processes and no polling.
+
+        The default worker timeout time is 2000 seconds.
 
         Arguments:
             func: [function] Worker function to which the arguments from the queue will be passed
@@ -78,6 +262,11 @@ class QueuedPool(object):
             worker_timeout: [int] Number of seconds to wait before the queue is killed due to a worker getting 
                 stuck.
             backup_dir: [str] Path to the directory where result backups will be held.
+            func_extra_args: [list] Arguments which are appended to the arguments of every job. They are 
+                given to the workers only once when they are started, so large objects (e.g. the config
+                or the flat field) do not have to be sent with every job. None by default.
+            func_kwargs: [dict] Keyword arguments given to the worker function in every job, sent to the
+                workers only once as well. None by default.
 
         """
 
@@ -99,41 +288,79 @@ class QueuedPool(object):
                 cores = multiprocessing.cpu_count()
 
 
-        self.cores = SafeValue(cores)
+        self.cores = cores
         self.log = log
 
         self.start_time = time.time()
         self.delay_start = delay_start
         self.worker_timeout = worker_timeout
 
-        # Initialize queues (for some reason queues from Manager need to be created, otherwise they are 
-        # blocking when using get_nowait)
-        manager = multiprocessing.Manager()
-        self.input_queue = manager.Queue()
-        self.output_queue = manager.Queue()
+        # Jobs are sent to the workers in batches, every element of the input queue is a list of jobs
+        self.input_queue = multiprocessing.Queue()
+        self.output_queue = multiprocessing.Queue()
 
         self.func = func
-        self.pool = None
+        self.func_extra_args = list(func_extra_args) if func_extra_args is not None else []
+        self.func_kwargs = dict(func_kwargs) if func_kwargs is not None else {}
+
+        self.workers = []
 
-        self.total_jobs = SafeValue()
-        self.results_counter = SafeValue()
-        self.active_workers = SafeValue()
+
+        # Job counters, shared between all processes which add jobs and the workers. They are only changed
+        # while holding the lock
+        self.counter_lock = multiprocessing.Lock()
+        self.total_jobs = multiprocessing.Value('i', 0, lock=False)
+        self.results_counter = multiprocessing.Value('i', 0, lock=False)
+
+        # Number of running workers and the number of workers which should be running
+        self.active_workers = multiprocessing.Value('i', 0, lock=False)
+        self.target_workers = multiprocessing.Value('i', cores, lock=False)
+
+        # Set when the results of all added jobs are available
+        self.all_done = multiprocessing.Event()
+        self.all_done.set()
+
+        # Set when the workers should exit
         self.kill_workers = multiprocessing.Event()
 
+        # Results taken from the output queue which were not yet returned by getResults
+        self.results = []
+        self.results_collected = 0
+
 
         ### Backing up results
 
         self.bkup_dir = backup_dir
+        self.bkup_file_name = 'rms_queue_results.sqlite'
+
+        # Prefix and extension of the backup files of older versions, which stored every result in a 
+        # separate pickle file
         self.bkup_file_prefix = 'rms_queue_bkup_'
         self.bkup_file_extension = '.pickle'
-        self.bkup_dict = {}
 
-        # Load all previous backup files in the given directory, if any
-        self.loadBackupFiles()
+        # Open the results of previous runs in the given directory, if any
+        self.result_store = ResultStore(os.path.join(self.bkup_dir, self.bkup_file_name))
+
+        # Import the results backed up by older versions, so they are not lost when resuming a night
+        self._importBackupFiles()
+
+        # Print and log how many previous results are available
+        self.printAndLog("Loaded {:d} backed up results...".format(len(self.result_store)))
 
         ### ###
 
 
+    def __getstate__(self):
+
+        # The worker processes and the collected results stay in the process which owns the pool
+        state = self.__dict__.copy()
+        state['workers'] = []
+        state['results'] = []
+
+        return state
+
+
+
     def printAndLog(self, *args):
         """ Print and log the given message. """
 
@@ -144,25 +371,9 @@ class QueuedPool(object):
             self.log.info(message)
 
 
-    def saveBackupFile(self, inputs, outputs):
-        """ Save the pair of inputs and outputs to disk, so if the script breaks, previous results can be
-            loaded in and processing can continue from that point.
-        """
-
-        # Create a backup object
-        bkup_obj = BackupContainer(inputs, outputs)
-
-        # Create a name for the backup file
-        bkup_file_name = self.bkup_file_prefix + str(self.results_counter.value()) + "_" + randomCharacters(9) \
-            + self.bkup_file_extension
-
-        # Save the backup to disk
-        savePickle(bkup_obj, self.bkup_dir, bkup_file_name)
-
-
 
     def _listBackupFiles(self):
-        """ Returns a list of all backup files in the backup folder. """
+        """ Returns a list of all backup files of older versions in the backup folder. """
 
         bkup_file_list = []
 
@@ -177,115 +388,189 @@ class QueuedPool(object):
 
 
 
-    def loadBackupFiles(self):
-        """ Load previous backup files. """
+    def _importBackupFiles(self):
+        """ Import the results which older versions backed up in separate pickle files into the result 
+            store, and delete the pickle files.
+        """
+
+        # Older versions passed the extra arguments and the keyword arguments as the last arguments of 
+        # every job. The results are keyed by the current extra arguments, as the worker does
+        extra_args_num = len(self.func_extra_args) + len(self.func_kwargs)
+        extra_args_key = inputFingerprint(self.func_extra_args + [self.func_kwargs])
+
+        imported = 0
 
-        # Load all backup files in a dictionary
         for file_name in self._listBackupFiles():
 
-            # Load the backup file
-            bkup_obj = loadPickle(self.bkup_dir, file_name)
+            try:
+                bkup_obj = loadPickle(self.bkup_dir, file_name)
 
-            if bkup_obj is None:
-                continue
+            except Exception:
+                bkup_obj = None
 
-            # Get the inputs
-            bkup_inputs = listToTupleRecursive(bkup_obj.inputs)
+            if (bkup_obj is not None) and (len(bkup_obj.inputs) > extra_args_num):
 
-            # Make sure the value-key pair does not exist
-            key_status, _ = isListKeyInDict(bkup_inputs, self.bkup_dict)
-            if not key_status:
+                job_args = list(bkup_obj.inputs[:len(bkup_obj.inputs) - extra_args_num])
 
-                # Add the pair of inputs vs. outputs to the lookup dictionary
-                self.bkup_dict[bkup_inputs] = bkup_obj.outputs
+                self.result_store.put(inputFingerprint(job_args + [extra_args_key]), bkup_obj.outputs)
 
+                imported += 1
+
+            else:
+                self.printAndLog('The backup file could not be imported: {:s}'.format(file_name))
 
-        # Print and log how many previous files have been loaded
-        print_str = "Loaded {:d} backed up results...".format(len(self.bkup_dict))
-        self.printAndLog(print_str)
+
+            os.remove(os.path.join(self.bkup_dir, file_name))
+
+
+        if imported:
+            self.printAndLog("Imported {:d} results backed up by an older version...".format(imported))
 
 
 
     def deleteBackupFiles(self):
-        """ Delete all backup files in the backup folder. """
+        """ Delete all backed up results in the backup folder. """
 
-        # Go though all backup files
-        for file_name in self._listBackupFiles():
+        self.result_store.close()
+
+        bkup_file_path = os.path.join(self.bkup_dir, self.bkup_file_name)
+
+        if os.path.isfile(bkup_file_path):
+            os.remove(bkup_file_path)
 
-            # Remove the backup file
+
+        # Remove the backup files of older versions
+        for file_name in self._listBackupFiles():
             os.remove(os.path.join(self.bkup_dir, file_name))
 
 
 
-    def _workerFunc(self, func):
-        """ A wrapper function for the given worker function. Handles the queue operations. """
+    def _workerFunc(self):
+        """ The worker process. Takes the batches of jobs from the input queue, runs the worker function and
+            puts the results to the output queue. 
+        """
         
 
-        # Wait until delay has passed
-        while (self.start_time + self.delay_start) > time.time():
-            time.sleep(0.1)
+        # Wait until delay has passed, or until the workers are killed
+        delay = self.start_time + self.delay_start - time.time()
+        if (delay > 0) and self.kill_workers.wait(delay):
+            return
 
-        self.active_workers.increment()
+        with self.counter_lock:
+            self.active_workers.value += 1
+
+        active = True
+
+        # Compute the fingerprint of the arguments which are the same for every job only once
+        extra_args_key = inputFingerprint(self.func_extra_args + [self.func_kwargs])
 
         while True:
 
-            # Get the function arguments (block until available)
-            args = self.input_queue.get(True)
+            # Get the batch of jobs (block until available)
+            jobs = self.input_queue.get(True)
 
             # The 'poison pill' for killing the worker when closing is requested
-            if args is None:
+            if jobs is None:
                 break
 
-            # First do a lookup in the dictionary if this set of inputs have already been processed
-            read_from_backup = False
-            args_tpl = listToTupleRecursive(args)
 
-            # Check if the key exists. Return the found key as object instances might differ
-            key_status, key = isListKeyInDict(args_tpl, self.bkup_dict)
+            for args in jobs:
 
-            if key_status:
+                # First do a lookup in the stored results if this set of inputs have already been processed
+                read_from_backup = False
+                key = inputFingerprint(list(args) + [extra_args_key])
 
-                # Load the results from backup
-                result = self.bkup_dict[key]
+                key_status, result = self.result_store.get(key)
 
-                read_from_backup = True
+                if key_status:
 
-                self.printAndLog('Result loaded from backup for input: {:s}'.format(str(args)))
+                    read_from_backup = True
 
+                    self.printAndLog('Result loaded from backup for input: {:s}'.format(str(args)))
 
-            # Process the inputs if they haven't been processed already
-            else:
 
-                # Catch errors in workers and handle them softly
-                try:
+                # Process the inputs if they haven't been processed already
+                else:
+
+                    # Catch errors in workers and handle them softly
+                    try:
+
+                        # Call the original worker function and collect results
+                        with Metrics.timer('queuedpool_job'):
+                            result = self.func(*(list(args) + self.func_extra_args), **self.func_kwargs)
+
+                    except:
+                        tb = traceback.format_exc()
+
+                        self.printAndLog(tb)
+
+                        result = None
 
-                    # Call the original worker function and collect results
-                    result = func(*args)
 
-                except:
-                    tb = traceback.format_exc()
+                # Back up the result to disk, if it was not already in the backup
+                if not read_from_backup:
+                    self.result_store.put(key, result)
 
-                    self.printAndLog(tb)
 
-                    result = None
+                # Save the results to an output queue
+                self.output_queue.put(result)
 
+                with self.counter_lock:
 
-            # Save the results to an output queue
-            self.output_queue.put(result)
-            self.results_counter.increment()
+                    self.results_counter.value += 1
 
-            time.sleep(0.1)
+                    # Signal that all jobs are done
+                    if self.results_counter.value >= self.total_jobs.value:
+                        self.all_done.set()
 
-            # Back up the result to disk, if it was not already in the backup
-            if not read_from_backup:
-                self.saveBackupFile(args, result)
+                self.reportQueueDepth()
 
-            # Exit if exit is requested
+
+            # Exit if exit is requested, or if there are more workers running than needed
             if self.kill_workers.is_set():
                 self.printAndLog('Worker killed!')
                 break
 
-        self.active_workers.decrement()
+            # The check and the decrement are done under one lock, so only the extra workers exit
+            with self.counter_lock:
+                if self.active_workers.value > self.target_workers.value:
+                    self.active_workers.value -= 1
+                    active = False
+                    break
+
+
+        if active:
+            with self.counter_lock:
+                self.active_workers.value -= 1
+
+        Metrics.flush()
+
+
+
+    def reportQueueDepth(self):
+        """ Report the number of jobs which were added, but whose results are not yet available. """
+
+        Metrics.setGauge('queuedpool_pending_jobs', self.pendingJobs())
+
+
+
+    def pendingJobs(self):
+        """ Return the number of jobs which were added, but whose results are not yet available. """
+
+        return self.total_jobs.value - self.results_counter.value
+
+
+
+    def _startWorkers(self, n):
+        """ Start the given number of worker processes. """
+
+        for i in range(n):
+
+            worker = multiprocessing.Process(target=self._workerFunc)
+            worker.daemon = True
+            worker.start()
+
+            self.workers.append(worker)
 
 
 
@@ -293,166 +578,204 @@ class QueuedPool(object):
         """ Start the pool with the given worker function and number of cores. """
 
         if cores is not None:
-            self.cores.set(cores)
+            self.cores = cores
 
+        self.target_workers.value = self.cores
 
-        self.printAndLog('Using {:d} cores'.format(self.cores.value()))
+        self.printAndLog('Using {:d} cores'.format(self.cores))
 
-        # Initialize the pool of workers with the given number of worker cores
-        # Comma in the argument list is a must!
-        self.pool = multiprocessing.Pool(self.cores.value(), self._workerFunc, (self.func, ))
+        self._startWorkers(self.cores)
 
 
 
-    def closePool(self):
-        """ Wait until all jobs are done and close the pool. """
+    def _collectResults(self, n, timeout=None):
+        """ Take the given number of results from the output queue and store them in the results list. 
+
+        Arguments:
+            n: [int] Number of results to take.
+
+        Keyword arguments:
+            timeout: [float] Time in seconds to wait for every result. None by default, which waits until
+                the result is available.
 
-        if self.pool is not None:
+        Return:
+            [int] Number of results which were taken.
+        """
 
-            c = 0
+        taken = 0
 
-            prev_output_qsize = 0
-            output_qsize_last_change = time.time()
+        while taken < n:
 
-            # Wait until the input queue is empty, then close the pool
-            while True:
+            try:
+                result = self.output_queue.get(True, timeout)
 
-                c += 1
+            except Empty:
+                break
 
-                if c%1000 == 0:
-                    self.printAndLog('-----')
-                    self.printAndLog('Queue size:', self.output_queue.qsize())
-                    self.printAndLog('Total jobs:', self.total_jobs.value())
+            self.results.append(result)
+            self.results_collected += 1
+            taken += 1
 
+        return taken
 
-                # Keep track of the changes of the output queue size
-                if self.output_queue.qsize() != prev_output_qsize:
-                    prev_output_qsize = self.output_queue.qsize()
-                    output_qsize_last_change = time.time()
 
 
-                # If the queue has been idle for too long, kill it
-                if (time.time() - output_qsize_last_change) > self.worker_timeout:
-                    self.printAndLog('One of the workers got stuck longer then {:d} seconds, killing multiprocessing...'.format(self.worker_timeout))
+    def closePool(self):
+        """ Wait until all jobs are done and close the pool. """
+
+        if self.workers:
 
-                    self.printAndLog('Terminating pool...')
-                    self.pool.terminate()
+            prev_results = self.results_counter.value
+            results_last_change = time.time()
 
-                    self.printAndLog('Joining pool...')
-                    self.pool.join()
+            # Wait until all jobs are done
+            while not self.all_done.wait(1.0):
 
-                    self.active_workers.set(0)
+                # Keep track of the processed jobs
+                if self.results_counter.value != prev_results:
+                    prev_results = self.results_counter.value
+                    results_last_change = time.time()
+
+
+                # If the queue has been idle for too long, kill it
+                if (time.time() - results_last_change) > self.worker_timeout:
+                    self.printAndLog('One of the workers got stuck longer then {:d} seconds, killing multiprocessing...'.format(self.worker_timeout))
+
+                    self._terminateWorkers()
 
                     break
 
-                
-                # If all jobs are done, close the pool
-                if self.output_queue.qsize() >= self.total_jobs.value():
 
-                    self.printAndLog('Inserting poison pills...')
+            # Take all results from the output queue, the workers cannot exit before their results are read
+            self._collectResults(self.results_counter.value - self.results_collected, timeout=10)
 
-                    # Insert the 'poison pill' to the queue, to kill all workers
-                    for i in range(self.active_workers.value()):
-                        self.printAndLog('Inserting pill', i + 1)
-                        self.input_queue.put(None)
+            # Stop the workers which are still waiting for the delayed start
+            self.kill_workers.set()
 
 
-                    time.sleep(0.1)
+            self.printAndLog('Inserting poison pills...')
 
+            # Insert the 'poison pill' to the queue, to kill all workers
+            for worker in self.workers:
+                self.input_queue.put(None)
 
-                    # Wait until the pills are 'swallowed'
-                    while self.input_queue.qsize():
-                        self.printAndLog('Swallowing pills...', self.input_queue.qsize())
-                        time.sleep(0.1)
 
+            # Wait for all workers to exit
+            self.printAndLog('Joining pool...')
+            for worker in self.workers:
 
-                    # Close the pool and wait for all threads to terminate
-                    self.printAndLog('Closing pool...')
-                    self.pool.close()
+                worker.join(10)
 
-                    self.printAndLog('Terminating pool...')
-                    self.pool.terminate()
+                if worker.is_alive():
+                    worker.terminate()
+                    worker.join()
 
-                    self.printAndLog('Joining pool...')
-                    self.pool.join()
+            self.workers = []
 
-                    break
 
-                else:
-                    time.sleep(0.1)
 
+    def _terminateWorkers(self):
+        """ Kill all worker processes. """
 
+        self.printAndLog('Terminating pool...')
 
-    def updateCoreNumber(self, cores=None):
-        """ Update the number of cores/workers used by the pool.
+        for worker in self.workers:
+            worker.terminate()
 
-        Arguments:
-            cores: [int] Number of CPU cores to use. None by default.
+        for worker in self.workers:
+            worker.join()
 
-        """
+        self.workers = []
+        self.active_workers.value = 0
 
-        # Kill the workers
-        self.kill_workers.set()
 
-        # Wait until all workers have exited
-        loop_start = time.time()
-        while self.active_workers.value() > 0:
-            self.printAndLog('Active workers:', self.active_workers.value())
-            time.sleep(0.1)
 
-            # Break the loop if waiting for more than 100 s
-            if abs(time.time() - loop_start) > 100:
-                break
+    def updateCoreNumber(self, cores=None):
+        """ Update the number of cores/workers used by the pool. If the number is increased, new workers are
+            started. If it is decreased, the extra workers exit after finishing their current jobs.
 
-        # Join the previous pool
-        self.printAndLog('Closing pool...')
-        self.pool.close()
-        self.printAndLog('Terminating pool...')
-        self.pool.terminate()
-        self.printAndLog('Joining pool...')
-        self.pool.join()
+        Arguments:
+            cores: [int] Number of CPU cores to use. None by default.
 
-        self.kill_workers.clear()
+        """
 
         # If cores were not given, use all available cores
         if cores is None:
             cores = multiprocessing.cpu_count()
 
         self.printAndLog('Setting new number of cores to:', cores)
-        self.cores.set(cores)
 
-        # Init a new pool
-        self.printAndLog('Starting new pool...')
-        self.startPool()
+        # Forget the workers which have already exited
+        self.workers = [worker for worker in self.workers if worker.is_alive()]
 
+        with self.counter_lock:
+            self.target_workers.value = cores
+            new_workers = cores - len(self.workers)
 
+        self.cores = cores
 
-    def addJob(self, job, wait_time=0.05):
+        # Start the additional workers
+        if new_workers > 0:
+            self.printAndLog('Starting {:d} new workers...'.format(new_workers))
+            self._startWorkers(new_workers)
+
+
+
+    def addJob(self, job, wait_time=0):
         """ Add a job to the input queue. Job can be a list of arguments for the worker function. If a list is
             not given, the arguments will be wrapped in the list.
 
+        Keyword arguments:
+            wait_time: [float] Not used, kept for compatibility.
+
         """
 
+        self.addJobs([job])
+
+
+
+    def addJobs(self, jobs, batch_size=None):
+        """ Add a list of jobs to the input queue. The jobs are sent to the workers in batches, which is much
+            faster than sending them one by one.
+
+        Arguments:
+            jobs: [list] A list of jobs, every job is a list of arguments for the worker function.
+
+        Keyword arguments:
+            batch_size: [int] Number of jobs in one batch. None by default, in which case the jobs are split
+                into 4 batches per core, so the work is evenly distributed among the workers.
+
+        """
+
+        jobs = [job if isinstance(job, list) else [job] for job in jobs]
+
+        if not jobs:
+            return
+
+        if batch_size is None:
+            batch_size = int(np.ceil(len(jobs)/(4.0*self.cores)))
+
+        batch_size = max(1, batch_size)
+
+
         # Track the total number of jobs received
-        self.total_jobs.increment()
+        with self.counter_lock:
+            self.total_jobs.value += len(jobs)
+            self.all_done.clear()
+
 
-        if not isinstance(job, list):
-            job = [job]
+        for i in range(0, len(jobs), batch_size):
+            self.input_queue.put(jobs[i:i + batch_size])
 
-        self.input_queue.put(job)
+        self.reportQueueDepth()
 
-        time.sleep(wait_time)
 
 
     def allDone(self):
         """ If all jobs are done, return True.
         """
 
-        if self.output_queue.qsize() == self.total_jobs.value():
-            return True
-
-        else:
-            return False
+        return self.all_done.is_set()
 
 
 
@@ -460,15 +783,11 @@ class QueuedPool(object):
         """ Get the results from the output queue and store them in a list. The output list will be returned. 
         """
 
-        results = []
+        # Take all results which are available
+        self._collectResults(self.results_counter.value - self.results_collected, timeout=1)
 
-        # Get all elements in the output queue
-        if not self.output_queue.empty():
-            while True:
-                try:
-                    results.append(self.output_queue.get_nowait())
-                except:
-                    break
+        results = self.results
+        self.results = []
             
         return results
 
@@ -510,11 +829,7 @@ if __name__ == "__main__":
     workpool = QueuedPool(exampleWorker, cores=1, log=log, worker_timeout=10)
 
     # Give the pool something to do
-    for i in range(1, 3):
-
-        workpool.addJob(["hello", i])
-
-        time.sleep(0.1)
+    workpool.addJobs([["hello", i] for i in range(1, 3)])
 
 
     # Start the pool
@@ -532,7 +847,6 @@ if __name__ == "__main__":
     # Give the pool some more work to do
     for i in range(1, 4):
         workpool.addJob(["test1", i])
-        time.sleep(0.05)
 
 
     workpool.addJob(["long time", 99])
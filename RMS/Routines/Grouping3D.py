@@ -26,11 +26,17 @@ import logging
 log = logging.getLogger("logger")
 
 
+# Seed of the random number generator of the RANSAC line finder, so the same FF file always gives the same
+# lines
+RANSAC_SEED = 0
+
+
 # Cython init
 import pyximport
 pyximport.install(setup_args={'include_dirs':[np.get_include()]})
 
 from RMS.Routines.Grouping3Dcy import find3DLines as find3DLinesCy
+from RMS.Routines.Grouping3Dcy import find3DLinesRANSAC as find3DLinesRANSACCy
 from RMS.Routines.Grouping3Dcy import getAllPoints as getAllPointsCy
 from RMS.Routines.Grouping3Dcy import thresholdAndSubsample as thresholdAndSubsampleCy
 from RMS.Routines.Grouping3Dcy import testPoints as testPointsCy
@@ -100,6 +106,7 @@ def find3DLines(point_list, start_time, config, fireball_detection=True):
             self.min_frames = config.min_frames
             self.line_minimum_frame_range = config.line_minimum_frame_range
             self.line_distance_const = config.line_distance_const
+            self.line_finding_method = config.line_finding_method
 
 
     # Convert the point list to numpy array
@@ -125,12 +132,18 @@ def find3DLines(point_list, start_time, config, fireball_detection=True):
         grouping_config.min_points = config.min_pixels_det
         grouping_config.line_minimum_frame_range = config.line_minimum_frame_range_det
         grouping_config.line_distance_const = config.line_distance_const_det
+        grouping_config.line_finding_method = config.line_finding_method_det
 
         # These parameters are important only in fireball detection, use these values for faint detection
         grouping_config.max_lines = 1
         grouping_config.point_ratio_threshold = 1
 
 
+    # Use RANSAC on large point clouds if it was chosen in the config file
+    if grouping_config.line_finding_method == 'ransac':
+        return find3DLinesRANSACCy(point_list, start_time, grouping_config, get_single, line_list, \
+            seed=RANSAC_SEED)
+
     # Call a fast cython function for finding lines in 3D
     return find3DLinesCy(point_list, start_time, grouping_config, get_single, line_list)
 
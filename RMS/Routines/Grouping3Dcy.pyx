@@ -16,11 +16,26 @@ ctypedef np.uint16_t UINT16_TYPE_t
 UINT8_TYPE = np.uint8
 ctypedef np.uint8_t UINT8_TYPE_t
 
+INT32_TYPE = np.int32
+ctypedef np.int32_t INT32_TYPE_t
+
+INT64_TYPE = np.int64
+ctypedef np.int64_t INT64_TYPE_t
+
 
 # Declare math functions
 cdef extern from "math.h":
     double floor(double)
     double abs(double)
+    double sqrt(double)
+    double log(double)
+
+
+# RANSAC line finder parameters
+RANSAC_CONFIDENCE = 0.999 # probability that at least one sampled pair lies on the best line
+RANSAC_MIN_ITERATIONS = 100 # minimum number of sampled pairs per line
+RANSAC_MAX_ITERATIONS = 5000 # maximum number of sampled pairs per line
+RANSAC_REFINE_ITERATIONS = 10 # how many times the best line is refitted to its points
 
 
 
@@ -84,6 +99,30 @@ cdef int point3DDistance(int x1, int y1, int z1, int x2, int y2, int z2):
 
 
 
+@cython.cdivision(True) # Don't check for zero division
+cdef double line3DDistance_double(double x1, double y1, double z1, double x2, double y2, double z2, double x0, \
+    double y0, double z0):
+    """ Calculate distance from line to a point in 3D, for lines which are not defined by integer points.
+
+    @return: squared distance
+    """
+
+    cdef double dx1 = x0 - x1
+    cdef double dy1 = y0 - y1
+    cdef double dz1 = z0 - z1
+
+    cdef double dx2 = x0 - x2
+    cdef double dy2 = y0 - y2
+    cdef double dz2 = z0 - z2
+
+    cdef double n_len = (dx1*dy2 - dx2*dy1)**2 + (dx2*dz1 - dx1*dz2)**2 + (dy1*dz2 - dy2*dz1)**2
+
+    cdef double d_len = (x2 - x1)**2 + (y2 - y1)**2 + (z2 - z1)**2
+
+    return n_len/d_len
+
+
+
 
 cdef class Line:
     """ Structure that defines a line.
@@ -421,6 +460,318 @@ def find3DLines(np.ndarray[UINT16_TYPE_t, ndim=2] point_list, start_time, config
 
 
 
+@cython.boundscheck(False)
+@cython.wraparound(False)
+cdef int propagateChain(np.ndarray[UINT16_TYPE_t, ndim=2] point_list, int seed, double x1, double y1, double z1, \
+    double x2, double y2, double z2, float distance_threshold, float gap_threshold, \
+    np.ndarray[INT32_TYPE_t, ndim=1] chain, float *line_dist_sum):
+    """ Find the points on the line going through the two given points, starting from the seed point and 
+        going forward and backward in time until the first gap. The points have to be sorted by frame. When 
+        the line goes through the seed point, this gives the same points as getAllPoints.
+
+    Arguments:
+        point_list: [ndarray] list of all points, sorted by frame
+        seed: [int] index of the point the chain starts from
+        x1, y1, z1: [float] first point defining the line
+        x2, y2, z2: [float] second point defining the line
+        distance_threshold: [float] maximum distance between the line and the point to be takes as a part of 
+            the same line
+        gap_threshold: [float] maximum allowed gap between points
+        chain: [ndarray] output array for the indices of points on the line
+        line_dist_sum: [float pointer] output sum of the point distances from the line
+
+    Return:
+        [int] number of points on the line
+    """
+
+    cdef int x3, y3, z3, x_prev, y_prev, z_prev, z, dz, direction
+    cdef int counter = 0
+    cdef int point_list_size = point_list.shape[0]
+    cdef float line_dist
+
+    line_dist_sum[0] = 0
+
+    for direction in (1, -1):
+
+        x_prev = point_list[seed, 0]
+        y_prev = point_list[seed, 1]
+        z_prev = point_list[seed, 2]
+
+        # The forward pass includes the seed point itself
+        if direction == 1:
+            z = seed
+        else:
+            z = seed - 1
+
+        while (z >= 0) and (z < point_list_size):
+
+            x3 = point_list[z, 0]
+            y3 = point_list[z, 1]
+            z3 = point_list[z, 2]
+
+            # Points are sorted by frame, so no further point can be within the gap if this one is too far in 
+            # time
+            dz = z3 - z_prev
+            if dz*dz > gap_threshold:
+                break
+
+            line_dist = line3DDistance_double(x1, y1, z1, x2, y2, z2, x3, y3, z3)
+
+            if line_dist < distance_threshold:
+
+                # Stop at the first point which is too far from the previous point on the line
+                if point3DDistance(x_prev, y_prev, z_prev, x3, y3, z3) > gap_threshold:
+                    break
+
+                chain[counter] = z
+                counter += 1
+                line_dist_sum[0] += line_dist
+
+                x_prev, y_prev, z_prev = x3, y3, z3
+
+            z += direction
+
+
+    return counter
+
+
+
+def _fitLine(np.ndarray[UINT16_TYPE_t, ndim=2] line_points):
+    """ Fit a line in 3D space to the given points by least squares.
+
+    @param line_points: [ndarray] points on the line
+
+    @return: (line_start, line_end): [tuple of ndarrays] centroid of the points, and the point a unit distance 
+        from it along the line
+    """
+
+    line_points_float = line_points.astype(np.float64)
+
+    centroid = np.mean(line_points_float, axis=0)
+
+    # The direction of the line is the principal axis of the points
+    direction = np.linalg.svd(line_points_float - centroid, full_matrices=False)[2][0]
+
+    return centroid, centroid + direction
+
+
+
+
+@cython.boundscheck(False)
+@cython.wraparound(False)
+def find3DLinesRANSAC(np.ndarray[UINT16_TYPE_t, ndim=2] point_list, start_time, config, get_single=False, \
+    line_list=[], seed=None):
+    """ Iteratively find N straight lines in 3D space using RANSAC.
+
+    Instead of testing every pair of points against every point, as find3DLines does, random pairs of points
+    which are close in time are tested. The points are sorted by frame, so the points on a candidate line are 
+    collected by following it in time until the first gap, which only touches the points around the line. 
+    The number of sampled pairs adapts to the share of points on the best line found so far. The best line 
+    is then refitted to its points by least squares and followed again from the first of its points, so a 
+    track is not cut where the sampled pair was. This scales to tens of thousands of points.
+    
+    @param point_list: [ndarray] list of all points
+    @param start_time: [time.time() object] starting time of the loop
+    @param config: [config object] defines configuration parameters fro the config file
+    @param get_single: [bool] returns only 1 line, does not perform recusrive line searching
+    @param line_list: [list] list of lines found previously
+    @param seed: [int] seed of the random number generator (optional)
+    
+    @return: list of found lines
+    """
+
+    # Load config parameters
+    cdef float distance_threshold = config.distance_threshold
+    cdef float gap_threshold = config.gap_threshold
+    cdef int min_points = config.min_points
+    cdef int line_minimum_frame_range = config.line_minimum_frame_range
+    cdef float line_distance_const = config.line_distance_const
+
+    cdef int i, j, k, n, counter, refit_counter, iterations, max_iterations, first, last, refine
+    cdef int best_seed, best_partner, best_counter
+    cdef float line_dist_sum, line_quality, best_quality, line_ratio
+    cdef double inlier_ratio
+
+    cdef np.ndarray[INT32_TYPE_t, ndim=1] chain, refit_chain
+    cdef np.ndarray[INT64_TYPE_t, ndim=1] reach_min, reach_max, seeds
+    cdef np.ndarray[np.float64_t, ndim=1] partners
+    cdef np.ndarray[UINT16_TYPE_t, ndim=2] points
+
+    rng = np.random.RandomState(seed)
+
+    # Largest frame difference two consecutive points on a line can have
+    cdef int frame_reach = int(sqrt(gap_threshold))
+
+    # Sort the points by frame, the lines are followed in time
+    points = np.ascontiguousarray(point_list[np.argsort(point_list[:, 2], kind='mergesort')])
+
+    found_lines = False
+
+    while True:
+
+        # Stop iterating if too many lines
+        if len(line_list) >= config.max_lines:
+            return line_list
+
+        n = points.shape[0]
+
+        if n < min_points:
+            break
+
+        # For every point, find the range of points which are close enough in time to be the next point on the 
+        # line
+        frames = points[:, 2].astype(INT64_TYPE)
+        reach_min = np.searchsorted(frames, frames - frame_reach, side='left').astype(INT64_TYPE)
+        reach_max = np.searchsorted(frames, frames + frame_reach, side='right').astype(INT64_TYPE)
+
+        chain = np.zeros(n, dtype=INT32_TYPE)
+        refit_chain = np.zeros(n, dtype=INT32_TYPE)
+
+        # Draw the random pairs, the second point is taken from the neighbourhood of the first one
+        max_iterations = min(RANSAC_MAX_ITERATIONS, ((<long long> n)*(n - 1))//2)
+        seeds = rng.randint(0, n, size=max_iterations).astype(INT64_TYPE)
+        partners = rng.random_sample(max_iterations)
+
+        best_counter = 0
+        best_quality = 0
+        best_seed = best_partner = -1
+        iterations = max_iterations
+
+        k = 0
+        while k < iterations:
+
+            # Stop iterating if running for too long
+            if (k%64 == 0) and (time() - start_time > config.max_time):
+                if len(line_list) > 0:
+                    return line_list
+                else:
+                    return None
+
+            i = seeds[k]
+            j = reach_min[i] + <int> (partners[k]*(reach_max[i] - reach_min[i]))
+            k += 1
+
+            # Skip pairs which do not define a line or are too far apart
+            if (j == i) or (j >= n):
+                continue
+
+            if point3DDistance(points[i, 0], points[i, 1], points[i, 2], points[j, 0], points[j, 1], \
+                points[j, 2]) > gap_threshold:
+                continue
+
+            if (points[i, 0] == points[j, 0]) and (points[i, 1] == points[j, 1]) \
+                and (points[i, 2] == points[j, 2]):
+                continue
+
+            counter = propagateChain(points, i, points[i, 0], points[i, 1], points[i, 2], points[j, 0], \
+                points[j, 1], points[j, 2], distance_threshold, gap_threshold, chain, &line_dist_sum)
+
+            # Skip if too little points were found
+            if counter < min_points:
+                continue
+
+            # Calculate a parameter for line quality, larger average distance = less quality
+            line_quality = <float> counter - line_distance_const*line_dist_sum/(<float> counter)
+
+            if (best_seed < 0) or (line_quality > best_quality):
+
+                best_quality = line_quality
+                best_counter = counter
+                best_seed = i
+                best_partner = j
+
+                # Reduce the number of iterations to what is needed to find a pair on the line with the given 
+                # confidence
+                inlier_ratio = (<double> counter)/n
+                if inlier_ratio >= 1:
+                    iterations = k
+
+                else:
+                    iterations = int(log(1 - RANSAC_CONFIDENCE)/log(1 - inlier_ratio**2)) + 1
+                    iterations = min(max_iterations, max(RANSAC_MIN_ITERATIONS, iterations))
+
+
+        # Stop if no good line was found
+        if best_seed < 0:
+            break
+
+
+        # Points on the best line
+        counter = propagateChain(points, best_seed, points[best_seed, 0], points[best_seed, 1], \
+            points[best_seed, 2], points[best_partner, 0], points[best_partner, 1], points[best_partner, 2], \
+            distance_threshold, gap_threshold, chain, &line_dist_sum)
+
+        # Refit the line to its points and follow the refitted line from the first of the points, as the chain 
+        # of the sampled pair stops at the first gap around the seed
+        for refine in range(RANSAC_REFINE_ITERATIONS):
+
+            line_start, line_end = _fitLine(points[chain[:counter]])
+
+            first = np.min(chain[:counter])
+
+            refit_counter = propagateChain(points, first, line_start[0], line_start[1], line_start[2], \
+                line_end[0], line_end[1], line_end[2], distance_threshold, gap_threshold, refit_chain, \
+                &line_dist_sum)
+
+            if refit_counter < min_points:
+                break
+
+            line_quality = <float> refit_counter - line_distance_const*line_dist_sum/(<float> refit_counter)
+
+            # Keep the refitted line if it covers more points, even if they are a bit further from the line, or
+            # if it is closer to the points
+            if (refit_counter <= counter) and (line_quality <= best_quality):
+                break
+
+            best_quality = line_quality
+            best_counter = refit_counter
+
+            chain, refit_chain = refit_chain, chain
+            counter = refit_counter
+
+
+        found_lines = True
+
+        # The line is given by the first and the last of its points
+        first = np.min(chain[:counter])
+        last = np.max(chain[:counter])
+
+        max_line = Line(points[first, 0], points[first, 1], points[first, 2], points[last, 0], \
+            points[last, 1], points[last, 2], best_counter, best_quality)
+
+        # Take the points of the best line out of the point cloud
+        line_indices = np.sort(chain[:counter])
+        max_line_points = points[line_indices]
+        points = np.ascontiguousarray(np.delete(points, line_indices, axis=0))
+
+        # Get the first and the last frame from the max_line point could
+        first_frame = max_line_points[0, 2]
+        last_frame = max_line_points[len(max_line_points) - 1, 2]
+
+        # Reject the line if all points are only in very close frames (eliminate flashes):
+        if abs(last_frame - first_frame) + 1 >= line_minimum_frame_range:
+
+            # Add max_line to results, as well as the first and the last frame of a meteor
+            line_list.append(_formatLine(max_line, first_frame, last_frame))
+
+        # Ratio of points on the line and all points
+        line_ratio = (<float> best_counter)/n
+
+        # Stop if only one line was desired, or if most points were on the line
+        if get_single or (line_ratio >= config.point_ratio_threshold):
+            break
+
+
+    # Return empty if no good match was found
+    if not found_lines:
+        return None
+
+    return line_list
+
+
+
+
+
 @cython.boundscheck(False)
 @cython.wraparound(False) 
 @cython.cdivision(True)
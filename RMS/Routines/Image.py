@@ -10,12 +10,54 @@ import scipy.misc
 
 
 
-@np.vectorize
+# Gamma correction lookup tables, cached per gamma, black and white point and image type
+_gamma_luts = {}
+
+
+
+def _gammaCorrectionArray(intensity, gamma, bp, wp):
+    """ Gamma correct an array of intensities, see gammaCorrection. """
+
+    intensity = np.maximum(np.asarray(intensity, dtype=np.float64), 0)
+
+    x = (intensity - bp)/(wp - bp)
+
+    # Compute the corrected intensity, values below the black point are set to the black point
+    return np.where(x > 0, bp + (wp - bp)*(np.maximum(x, 0)**(1.0/gamma)), bp)
+
+
+
+def gammaCorrectionLUT(gamma, bp=0, wp=255, dtype=np.uint8):
+    """ Return the gamma correction lookup table for all values of the given unsigned integer type. The 
+        tables are cached, so they are only computed once per gamma.
+
+    Arguments:
+        gamma: [float] Gamma.
+
+    Keyword arguments:
+        bp: [int] Black point.
+        wp: [int] White point.
+        dtype: [type] Unsigned integer image type, uint8 by default.
+
+    Return:
+        [ndarray] Gamma corrected intensities (float64), indexed by the input intensity.
+    """
+
+    key = (gamma, bp, wp, np.dtype(dtype).str)
+
+    if key not in _gamma_luts:
+        values = np.arange(np.iinfo(dtype).max + 1)
+        _gamma_luts[key] = _gammaCorrectionArray(values, gamma, bp, wp)
+
+    return _gamma_luts[key]
+
+
+
 def gammaCorrection(intensity, gamma, bp=0, wp=255):
     """ Correct the given intensity for gamma. 
         
     Arguments:
-        intensity: [int] Pixel intensity
+        intensity: [int or ndarray] Pixel intensity or an image.
         gamma: [float] Gamma.
 
     Keyword arguments:
@@ -23,21 +65,16 @@ def gammaCorrection(intensity, gamma, bp=0, wp=255):
         wp: [int] White point.
 
     Return:
-        [float] Gamma corrected image intensity.
+        [float or ndarray] Gamma corrected image intensity.
     """
 
-    if intensity < 0:
-        intensity = 0
-
-    x = (intensity - bp)/(wp - bp)
+    intensity = np.asarray(intensity)
 
-    if x > 0:
+    # 8 and 16 bit images are corrected using a lookup table
+    if intensity.dtype in (np.uint8, np.uint16):
+        return gammaCorrectionLUT(gamma, bp=bp, wp=wp, dtype=intensity.dtype)[intensity]
 
-        # Compute the corrected intensity
-        return bp + (wp - bp)*(x**(1.0/gamma))
-
-    else:
-        return bp
+    return _gammaCorrectionArray(intensity, gamma, bp, wp)
 
 
 
@@ -190,6 +227,9 @@ class FlatStruct(object):
         # Fix values close to 0
         self.fixValues()
 
+        # Compute the per pixel flat gain
+        self.computeGain()
+
 
     def applyDark(self, dark):
         """ Apply a dark to the flat. """
@@ -209,6 +249,9 @@ class FlatStruct(object):
         # Fix values close to 0
         self.fixValues()
 
+        # Compute the per pixel flat gain
+        self.computeGain()
+
 
     def computeAverage(self):
         """ Compute the flat average. """
@@ -228,6 +271,12 @@ class FlatStruct(object):
         self.flat_img[(self.flat_img < self.flat_avg/10) | (self.flat_img < 10)] = self.flat_avg
 
 
+    def computeGain(self):
+        """ Precompute the factors by which the image pixels are multiplied when the flat is applied. """
+
+        self.flat_gain = (self.flat_avg/self.flat_img).astype(np.float32)
+
+
 
 
 
@@ -293,17 +342,15 @@ def applyFlat(img, flat_struct):
 
     input_type = img.dtype
 
-    # Apply the flat
-    img = flat_struct.flat_avg*img.astype(np.float64)/flat_struct.flat_img
+    # Apply the flat by multiplying the image with the precomputed flat gain
+    img_flat = np.multiply(img, flat_struct.flat_gain, dtype=np.float32)
 
     # Limit the image values to image type range
     dtype_info = np.iinfo(input_type)
-    img = np.clip(img, dtype_info.min, dtype_info.max)
+    np.clip(img_flat, dtype_info.min, dtype_info.max, out=img_flat)
 
     # Make sure the output array is the same as the input type
-    img = img.astype(input_type)
-
-    return img
+    return img_flat.astype(input_type)
 
 
 
@@ -48,23 +48,124 @@ def loadMask(mask_file):
 
 
 
-def maskImage(input_image, mask):
-	""" Apply masking to the given image. """
+class MaskStruct(object):
+	def __init__(self, mask):
+		""" Mask prepared for applying it to many images of the same size.
+
+		Arguments:
+			mask: [ndarray] Mask image, the pixels where the mask is black are masked.
+
+		"""
+
+		self.mask = mask
+		self.shape = mask.shape
+
+		# Flat indices of the masked pixels
+		self.masked_indices = np.flatnonzero(mask == 0)
+
+
+
+def _imageMean(img):
+	""" Return the mean of the image. Integer images are summed as integers, which is exact and faster. """
+
+	if np.issubdtype(img.dtype, np.integer):
+		return img.sum(dtype=np.int64)/img.size
+
+	return np.mean(img)
+
+
+
+def maskImage(input_image, mask, mask_struct=None, out=None):
+	""" Apply masking to the given image. The masked pixels are set to the mean of the image.
+
+	Keyword arguments:
+		mask_struct: [MaskStruct] Precomputed mask structure. Computed from the mask if not given.
+		out: [ndarray] Array the masked image is written to, the input image is masked in place if not given.
+	"""
+
+	if out is None:
+		out = input_image
+
+	elif out is not input_image:
+		np.copyto(out, input_image)
 
 	# If the image dimensions don't agree, dont apply the mask
 	if input_image.shape != mask.shape:
 		log.warning('Image and mask dimensions do not agree! Skipping masking...')
-		return input_image
+		return out
+
+	if mask_struct is None:
+		mask_struct = MaskStruct(mask)
+
+	# Set all image pixels where the mask is black to the image mean
+	out.put(mask_struct.masked_indices, _imageMean(input_image))
+
+	return out
+
+
+
+def maskFF(ff, mask_struct, out=None):
+	""" Mask all image planes of an FF file in one pass. The masked pixels of every plane are set to the 
+		mean of that plane.
 
-	# Set all image pixels where the mask is black to 0
-	input_image[mask == 0] = np.mean(input_image)
+	Arguments:
+		ff: [ff bin struct] FF file.
+		mask_struct: [MaskStruct] Precomputed mask structure.
 
-	return input_image
+	Keyword arguments:
+		out: [ff bin struct] FF structure the masked maxpixel, avepixel, stdpixel and maxframe are written 
+			to. Planes which are not allocated or have a different size are allocated. The input FF file is
+			masked in place if not given.
 
+	Return:
+		[ff bin struct] Masked FF file.
+	"""
 
+	if out is None:
+		out = ff
 
-def applyMask(input_image, mask_tuple, ff_flag=False):
-	""" Apply a mask to the given image array or FF file. """
+	plane_names = ('maxpixel', 'avepixel', 'stdpixel', 'maxframe')
+
+	apply_mask = ff.maxpixel.shape == mask_struct.shape
+
+	# If the image dimensions don't agree, dont apply the mask
+	if not apply_mask:
+		log.warning('Image and mask dimensions do not agree! Skipping masking...')
+
+	for name in plane_names:
+
+		plane = getattr(ff, name)
+
+		# Copy the plane to the output buffer
+		if out is not ff:
+
+			out_plane = getattr(out, name, None)
+
+			if (out_plane is None) or (out_plane.shape != plane.shape) or (out_plane.dtype != plane.dtype):
+				out_plane = np.empty_like(plane)
+				setattr(out, name, out_plane)
+
+			np.copyto(out_plane, plane)
+
+		else:
+			out_plane = plane
+
+		if apply_mask:
+			out_plane.put(mask_struct.masked_indices, _imageMean(plane))
+
+
+	return out
+
+
+
+def applyMask(input_image, mask_tuple, ff_flag=False, mask_struct=None, out=None):
+	""" Apply a mask to the given image array or FF file. 
+
+	Keyword arguments:
+		mask_struct: [MaskStruct] Precomputed mask structure. Computed from the mask if not given.
+		out: [ndarray or ff bin struct] Output buffer for the masked image or FF file, see maskImage and 
+			maskFF. The input is masked in place if not given.
+	"""
 
 	# Check if the loading procedure determined if the mask file exists
 	mask_flag, mask = mask_tuple
@@ -72,18 +173,16 @@ def applyMask(input_image, mask_tuple, ff_flag=False):
 	if not mask_flag:
 		return input_image
 
+	if mask_struct is None:
+		mask_struct = MaskStruct(mask)
+
 	# Apply masking to an FF file
 	if ff_flag:
-		input_image.maxpixel = maskImage(input_image.maxpixel, mask)
-		input_image.avepixel = maskImage(input_image.avepixel, mask)
-		input_image.stdpixel = maskImage(input_image.stdpixel, mask)
-		input_image.maxframe = maskImage(input_image.maxframe, mask)
-
-		return input_image
+		return maskFF(input_image, mask_struct, out=out)
 
 	# Apply the mask to a regular image array
 	else:
-		return maskImage(input_image, mask)
+		return maskImage(input_image, mask, mask_struct=mask_struct, out=out)
 
 
 
@@ -12,9 +12,20 @@ ctypedef np.uint8_t INT_TYPE_t
 
 
 
+class MorphBuffers(object):
+    """ Work arrays for morphological operations, which can be reused for many images of the same size. """
+
+    def __init__(self, y_size, x_size):
+
+        self.mask = np.zeros(shape=(y_size, x_size), dtype=INT_TYPE)
+        self.previous = np.zeros(shape=(y_size, x_size), dtype=INT_TYPE)
+        self.closed = np.zeros(shape=(y_size, x_size), dtype=INT_TYPE)
+
+
+
 @cython.boundscheck(False)
 @cython.wraparound(False) 
-def morphApply(np.ndarray[INT_TYPE_t, ndim=2] img, operations):
+def morphApply(np.ndarray[INT_TYPE_t, ndim=2] img, operations, buffers=None):
     """ Apply morphological operations on the given image.
 
     1 - clean
@@ -22,6 +33,9 @@ def morphApply(np.ndarray[INT_TYPE_t, ndim=2] img, operations):
     3 - close
     4 - thin
 
+    If a MorphBuffers object is given, the work arrays are taken from it instead of being allocated on every 
+    call, and the input image may be modified in place.
+
     """
 
     cdef int operation
@@ -32,13 +46,16 @@ def morphApply(np.ndarray[INT_TYPE_t, ndim=2] img, operations):
             img = clean(img)
 
         elif (operation == 2):
-            img = bridge(img)
+            img = bridge(img, None if buffers is None else buffers.mask)
 
         elif (operation == 3):
-            img = close(img)
+            img = close(img, None if buffers is None else buffers.closed)
 
         elif (operation == 4):
-            img = thin(img)
+            if buffers is None:
+                img = thin(img)
+            else:
+                img = thin(img, buffers.mask, buffers.previous, True)
 
 
     return img
@@ -93,13 +110,14 @@ def clean(np.ndarray[INT_TYPE_t, ndim=2] img):
 
 @cython.boundscheck(False)
 @cython.wraparound(False) 
-def bridge(np.ndarray[INT_TYPE_t, ndim=2] img):
+def bridge(np.ndarray[INT_TYPE_t, ndim=2] img, np.ndarray[INT_TYPE_t, ndim=2] mask=None):
     """ Connect pixels on opposite sides, if other pixels are 0, as in:
      0  0  1      0  0  1
      0  0  0  =>  0  1  0
      1  0  0      1  0  0
     
     @param img: input image
+    @param mask: optional work array of the same size as the image, allocated if not given
     
     @return bridged image
     """
@@ -111,7 +129,10 @@ def bridge(np.ndarray[INT_TYPE_t, ndim=2] img):
     cdef int x_size = img.shape[1]
 
     # Init mask array
-    cdef np.ndarray[INT_TYPE_t, ndim=2] mask = np.zeros(shape=(y_size, x_size), dtype=INT_TYPE)
+    if mask is None:
+        mask = np.zeros(shape=(y_size, x_size), dtype=INT_TYPE)
+    else:
+        mask.fill(0)
 
     
     for y in range(1, img.shape[0]-1):
@@ -226,17 +247,18 @@ def close_cy(np.ndarray[INT_TYPE_t, ndim=2] img):
 
 @cython.boundscheck(False)
 @cython.wraparound(False) 
-def close(np.ndarray[INT_TYPE_t, ndim=2] img):
+def close(np.ndarray[INT_TYPE_t, ndim=2] img, np.ndarray[INT_TYPE_t, ndim=2] dst=None):
     """ Morphological closing (dilation followed by erosion) with OpenCV.
     
     @param image: input image
+    @param dst: optional output array of the same size as the image, allocated if not given
     
     @return closed image
     """
     
     kernel = np.ones((3, 3), np.uint8)
     
-    img = cv2.morphologyEx(img, cv2.MORPH_CLOSE, kernel)
+    img = cv2.morphologyEx(img, cv2.MORPH_CLOSE, kernel, dst=dst)
     
     return img
 
@@ -244,8 +266,13 @@ def close(np.ndarray[INT_TYPE_t, ndim=2] img):
 
 @cython.boundscheck(False)
 @cython.wraparound(False) 
-def thin(np.ndarray[INT_TYPE_t, ndim=2] img):
-    """ Zhang-Suen fast thinning algorithm. """
+def thin(np.ndarray[INT_TYPE_t, ndim=2] img, np.ndarray[INT_TYPE_t, ndim=2] mask=None, 
+    np.ndarray[INT_TYPE_t, ndim=2] previous=None, bint in_place=False):
+    """ Zhang-Suen fast thinning algorithm. 
+
+    The mask and previous work arrays of the same size as the image can be given, otherwise they are
+    allocated. If in_place is True, the input image is thinned in place.
+    """
 
     cdef int y, x
     cdef int p2, p3, p4, p5, p6, p7, p8, p9
@@ -257,10 +284,20 @@ def thin(np.ndarray[INT_TYPE_t, ndim=2] img):
     cdef int x_size = img.shape[1]
 
     # Init mask array
-    cdef np.ndarray[INT_TYPE_t, ndim=2] mask = np.zeros(shape=(y_size, x_size), dtype=INT_TYPE)
+    if mask is None:
+        mask = np.zeros(shape=(y_size, x_size), dtype=INT_TYPE)
+    else:
+        mask.fill(0)
 
     # Previous thinning solution
-    cdef np.ndarray[INT_TYPE_t, ndim=2] previous = np.zeros(shape=(y_size, x_size), dtype=INT_TYPE)    
+    if previous is None:
+        previous = np.zeros(shape=(y_size, x_size), dtype=INT_TYPE)
+    else:
+        previous.fill(0)
+
+    # Work on a copy, the input image is not changed
+    if not in_place:
+        img = np.copy(img)
 
     while True:
 
@@ -294,17 +331,17 @@ def thin(np.ndarray[INT_TYPE_t, ndim=2] img):
 
         
             # Bitwise AND image with inverted mask
-            img = (img & ~mask)
+            np.invert(mask, mask)
+            np.bitwise_and(img, mask, img)
 
             # Reset mask to 0
             mask.fill(0)
 
         # Check the difference with the previous thinning solution
-        diff = np.absolute(img - previous)
-        if np.sum(diff) == 0:
+        if np.array_equal(img, previous):
             break
 
         # Set previous
-        previous = np.copy(img)
+        np.copyto(previous, img)
 
     return img
@@ -22,7 +22,6 @@ import argparse
 import time
 import datetime
 import signal
-import ctypes
 import logging
 import multiprocessing
 
@@ -37,7 +36,9 @@ from RMS.CaptureDuration import captureDuration
 from RMS.Compression import Compressor
 from RMS.DeleteOldObservations import deleteOldObservations
 from RMS.DetectStarsAndMeteors import detectStarsAndMeteors
+from RMS.FrameRing import FrameRing
 from RMS.LiveViewer import LiveViewer
+from RMS import Metrics
 from RMS.Misc import mkdirP
 from RMS.QueuedPool import QueuedPool
 from RMS.Reprocess import getPlatepar, processNight
@@ -194,16 +195,9 @@ def runCapture(config, duration=None, video_file=None, nodetect=False, detect_en
         array_pad = 1
 
 
-    # Init arrays for parallel compression on 2 cores
-    sharedArrayBase = multiprocessing.Array(ctypes.c_uint8, 256*(config.width + array_pad)*(config.height + array_pad))
-    sharedArray = np.ctypeslib.as_array(sharedArrayBase.get_obj())
-    sharedArray = sharedArray.reshape(256, (config.height + array_pad), (config.width + array_pad))
-    startTime = multiprocessing.Value('d', 0.0)
-    
-    sharedArrayBase2 = multiprocessing.Array(ctypes.c_uint8, 256*(config.width + array_pad)*(config.height + array_pad))
-    sharedArray2 = np.ctypeslib.as_array(sharedArrayBase2.get_obj())
-    sharedArray2 = sharedArray2.reshape(256, (config.height + array_pad), (config.width + array_pad))
-    startTime2 = multiprocessing.Value('d', 0.0)
+    # Init the ring of frame blocks in shared memory, used for parallel capture and compression
+    frame_ring = FrameRing(config.frame_ring_blocks, 256, config.height + array_pad, 
+        config.width + array_pad)
 
     log.info('Initializing frame buffers done!')
 
@@ -223,21 +217,21 @@ def runCapture(config, duration=None, video_file=None, nodetect=False, detect_en
             # Delay the detection for 2 minutes after capture start
             delay_detection = 120
 
-        # Initialize the detector
+        # Initialize the detector, the config and the flat are sent to every worker only once
         detector = QueuedPool(detectStarsAndMeteors, cores=1, log=log, delay_start=delay_detection, \
-            backup_dir=night_data_dir)
+            backup_dir=night_data_dir, func_extra_args=[config, flat_struct])
         detector.startPool()
 
     
     # Initialize buffered capture
-    bc = BufferedCapture(sharedArray, startTime, sharedArray2, startTime2, config, video_file=video_file)
+    bc = BufferedCapture(frame_ring, config, video_file=video_file)
 
     # Initialize the live image viewer
     live_view = LiveViewer(window_name='Maxpixel')
     
     # Initialize compression
-    compressor = Compressor(night_data_dir, sharedArray, startTime, sharedArray2, startTime2, config, 
-        detector=detector, live_view=live_view, flat_struct=flat_struct)
+    compressor = Compressor(night_data_dir, frame_ring, config, detector=detector, live_view=live_view, 
+        flat_struct=flat_struct)
 
     
     # Start buffered capture
@@ -262,6 +256,8 @@ def runCapture(config, duration=None, video_file=None, nodetect=False, detect_en
 
     dropped_frames = bc.dropped_frames
     log.info('Total number of late or dropped frames: ' + str(dropped_frames))
+    log.info('Frame ring starved {:d} times, {:d} frame blocks were overwritten before compression'.format(
+        frame_ring.starved.value, frame_ring.overwritten.value))
 
 
     # Stop the compressor
@@ -280,7 +276,7 @@ def runCapture(config, duration=None, video_file=None, nodetect=False, detect_en
     # If detection should be performed
     if not nodetect:
 
-        log.info('Finishing up the detection, ' + str(detector.input_queue.qsize()) + ' files to process...')
+        log.info('Finishing up the detection, ' + str(detector.pendingJobs()) + ' files to process...')
 
 
         # Reset the Ctrl+C to KeyboardInterrupt
@@ -290,7 +286,7 @@ def runCapture(config, duration=None, video_file=None, nodetect=False, detect_en
         try:
 
             # If there are some more files to process, process them on more cores
-            if detector.input_queue.qsize() > 0:
+            if detector.pendingJobs() > 0:
 
                 # Let the detector use all cores, but leave 2 free
                 available_cores = multiprocessing.cpu_count() - 2
@@ -402,7 +398,8 @@ if __name__ == "__main__":
     arg_group.add_argument('-d', '--duration', metavar='DURATION_HOURS', help="""Start capturing right away, 
         with the given duration in hours. """)
     arg_group.add_argument('-i', '--input', metavar='FILE_PATH', help="""Use video from the given file, 
-        not from a video device. """)
+        not from a video device. A directory with FF files, an FF file or a .vid file can be given as well, or 
+        'synthetic' for a simulated camera (e.g. 'synthetic:5' to use the random seed 5). """)
 
     arg_parser.add_argument('-n', '--nodetect', action="store_true", help="""Do not perform star extraction 
         nor meteor detection. """)
@@ -436,6 +433,10 @@ if __name__ == "__main__":
     mkdirP(os.path.join(root_dir, config.archived_dir))
 
 
+    # Set up saving the metrics before any worker processes are started
+    Metrics.configure(config)
+
+
     # If the duration of capture was given, capture right away for a specified time
     if cml_args.duration:
 
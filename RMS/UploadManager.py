@@ -12,6 +12,8 @@ import logging
 import binascii
 import paramiko
 
+from RMS import Metrics
+
 try:
     # Python 2
     import Queue
@@ -149,7 +151,13 @@ def uploadSFTP(hostname, username, dir_local, dir_remote, file_list, port=22,
             
             # Upload the file to the server if it isn't already there
             log.info('Copying ' + local_file + ' to ' + remote_file)
-            sftp.put(local_file, remote_file)
+
+            with Metrics.timer('upload'):
+                sftp.put(local_file, remote_file)
+
+            # The upload throughput is given by the uploaded bytes and the upload time
+            Metrics.increment('upload_bytes', local_file_size)
+            Metrics.increment('upload_files')
 
         t.close()
 
@@ -18,12 +18,23 @@
 
 import math
 import time
+import ctypes
 import logging
-from multiprocessing import Process, Event
+import multiprocessing
+from multiprocessing import Process, Event, Queue, Value
+
+try:
+    # Python 3
+    from queue import Empty
+
+except:
+    # Python 2
+    from Queue import Empty
 
 import numpy as np
 from scipy import stats
 
+from RMS import Metrics
 from RMS.Routines import Grouping3D
 from RMS.Formats import FRbin
 
@@ -257,7 +268,11 @@ class Extractor(Process):
 
 
     def executeAll(self):
-        """ Run the complete extraction procedure. """
+        """ Run the complete extraction procedure. The time spent in every stage of the extraction is stored
+            in the timings dictionary.
+        """
+
+        self.timings = {}
 
         # Check if the average image is too white and skip it
         if np.average(self.compressed[2]) > self.config.white_avg_level:
@@ -268,7 +283,8 @@ class Extractor(Process):
 
         # Extract points of the fireball
         event_points = self.findPoints()
-        log.debug("[" + self.filename + "] time for thresholding and subsampling: " + str(time.time() - t) + "s")
+        self.timings['findPoints'] = time.time() - t
+        log.debug("[" + self.filename + "] time for thresholding and subsampling: " + str(self.timings['findPoints']) + "s")
         
         # Skip the event if not points where found
         if len(event_points) == 0:
@@ -279,7 +295,8 @@ class Extractor(Process):
 
         # Find lines in 3D space and store them to line_list
         line_list = Grouping3D.find3DLines(event_points, time.time(), self.config)
-        log.debug("[" + self.filename + "] Time for finding lines: " + str(time.time() - t) + "s")
+        self.timings['find3DLines'] = time.time() - t
+        log.debug("[" + self.filename + "] Time for finding lines: " + str(self.timings['find3DLines']) + "s")
         
         if line_list is None:
             log.debug("[" + self.filename + "] no lines found, not extracting anything")
@@ -289,7 +306,8 @@ class Extractor(Process):
 
         # Find the parameters of the line in the 3D point cloud
         coeff = Grouping3D.findCoefficients(line_list)
-        log.debug("[" + self.filename + "] Time for finding coefficients: " + str(time.time() - t) + "s")
+        self.timings['findCoefficients'] = time.time() - t
+        log.debug("[" + self.filename + "] Time for finding coefficients: " + str(self.timings['findCoefficients']) + "s")
         
         if len(coeff) == 0:
             log.debug("[" + self.filename + "] nothing found, not extracting anything 2")
@@ -299,7 +317,8 @@ class Extractor(Process):
 
         # Extract video clips from the raw data
         clips = self.extract(coeff)
-        log.debug("[" + self.filename + "] Time for extracting: " + str(time.time() - t) + "s")
+        self.timings['extract'] = time.time() - t
+        log.debug("[" + self.filename + "] Time for extracting: " + str(self.timings['extract']) + "s")
 
          
         t = time.time()
@@ -307,4 +326,278 @@ class Extractor(Process):
         # Save the extracted clips
         self.save(clips)
 
-        log.debug("[" + self.filename + "] Time for saving: " + str(time.time() - t) + "s")
\ No newline at end of file
+        self.timings['save'] = time.time() - t
+        log.debug("[" + self.filename + "] Time for saving: " + str(self.timings['save']) + "s")
+
+
+
+
+class ExtractorWorker(Process):
+    """ Long-lived extractor process which receives the frame blocks through a job queue, instead of forking
+        a new Extractor for every block.
+
+        If the capture has a spare free block in the frame ring, the compressed block is kept in the ring 
+        until its extraction is done, so the frames are neither copied nor pickled. Otherwise the frames are
+        copied into a free buffer of a small pool of frame buffers in shared memory which the worker owns,
+        and the ring block is freed right away. The buffer is freed when the extraction of the job is done.
+        If all buffers are taken by jobs which are waiting or being processed, the extractor is behind and 
+        the new block is skipped instead of being queued.
+
+    """
+
+    def __init__(self, config, data_dir, frame_ring, buffers_num=1):
+        """
+        Arguments:
+            config: [Configuration object] config obj
+            data_dir: [str] path to the directory where FF files are located
+            frame_ring: [FrameRing] Frame ring which holds the blocks of raw frames.
+
+        Keyword arguments:
+            buffers_num: [int] Number of frame buffers, i.e. the maximum number of jobs with copied frames 
+                which can wait for extraction or be processed. Every buffer takes the memory of one block. 
+                1 by default.
+
+        """
+
+        super(ExtractorWorker, self).__init__()
+
+        self.config = config
+        self.data_dir = data_dir
+        self.frame_ring = frame_ring
+
+        self.buffers_num = max(0, buffers_num)
+
+        # Init the frame buffers in shared memory
+        self.buffers = []
+        for i in range(self.buffers_num):
+
+            shared_array_base = multiprocessing.Array(ctypes.c_uint8, self.frame_ring.arrays[0].size)
+            shared_array = np.ctypeslib.as_array(shared_array_base.get_obj())
+            shared_array = shared_array.reshape(self.frame_ring.arrays[0].shape)
+
+            self.buffers.append(shared_array)
+
+
+        # Flags telling which buffers are taken by jobs, only changed while holding the backlog lock
+        self.buffers_taken = multiprocessing.Array(ctypes.c_bool, max(1, self.buffers_num), lock=False)
+
+        # Number of jobs which were added, but not yet processed
+        self.backlog = Value('i', 0)
+
+        # Number of blocks which were skipped because the extractor was behind
+        self.skipped = Value('i', 0)
+
+        self.job_queue = Queue()
+
+        self.exit = Event()
+
+
+
+    def addJob(self, block, startTime, compressed, filename):
+        """ Add the raw frames of the compressed frame ring block to the extraction queue. The block is kept 
+            in the ring until the extraction is done if the capture has a spare block, otherwise the frames 
+            are copied into a free buffer and the block is freed. If there are no free buffers either, the 
+            block is freed and its extraction is skipped.
+
+        Arguments:
+            block: [int] Index of the frame ring block which holds the raw frames.
+            startTime: [float] Time of the first frame in the block.
+            compressed: [ndarray] Array with FTP compressed frames.
+            filename: [str] Name of the FF file which is being processed.
+
+        Return:
+            [bool] True if the job was added, False if it was skipped.
+        """
+
+        pinned = False
+
+        try:
+
+            with self.backlog.get_lock():
+
+                # Keep the block in the ring if the capture has a spare one
+                pinned = self.frame_ring.pinForExtraction(block)
+
+                buffer_index = None
+
+                if not pinned:
+                    for i in range(self.buffers_num):
+                        if not self.buffers_taken[i]:
+                            buffer_index = i
+                            break
+
+                if pinned or (buffer_index is not None):
+
+                    if buffer_index is not None:
+                        self.buffers_taken[buffer_index] = True
+
+                    self.backlog.value += 1
+
+                else:
+                    self.skipped.value += 1
+
+
+            if pinned:
+                self.job_queue.put([True, block, startTime, time.time(), compressed, filename])
+
+                return True
+
+
+            if buffer_index is None:
+
+                Metrics.increment('extraction_skipped')
+                log.warning("[" + filename + "] extractor backlog is full ({:d} jobs), skipping the "\
+                    "extraction! Skipped blocks so far: {:d}".format(self.getBacklog(), self.skipped.value))
+
+                return False
+
+
+            t = time.time()
+
+            np.copyto(self.buffers[buffer_index], self.frame_ring.arrays[block])
+
+            Metrics.addTime('extraction_copy', time.time() - t)
+
+            self.job_queue.put([False, buffer_index, startTime, time.time(), compressed, filename])
+
+            return True
+
+
+        finally:
+
+            # Free the block for the capture if it was not kept for the extraction
+            if not pinned:
+                self.frame_ring.release(block)
+
+
+
+    def freeJob(self, pinned, index):
+        """ Free the frame ring block or the buffer of the job, after it was processed or discarded.
+
+        Arguments:
+            pinned: [bool] True if the frames of the job are in the frame ring, False if they are in a 
+                buffer.
+            index: [int] Index of the frame ring block or the buffer.
+
+        """
+
+        with self.backlog.get_lock():
+
+            if pinned:
+                self.frame_ring.release(index)
+
+            else:
+                self.buffers_taken[index] = False
+
+            self.backlog.value -= 1
+
+
+
+    def getBacklog(self):
+        """ Return the number of jobs which are waiting for extraction or are being processed. """
+
+        return self.backlog.value
+
+
+
+    def stop(self, timeout=60):
+        """ Stop the worker after the job which is currently being processed. The jobs remaining in the
+            queue are discarded.
+
+        Keyword arguments:
+            timeout: [float] Time in seconds to wait for the worker to finish before terminating it.
+
+        """
+
+        self.exit.set()
+
+        # Wake up the worker if it is waiting for jobs
+        self.job_queue.put(None)
+
+        self.join(timeout)
+
+        if self.is_alive():
+            log.info('Terminating the extractor...')
+            self.terminate()
+            self.join()
+
+        if self.skipped.value:
+            log.info('Extraction skipped on {:d} blocks because the extractor was behind.'.format(\
+                self.skipped.value))
+
+
+
+    def run(self):
+        """ Process the jobs from the queue until stopped. """
+
+        extractor = Extractor(self.config, self.data_dir)
+
+        while not self.exit.is_set():
+
+            try:
+                job = self.job_queue.get(timeout=1)
+
+            except Empty:
+                continue
+
+            # Stop if the sentinel was received
+            if job is None:
+                break
+
+            pinned, index, startTime, t_added, compressed, filename = job
+
+            t = time.time()
+            t_queue = t - t_added
+
+            if pinned:
+                extractor.frames = self.frame_ring.arrays[index]
+
+            else:
+                extractor.frames = self.buffers[index]
+
+            extractor.compressed = compressed
+            extractor.filename = filename
+
+            try:
+                extractor.executeAll()
+
+            except:
+                log.exception("[" + filename + "] extraction failed!")
+
+
+            # Report the per-stage timings
+            for stage in extractor.timings:
+                Metrics.addTime('extraction_' + stage, extractor.timings[stage])
+
+            Metrics.addTime('extraction', time.time() - t)
+            Metrics.addTime('extraction_queue_wait', t_queue)
+
+            timings = ", ".join(["{:s}: {:.3f}s".format(stage, extractor.timings[stage]) for stage in \
+                ['findPoints', 'find3DLines', 'findCoefficients', 'extract', 'save'] \
+                if stage in extractor.timings])
+
+            log.debug("[" + filename + "] extraction done in {:.3f}s, queue: {:.3f}s, "\
+                "{:s}".format(time.time() - t, t_queue, timings))
+
+
+            self.freeJob(pinned, index)
+
+            Metrics.setGauge('extractor_backlog', self.getBacklog())
+
+            log.debug("Extractor backlog: {:d}".format(self.getBacklog()))
+
+
+        # Free the frame ring blocks and the buffers of the discarded jobs
+        while True:
+
+            try:
+                job = self.job_queue.get_nowait()
+
+            except Empty:
+                break
+
+            if job is not None:
+                self.freeJob(job[0], job[1])
+
+
+        Metrics.flush()
@@ -0,0 +1,550 @@
+""" Benchmarks of the hot paths of the capture and the processing pipeline on generated data.
+
+    The frames are generated by the synthetic camera with a fixed seed, so every run processes the same data.
+    The results are saved as JSON, and can be compared to the results of an earlier run (the baseline) to
+    catch slowdowns. If any case is slower than the baseline by more than the given tolerance, the script
+    exits with a non-zero status.
+
+    Usage:
+        python -m Tests.Benchmarks -o baseline.json
+        python -m Tests.Benchmarks -b baseline.json -t 0.2
+"""
+
+from __future__ import print_function, division, absolute_import
+
+import os
+import sys
+import copy
+import json
+import time
+import random
+import shutil
+import argparse
+import platform
+import tempfile
+import datetime
+
+import numpy as np
+
+import RMS.ConfigReader as cr
+from RMS.FrameSource import SyntheticSource
+from RMS.Formats import FFfile, FFStruct, FRbin
+from RMS.Formats.Platepar import Platepar
+from RMS.Astrometry.ApplyAstrometry import raDecToCorrectedXYPP
+from RMS.Astrometry.Conversions import date2JD, JD2LST
+from RMS.Routines import Grouping3D
+
+# Import Cython functions
+import pyximport
+pyximport.install(setup_args={'include_dirs':[np.get_include()]})
+from RMS.CompressionCy import compressFrames, compressFramesParallel
+
+
+
+# Resolutions at which the benchmarks are run
+RESOLUTIONS = {
+    'cif': (352, 288),
+    '720p': (1280, 720),
+    '1080p': (1920, 1080)
+    }
+
+# Name of the generated FF files, without the extension
+FF_NAME = 'FF_XX0001_20180101_000000_000_0000000'
+
+
+
+def timeCase(func, repeats):
+    """ Time the given function. The first call is a warmup and it is not measured.
+
+    Arguments:
+        func: [function] Function without arguments which will be timed.
+        repeats: [int] Number of measured calls.
+
+    Return:
+        [dict] Median and minimum run time in seconds, and the number of measured calls.
+    """
+
+    func()
+
+    timings = []
+    for i in range(repeats):
+
+        t1 = time.time()
+        func()
+        timings.append(time.time() - t1)
+
+
+    return {'median': float(np.median(timings)), 'min': float(np.min(timings)), 'repeats': repeats}
+
+
+
+def generateFrames(width, height, seed):
+    """ Generate a block of 256 frames with the synthetic camera.
+
+    Arguments:
+        width: [int] Width of the frames.
+        height: [int] Height of the frames.
+        seed: [int] Seed of the synthetic camera.
+
+    Return:
+        [3D ndarray] Frames in the (frame, y, x) order.
+    """
+
+    # Generate more meteors than usual, so all stages of the detection have something to work on
+    source = SyntheticSource(width, height, 25.0, seed=seed, stars_num=width*height//2000,
+        meteor_interval=60, frames_num=256)
+
+    frames = np.empty((256, height, width), dtype=np.uint8)
+
+    for i in range(256):
+        frames[i] = source.nextFrame()
+
+    source.release()
+
+    return frames
+
+
+
+def makeFF(compressed, config):
+    """ Make the FF structure from the compressed frames, in the same way the compression does it. """
+
+    ff = FFStruct.FFStruct()
+    ff.array = compressed
+    ff.nrows = compressed.shape[1]
+    ff.ncols = compressed.shape[2]
+    ff.nbits = config.bit_depth
+    ff.nframes = 256
+    ff.first = 256
+    ff.camno = config.stationID
+    ff.fps = config.fps
+
+    return ff
+
+
+
+def makeCutouts(seed, lines_num=10, frames_num=50, size=64):
+    """ Generate random frame cutouts in the format given to FRbin.writeArray.
+
+    Arguments:
+        seed: [int] Seed of the random generator.
+
+    Keyword arguments:
+        lines_num: [int] Number of lines. 10 by default.
+        frames_num: [int] Number of cutouts per line. 50 by default.
+        size: [int] Size of the cutouts. 64 by default.
+
+    Return:
+        [list] A list of [cutouts, sizepos] entries, one per line.
+    """
+
+    random_state = np.random.RandomState(seed)
+
+    arr = []
+    for i in range(lines_num):
+
+        cutouts = random_state.randint(0, 256, (frames_num, size, size)).astype(np.uint8)
+
+        sizepos = np.zeros((frames_num, 4), dtype=np.uint32)
+        sizepos[:, 0] = random_state.randint(0, 720, frames_num)
+        sizepos[:, 1] = random_state.randint(0, 1280, frames_num)
+        sizepos[:, 2] = np.arange(frames_num)
+        sizepos[:, 3] = size
+
+        arr.append([cutouts, sizepos])
+
+    return arr
+
+
+
+def makeCalstars(config, width, height, seed, files_num=20):
+    """ Generate the platepar and the star list for the astrometry check. The stars are the catalog stars
+        projected to the image with a known platepar. The initial platepar is the same one, but slightly off,
+        so the fit has to move it back.
+
+    Arguments:
+        config: [Config object]
+        width: [int] Width of the image.
+        height: [int] Height of the image.
+        seed: [int] Seed of the random generator.
+
+    Keyword arguments:
+        files_num: [int] Number of FF files with stars. 20 by default.
+
+    Return:
+        (platepar, calstars_list): [tuple] Initial platepar and the stars in the CALSTARS list format, or None
+            if the star catalog could not be loaded.
+    """
+
+    from RMS.Formats import StarCatalog
+
+    catalog_stars = StarCatalog.readStarCatalog(config.star_catalog_path, config.star_catalog_file, \
+        lim_mag=config.catalog_mag_limit, mag_band_ratios=config.star_catalog_band_ratios)
+
+    if (catalog_stars is False) or (catalog_stars is None) or (len(catalog_stars) == 0):
+        return None
+
+    ra_catalog, dec_catalog, mag_catalog = catalog_stars.T
+
+
+    # Camera pointing at the zenith with a 60 degree wide field of view
+    time_beg = datetime.datetime(2018, 1, 1, 0, 0, 0)
+
+    platepar = Platepar()
+    platepar.lat = 45.0
+    platepar.lon = 15.0
+    platepar.JD = date2JD(*time_beg.timetuple()[:6])
+    platepar.X_res = width
+    platepar.Y_res = height
+    platepar.F_scale = width/60.0
+    platepar.RA_d, _ = JD2LST(platepar.JD, platepar.lon)
+    platepar.dec_d = platepar.lat
+
+
+    random_state = np.random.RandomState(seed)
+
+    calstars_list = []
+    for i in range(files_num):
+
+        # One FF file every 10.24 seconds
+        ff_time = time_beg + datetime.timedelta(seconds=10.24*i)
+        ff_name = 'FF_XX0001_{:s}_{:03d}_{:07d}.fits'.format(ff_time.strftime('%Y%m%d_%H%M%S'),
+            ff_time.microsecond//1000, 256*i)
+
+        dt = FFfile.getMiddleTimeFF(ff_name, config.fps, ret_milliseconds=True)
+        jd = date2JD(*dt)
+
+        # Project the catalog stars to the image and add the centroiding noise
+        x_array, y_array = raDecToCorrectedXYPP(ra_catalog, dec_catalog, jd, platepar)
+        x_array = x_array + random_state.normal(0, 0.3, len(x_array))
+        y_array = y_array + random_state.normal(0, 0.3, len(y_array))
+
+        star_data = []
+        for x, y, mag in zip(x_array, y_array, mag_catalog):
+
+            if (x > 10) and (x < width - 10) and (y > 10) and (y < height - 10):
+
+                intensity = 10**(-0.4*(mag - 12))
+                star_data.append([y, x, intensity/10, intensity])
+
+
+        calstars_list.append([ff_name, star_data])
+
+
+    # Move the initial solution slightly off
+    platepar.RA_d += 0.3
+    platepar.dec_d -= 0.2
+    platepar.pos_angle_ref += 0.5
+
+    return platepar, calstars_list
+
+
+
+def benchmarkResolution(config, width, height, dir_path, repeats, seed=0):
+    """ Run all benchmark cases at the given resolution.
+
+    Arguments:
+        config: [Config object]
+        width: [int] Width of the frames.
+        height: [int] Height of the frames.
+        dir_path: [str] Directory where the files will be written.
+        repeats: [int] Number of measured calls of every case.
+
+    Keyword arguments:
+        seed: [int] Seed of the generated data. 0 by default.
+
+    Return:
+        [dict] Results of every case. Failed cases have an 'error' entry instead of the timings.
+    """
+
+    # Use the whole frame, not the region of interest of the real camera
+    config.width, config.height = width, height
+    config.roi_left, config.roi_right = 0, width
+    config.roi_up, config.roi_down = 0, height
+
+    frames = generateFrames(width, height, seed)
+    compressed, _ = compressFrames(frames, config.deinterlace_order)
+
+    ff = makeFF(compressed, config)
+
+    # Two copies of every FF file are read in turns, otherwise the memoized FF reader would not read the file
+    # after the first time
+    ff_formats = ['bin', 'fits', 'fits_gzip']
+
+    ff_names = {}
+    for i, fmt in enumerate(ff_formats):
+
+        ff_names[fmt] = [FF_NAME.replace('XX0001', 'XX{:04d}'.format(2*i + j + 1)) + '.' \
+            + FFfile.formatExtension(fmt) for j in range(2)]
+
+        for ff_name in ff_names[fmt]:
+            FFfile.write(ff, dir_path, ff_name, fmt=fmt)
+
+
+    results = {}
+
+    def addCase(name, func):
+
+        print('  {:s}...'.format(name))
+
+        try:
+            results[name] = timeCase(func, repeats)
+
+        except Exception as e:
+            results[name] = {'error': '{:s}: {:s}'.format(type(e).__name__, str(e))}
+
+        print('    ' + ', '.join(['{:s}: {:s}'.format(key, str(value)) for key, value \
+            in sorted(results[name].items())]))
+
+
+
+    ### Compression ###
+
+    addCase('compressFrames', lambda: compressFrames(frames, config.deinterlace_order))
+
+    if config.compression_threads != 1:
+        addCase('compressFramesParallel', lambda: compressFramesParallel(frames, config.deinterlace_order,
+            config.compression_threads))
+
+
+    ### Fireball extraction ###
+
+    threshold_results = []
+
+    def thresholdAndSubsample():
+        threshold_results[:] = [Grouping3D.thresholdAndSubsample(frames, compressed, config.min_level,
+            config.min_pixels, config.k1, config.j1, config.f)]
+
+    addCase('thresholdAndSubsample', thresholdAndSubsample)
+
+
+    # Prepare the points in the same way as the extraction does, without the flare rejection
+    if threshold_results and (threshold_results[0][0] > 0):
+
+        _, x, y, z = threshold_results[0]
+
+        # The RANSAC line finder is run on all points
+        indices = np.argsort(z)
+        all_points = np.squeeze(np.dstack((y[indices], x[indices], z[indices]))).tolist()
+
+        ransac_config = copy.copy(config)
+        ransac_config.line_finding_method = 'ransac'
+
+        addCase('find3DLinesRANSAC', lambda: Grouping3D.find3DLines(list(all_points), time.time(), 
+            ransac_config))
+
+        if len(z) > config.max_points:
+            indices = np.random.RandomState(seed).choice(len(z), config.max_points, replace=False)
+            y, x, z = y[indices], x[indices], z[indices]
+
+        indices = np.argsort(z)
+        event_points = np.squeeze(np.dstack((y[indices], x[indices], z[indices]))).tolist()
+
+        addCase('find3DLines', lambda: Grouping3D.find3DLines(list(event_points), time.time(), config))
+
+    else:
+        results['find3DLines'] = {'error': 'No points were given by thresholdAndSubsample'}
+
+
+    ### FF files IO ###
+
+    for fmt in ff_formats:
+
+        addCase('FFwrite_' + fmt, lambda: FFfile.write(ff, dir_path, ff_names[fmt][0], fmt))
+
+        read_count = [0]
+        def readFF():
+            read_count[0] += 1
+            FFfile.read(dir_path, ff_names[fmt][read_count[0]%2], fmt)
+
+        addCase('FFread_' + fmt, readFF)
+
+
+    ### FR files IO ###
+
+    cutouts = makeCutouts(seed)
+
+    addCase('FRbinWrite', lambda: FRbin.writeArray(cutouts, dir_path, FF_NAME.replace('FF', 'FR') + '.bin'))
+    addCase('FRbinRead', lambda: FRbin.read(dir_path, FF_NAME.replace('FF', 'FR') + '.bin'))
+
+
+    ### Star extraction and meteor detection ###
+
+    from RMS.ExtractStars import extractStars
+    from RMS.Detection import detectMeteors
+
+    addCase('extractStars', lambda: extractStars(dir_path, ff_names['fits'][0], config))
+    addCase('detectMeteors', lambda: detectMeteors(dir_path, ff_names['fits'][0], config))
+
+
+    ### Astrometry check ###
+
+    try:
+        calstars = makeCalstars(config, width, height, seed)
+
+    except Exception as e:
+        calstars = None
+        results['autoCheckFit'] = {'error': '{:s}: {:s}'.format(type(e).__name__, str(e))}
+
+    if calstars is not None:
+
+        from RMS.Astrometry.CheckFit import autoCheckFit
+
+        platepar, calstars_list = calstars
+
+        # Use all generated files and stars
+        config.calstars_files_N = len(calstars_list)
+        config.calstars_min_stars = 1
+        config.ff_min_stars = 1
+
+        def checkFit():
+
+            # The files are randomly sampled during the fit
+            random.seed(seed)
+
+            autoCheckFit(config, copy.deepcopy(platepar), calstars_list)
+
+        addCase('autoCheckFit', checkFit)
+
+    elif 'autoCheckFit' not in results:
+        results['autoCheckFit'] = {'error': 'Star catalog {:s} could not be loaded'.format(
+            os.path.join(config.star_catalog_path, config.star_catalog_file))}
+
+
+    return results
+
+
+
+def compareBaseline(results, baseline, tolerance):
+    """ Compare the results to the baseline.
+
+    Arguments:
+        results: [dict] Benchmark results.
+        baseline: [dict] Benchmark results of the baseline run.
+        tolerance: [float] Allowed relative slowdown of the median run time, e.g. 0.2 for 20%.
+
+    Return:
+        [list] A list of (resolution, case, baseline time, new time) entries for every case which is slower
+            than allowed.
+    """
+
+    regressions = []
+
+    for res_name in sorted(results['results']):
+
+        if res_name not in baseline['results']:
+            continue
+
+        for case in sorted(results['results'][res_name]):
+
+            new = results['results'][res_name][case]
+            base = baseline['results'][res_name].get(case)
+
+            # Skip the cases which have failed or were not run in either one of the runs
+            if (base is None) or ('median' not in base) or ('median' not in new):
+                continue
+
+            if new['median'] > base['median']*(1 + tolerance):
+                regressions.append((res_name, case, base['median'], new['median']))
+
+
+    return regressions
+
+
+
+
+if __name__ == "__main__":
+
+    ### COMMAND LINE ARGUMENTS
+
+    # Init the command line arguments parser
+    arg_parser = argparse.ArgumentParser(description="Benchmark the hot paths of the pipeline on generated \
+        data.")
+
+    arg_parser.add_argument('-r', '--resolutions', metavar='RESOLUTIONS', type=str, nargs='+', \
+        default=['cif', '720p', '1080p'], help="Resolutions to run, from: {:s}. All by default.".format(
+            ', '.join(sorted(RESOLUTIONS))))
+
+    arg_parser.add_argument('-n', '--repeats', metavar='REPEATS', type=int, default=5, \
+        help="Number of measured runs of every case. 5 by default.")
+
+    arg_parser.add_argument('-s', '--seed', metavar='SEED', type=int, default=0, \
+        help="Seed of the generated data. 0 by default.")
+
+    arg_parser.add_argument('-c', '--config', metavar='CONFIG_PATH', type=str, default='.config', \
+        help="Path to the config file. .config by default.")
+
+    arg_parser.add_argument('-o', '--output', metavar='JSON_PATH', type=str, \
+        help="Save the results to the given JSON file, which can be used as the baseline later.")
+
+    arg_parser.add_argument('-b', '--baseline', metavar='JSON_PATH', type=str, \
+        help="Compare the results to the baseline results in the given JSON file.")
+
+    arg_parser.add_argument('-t', '--tolerance', metavar='TOLERANCE', type=float, default=0.2, \
+        help="Allowed relative slowdown compared to the baseline. 0.2 (20%%) by default.")
+
+    # Parse the command line arguments
+    cml_args = arg_parser.parse_args()
+
+    #########################
+
+
+    # Load the configuration file
+    config = cr.parse(cml_args.config)
+
+
+    results = {
+        'date': datetime.datetime.utcnow().strftime('%Y-%m-%d %H:%M:%S'),
+        'platform': platform.platform(),
+        'python': platform.python_version(),
+        'numpy': np.__version__,
+        'cpu_count': os.cpu_count() if hasattr(os, 'cpu_count') else None,
+        'repeats': cml_args.repeats,
+        'seed': cml_args.seed,
+        'results': {}
+        }
+
+
+    dir_path = tempfile.mkdtemp(prefix='rms_benchmarks_')
+
+    try:
+        for res_name in cml_args.resolutions:
+
+            width, height = RESOLUTIONS[res_name]
+
+            print('Running {:s} ({:d}x{:d})...'.format(res_name, width, height))
+
+            results['results'][res_name] = benchmarkResolution(config, width, height, dir_path,
+                cml_args.repeats, seed=cml_args.seed)
+
+    finally:
+        shutil.rmtree(dir_path, ignore_errors=True)
+
+
+    if cml_args.output is not None:
+        with open(cml_args.output, 'w') as f:
+            json.dump(results, f, indent=4, sort_keys=True)
+
+        print('Results saved to:', cml_args.output)
+
+
+    # Compare the results to the baseline
+    if cml_args.baseline is not None:
+
+        with open(cml_args.baseline) as f:
+            baseline = json.load(f)
+
+        regressions = compareBaseline(results, baseline, cml_args.tolerance)
+
+        if regressions:
+
+            print()
+            print('Slower than the baseline by more than {:.0f}%:'.format(100*cml_args.tolerance))
+
+            for res_name, case, base_time, new_time in regressions:
+                print('    {:s} {:s}: {:.4f} s -> {:.4f} s ({:+.0f}%)'.format(res_name, case, base_time,
+                    new_time, 100*(new_time/base_time - 1)))
+
+            sys.exit(1)
+
+        else:
+            print('No regressions compared to the baseline.')
@@ -28,7 +28,7 @@ if __name__ == "__main__":
     for i in range(256):
         frames[i] = np.random.normal(128, 2, (576, 720))
     
-    comp = Compressor(None, None, None, None, None, config)
+    comp = Compressor(None, None, config)
     compressed, field_intensities = comp.compress(frames)
     
     plt.hist(compressed[1].ravel(), 256, [0,256])
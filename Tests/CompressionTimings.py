@@ -26,7 +26,7 @@ import time
 import sys
 
 config = cr.parse(".config")
-comp = Compressor(None, None, None, None, None, config)
+comp = Compressor(None, None, config)
 
 
 # IMAGE SIZE
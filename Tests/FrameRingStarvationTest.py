@@ -0,0 +1,136 @@
+""" Checks that a slow fireball extraction never starves the capture of free frame ring blocks.
+
+The capture is simulated by filling the ring blocks at a rate faster than the fake extraction can process
+them. The capture never overwrites blocks and asserts that it always finds a free block without waiting,
+while some blocks are still extracted, either copied to the extraction buffers or kept in the frame ring.
+
+Usage:
+
+    python -m Tests.FrameRingStarvationTest
+"""
+
+from __future__ import print_function, division, absolute_import
+
+import time
+import shutil
+import tempfile
+import multiprocessing
+
+import numpy as np
+
+import RMS.ConfigReader as cr
+from RMS import VideoExtraction
+from RMS.Compression import Compressor
+from RMS.FrameRing import FrameRing
+
+
+# Time in seconds it takes to capture one block of frames
+BLOCK_DURATION = 0.25
+
+# Time in seconds one fake extraction takes, much longer than the capture of a block
+EXTRACTION_DURATION = 4*BLOCK_DURATION
+
+# Number of captured blocks
+BLOCKS_NUM = 24
+
+# Longest time in seconds the capture may wait for a free block
+MAX_ACQUIRE_WAIT = 0.5*BLOCK_DURATION
+
+# Number of blocks on which the fake extraction was run, shared with the extractor process
+EXTRACTED = multiprocessing.Value('i', 0)
+
+
+
+def slowExtraction(self):
+    """ Fake extraction which only takes a long time and checks that the frames were handed over. """
+
+    self.timings = {}
+
+    time.sleep(EXTRACTION_DURATION)
+
+    assert self.frames.any()
+
+    with EXTRACTED.get_lock():
+        EXTRACTED.value += 1
+
+
+
+def testCaptureNotStarved(blocks_num=2, extraction_buffers=1):
+    """ Capture blocks into the frame ring while a slow extraction is running and return the longest time
+        the capture waited for a free block and the number of extracted blocks.
+    """
+
+    config = cr.Config()
+    config.width = 64
+    config.height = 48
+    config.compression_threads = 1
+    config.extraction_buffers = extraction_buffers
+    config.ff_night_container = False
+
+    data_dir = tempfile.mkdtemp()
+
+    # Replace the extraction with the slow one, the compressor and the extractor inherit it when forked
+    execute_all = VideoExtraction.Extractor.executeAll
+    VideoExtraction.Extractor.executeAll = slowExtraction
+
+    ring = FrameRing(blocks_num, 256, config.height, config.width)
+
+    EXTRACTED.value = 0
+
+    compressor = Compressor(data_dir, ring, config)
+
+    try:
+
+        compressor.start()
+
+        max_wait = 0
+        for i in range(BLOCKS_NUM):
+
+            t = time.time()
+
+            block = ring.acquireFree(overwrite=False)
+
+            max_wait = max(max_wait, time.time() - t)
+
+            # Fill the block at the frame rate of the capture
+            start_time = time.time()
+            frames = ring.arrays[block]
+            for j in range(ring.frames_num):
+                frames[j] = np.random.randint(0, 255, (config.height, config.width))
+                ring.frameAdded(block, j + 1)
+
+                time.sleep(max(0, start_time + (j + 1)*BLOCK_DURATION/ring.frames_num - time.time()))
+
+            ring.markReady(block, start_time)
+
+
+        compressor.stop()
+
+    finally:
+        VideoExtraction.Extractor.executeAll = execute_all
+        shutil.rmtree(data_dir)
+
+
+    assert ring.starved.value == 0, "The capture was starved {:d} times!".format(ring.starved.value)
+    assert ring.overwritten.value == 0
+    assert max_wait < MAX_ACQUIRE_WAIT, "The capture waited {:.3f}s for a free block!".format(max_wait)
+
+    # Some blocks must still be extracted, by copying them or by keeping them in the ring
+    assert EXTRACTED.value > 0
+
+    return max_wait, EXTRACTED.value
+
+
+
+if __name__ == "__main__":
+
+    # With 3 ring blocks and no buffers, the blocks are only extracted while kept in the ring
+    for blocks_num, extraction_buffers in [[2, 1], [2, 3], [3, 0]]:
+
+        max_wait, extracted = testCaptureNotStarved(blocks_num=blocks_num, 
+            extraction_buffers=extraction_buffers)
+
+        print("Ring blocks: {:d}, extraction buffers: {:d}, longest wait for a free block: {:.3f}s, "\
+            "extracted blocks: {:d}".format(blocks_num, extraction_buffers, max_wait, extracted))
+
+    print("OK")
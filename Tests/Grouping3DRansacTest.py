@@ -0,0 +1,161 @@
+""" Regression tests of the RANSAC 3D line finder on small point clouds and on single tracks.
+
+Usage:
+
+    python -m Tests.Grouping3DRansacTest
+"""
+
+from __future__ import print_function, division, absolute_import
+
+import copy
+import time
+
+import numpy as np
+
+import RMS.ConfigReader as cr
+from RMS.Routines import Grouping3D
+
+# Import Cython functions
+import pyximport
+pyximport.install(setup_args={'include_dirs':[np.get_include()]})
+from RMS.Routines.Grouping3Dcy import find3DLines, find3DLinesRANSAC
+
+
+
+def makeCloud(track_points, noise_points, seed, velocity=2.0, jitter=1.0, width=80, height=45, frames=256):
+    """ Make a point cloud with one track of subsampled points and randomly placed noise points.
+
+    Arguments:
+        track_points: [int] Number of points on the track.
+        noise_points: [int] Number of noise points.
+        seed: [int] Seed of the random number generator.
+
+    Keyword arguments:
+        velocity: [float] Largest speed of the track in points per frame.
+        jitter: [float] Standard deviation of the track points from the line.
+        width: [int] Width of the subsampled image.
+        height: [int] Height of the subsampled image.
+        frames: [int] Number of frames.
+
+    Return:
+        [ndarray] (x, y, frame) points, the track points first.
+    """
+
+    rng = np.random.RandomState(seed)
+
+    x0 = rng.uniform(10, width - 10)
+    y0 = rng.uniform(10, height - 10)
+    vx = rng.uniform(-velocity, velocity)
+    vy = rng.uniform(-velocity/2, velocity/2)
+
+    # The track is not detected on every frame
+    z0 = rng.randint(0, 60)
+    z = z0 + np.cumsum(np.r_[0, rng.randint(1, 3, max(track_points - 1, 0))])[:track_points]
+
+    track = np.c_[np.round(x0 + vx*(z - z0) + rng.normal(0, jitter, track_points)), \
+        np.round(y0 + vy*(z - z0) + rng.normal(0, jitter, track_points)), z]
+
+    noise = np.c_[rng.randint(0, width, noise_points), rng.randint(0, height, noise_points), \
+        rng.randint(0, frames, noise_points)]
+
+    return np.clip(np.r_[track, noise], 0, None).astype(np.uint16)
+
+
+
+def trackFragments(line_list, first_frame, last_frame):
+    """ Return the number of found lines which cover a part of the given frame range. """
+
+    return len([line for line in (line_list or []) \
+        if min(last_frame, line[5]) - max(first_frame, line[4]) > 3])
+
+
+
+def testSmallClouds(config):
+    """ The number of sampled pairs must never exceed the number of pairs in small point clouds. The clouds 
+        are mostly a slow track, so a line is found on them, but not all points are on it.
+    """
+
+    for points_num in range(2, 41):
+        for seed in range(10):
+
+            noise_points = min(points_num, 2)
+
+            point_list = makeCloud(points_num - noise_points, noise_points, seed, velocity=0.5, jitter=0.3)
+
+            line_list = find3DLinesRANSAC(point_list, time.time(), config, line_list=[], seed=seed)
+
+            if line_list is not None:
+                for line in line_list:
+                    assert line[2] <= points_num
+
+
+
+def testTrackNotSplit(config, clouds_num=60, tries=5):
+    """ A track must not be split into more lines than the exhaustive line finder splits it into.
+
+    Return:
+        (exhaustive, ransac): [tuple] Mean number of lines per track found by both line finders.
+    """
+
+    exhaustive_fragments = 0
+    ransac_fragments = 0
+
+    for seed in range(clouds_num):
+
+        point_list = makeCloud(42, 15, seed)
+        first_frame, last_frame = np.min(point_list[:42, 2]), np.max(point_list[:42, 2])
+
+        fragments = trackFragments(find3DLines(point_list.copy(), time.time(), config, line_list=[]),
+            first_frame, last_frame)
+
+        for ransac_seed in range(tries):
+
+            ransac_lines = find3DLinesRANSAC(point_list.copy(), time.time(), config, line_list=[],
+                seed=ransac_seed)
+
+            ransac_fragments_num = trackFragments(ransac_lines, first_frame, last_frame)
+
+            assert ransac_fragments_num <= fragments, "Cloud {:d}, try {:d}: the track was split into {:d} "\
+                "lines, the exhaustive line finder found {:d}!".format(seed, ransac_seed,
+                    ransac_fragments_num, fragments)
+
+            exhaustive_fragments += fragments
+            ransac_fragments += ransac_fragments_num
+
+
+    return exhaustive_fragments/(clouds_num*tries), ransac_fragments/(clouds_num*tries)
+
+
+
+def testReproducible(config, clouds_num=20):
+    """ The same point cloud must always give the same lines when RANSAC is chosen in the config file. """
+
+    config = copy.copy(config)
+    config.line_finding_method = 'ransac'
+
+    for seed in range(clouds_num):
+
+        point_list = makeCloud(42, 40, seed)
+
+        line_lists = [Grouping3D.find3DLines(point_list.copy(), time.time(), config) for i in range(3)]
+
+        assert line_lists[0] == line_lists[1] == line_lists[2], "Cloud {:d}: the lines differ between "\
+            "runs!".format(seed)
+
+
+
+
+if __name__ == "__main__":
+
+    # Load config file
+    config = cr.parse(".config")
+
+    testSmallClouds(config)
+    print("Small clouds: OK")
+
+    testReproducible(config)
+    print("Reproducible lines: OK")
+
+    exhaustive, ransac = testTrackNotSplit(config)
+    print("Lines per track: exhaustive {:.3f}, RANSAC {:.3f}".format(exhaustive, ransac))
+    print("OK")
@@ -0,0 +1,185 @@
+""" Compare the exhaustive and the RANSAC 3D line finders on the point clouds of recorded FF files. """
+
+from __future__ import print_function, division, absolute_import
+
+import os
+import copy
+import time
+import argparse
+
+import numpy as np
+
+import RMS.ConfigReader as cr
+import RMS.Formats.FFfile as FFfile
+from RMS.Formats.FFfile import validFFName
+from RMS.Routines.Grouping3D import find3DLines
+from RMS.VideoExtraction import Extractor
+
+
+
+def lineDirection(detected_line):
+    """ Return the unit direction vector of a line found by find3DLines, pointing forward in time. """
+
+    point1 = np.array(detected_line[0], dtype=np.float64)
+    point2 = np.array(detected_line[1], dtype=np.float64)
+
+    direction = point2 - point1
+    if direction[2] < 0:
+        direction = -direction
+
+    return direction/np.linalg.norm(direction)
+
+
+
+def matchLines(reference_lines, test_lines):
+    """ Pair every reference line with the test line which overlaps it the most in time.
+
+    Arguments:
+        reference_lines: [list] Lines found by the exhaustive line finder.
+        test_lines: [list] Lines found by the RANSAC line finder.
+
+    Return:
+        [list] (reference line, matched test line or None, angle between the lines in degrees) tuples.
+    """
+
+    matches = []
+
+    for ref_line in reference_lines:
+
+        best_line = None
+        best_overlap = 0
+
+        for test_line in test_lines:
+
+            # Overlap of the frame ranges
+            overlap = min(ref_line[5], test_line[5]) - max(ref_line[4], test_line[4]) + 1
+
+            if overlap > best_overlap:
+                best_overlap = overlap
+                best_line = test_line
+
+        angle = None
+        if best_line is not None:
+            cos_angle = np.clip(np.dot(lineDirection(ref_line), lineDirection(best_line)), -1, 1)
+            angle = np.degrees(np.arccos(cos_angle))
+
+        matches.append((ref_line, best_line, angle))
+
+    return matches
+
+
+
+def runLineFinder(event_points, config, method):
+    """ Run the given line finder and return the found lines and the run time. """
+
+    config = copy.copy(config)
+    config.line_finding_method = method
+
+    t1 = time.time()
+    line_list = find3DLines(event_points, time.time(), config)
+
+    return (line_list or []), time.time() - t1
+
+
+
+
+if __name__ == "__main__":
+
+    ### COMMAND LINE ARGUMENTS
+
+    # Init the command line arguments parser
+    arg_parser = argparse.ArgumentParser(description="Compare the exhaustive and the RANSAC 3D line finders on \
+        the point clouds extracted from FF files.")
+
+    arg_parser.add_argument('dir_path', nargs=1, metavar='DIR_PATH', type=str, \
+        help='Path to directory with FF files.')
+
+    arg_parser.add_argument('--full', action="store_true", \
+        help="""Also run RANSAC on the point clouds which were not randomly subsampled to max_points.""")
+
+    # Parse the command line arguments
+    cml_args = arg_parser.parse_args()
+
+    #########################
+
+
+    dir_path = cml_args.dir_path[0]
+
+    # Load config file
+    config = cr.parse(".config")
+
+    # Config which does not subsample the point clouds
+    config_full = copy.copy(config)
+    config_full.max_points = np.inf
+
+
+    total_lines = 0
+    total_matched = 0
+    total_time = {'exhaustive': 0, 'ransac': 0}
+
+    for ff_name in sorted(os.listdir(dir_path)):
+
+        if not validFFName(ff_name):
+            continue
+
+        # Reconstruct the frames from the FF file, as the extractor does
+        ff = FFfile.read(dir_path, ff_name)
+        if ff is None:
+            continue
+
+        extract_obj = Extractor(config, dir_path)
+        extract_obj.compressed = FFfile.read(dir_path, ff_name, None, True).array
+        extract_obj.frames = FFfile.reconstruct(ff)
+
+        # Use the same random subsample for both line finders
+        np.random.seed(0)
+        event_points = extract_obj.findPoints()
+
+        if not event_points:
+            continue
+
+        print(ff_name)
+        print('  Points:', len(event_points))
+
+        exhaustive_lines, exhaustive_time = runLineFinder(event_points, config, 'exhaustive')
+        ransac_lines, ransac_time = runLineFinder(event_points, config, 'ransac')
+
+        total_time['exhaustive'] += exhaustive_time
+        total_time['ransac'] += ransac_time
+
+        print('  Exhaustive: {:d} lines in {:.3f} s'.format(len(exhaustive_lines), exhaustive_time))
+        print('  RANSAC:     {:d} lines in {:.3f} s'.format(len(ransac_lines), ransac_time))
+
+        for ref_line, test_line, angle in matchLines(exhaustive_lines, ransac_lines):
+
+            total_lines += 1
+
+            if test_line is None:
+                print('    frames {:3d}-{:3d}: not found by RANSAC'.format(ref_line[4], ref_line[5]))
+                continue
+
+            total_matched += 1
+
+            print('    frames {:3d}-{:3d} ({:d} points) -> frames {:3d}-{:3d} ({:d} points), angle {:.1f} deg'.format(
+                ref_line[4], ref_line[5], ref_line[2], test_line[4], test_line[5], test_line[2], angle))
+
+
+        # Run RANSAC on all points
+        if cml_args.full:
+
+            extract_obj.config = config_full
+            full_points = extract_obj.findPoints()
+
+            if not full_points:
+                continue
+
+            full_lines, full_time = runLineFinder(full_points, config_full, 'ransac')
+
+            print('  RANSAC on all {:d} points: {:d} lines in {:.3f} s'.format(len(full_points),
+                len(full_lines), full_time))
+
+
+    print()
+    print('Exhaustive lines found by RANSAC: {:d}/{:d}'.format(total_matched, total_lines))
+    print('Total time: exhaustive {:.2f} s, RANSAC {:.2f} s'.format(total_time['exhaustive'],
+        total_time['ransac']))
@@ -29,6 +29,7 @@ import cv2
 
 import RMS.ConfigReader as cr
 import RMS.Formats.FFfile as FFfile
+from RMS.Formats import FFnight
 
 
 def stackIfLighter(arr1, arr2):
@@ -65,8 +66,9 @@ def generateThumbnails(dir_path, config, mosaic_type, file_list=None):
 
     """
 
+    # List the files in the directory and in its night container
     if file_list is None:
-        file_list = sorted(os.listdir(dir_path))
+        file_list = FFnight.listFiles(dir_path)
 
 
     # Make a list of all FF files in the night directory
@@ -16,6 +16,7 @@ import RMS.Formats.CALSTARS as CALSTARS
 from RMS.Formats.FFfile import read as readFF
 from RMS.Formats.FFfile import validFFName
 from RMS.Formats.FFfile import getMiddleTimeFF
+from RMS.Formats import FFnight
 from RMS.Astrometry.Conversions import date2JD
 
 
@@ -59,8 +60,8 @@ def makeFlat(dir_path, config, nostars=False):
 
     ff_list = []
 
-    # Get a list of FF files in the folder
-    for file_name in os.listdir(dir_path):
+    # Get a list of FF files in the folder and in its night container
+    for file_name in FFnight.listFiles(dir_path):
         if validFFName(file_name) and ((file_name in calstars_ff_files) or nostars):
             ff_list.append(file_name)
             
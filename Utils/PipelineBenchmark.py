@@ -0,0 +1,199 @@
+""" Measures the throughput of the capture, compression, extraction and detection pipeline, using the
+    synthetic camera instead of a real one. The frames are generated from the given random seed, so the runs
+    are reproducible.
+"""
+
+from __future__ import print_function, division, absolute_import
+
+import os
+import sys
+import json
+import time
+import shutil
+import logging
+import argparse
+import tempfile
+
+import RMS.ConfigReader as cr
+from RMS.BufferedCapture import BufferedCapture
+from RMS.Compression import Compressor
+from RMS.FrameRing import FrameRing
+from RMS.Formats.FFfile import validFFName
+
+
+
+def listFF(dir_path):
+    """ Return a sorted list of FF files in the given directory. """
+
+    return sorted([ff_name for ff_name in os.listdir(dir_path) if validFFName(ff_name)])
+
+
+
+def runBenchmark(config, blocks_num, dir_path, seed=0, real_time=False, detect=False, timeout=600):
+    """ Run the capture and the compression on the synthetic camera until the given number of blocks are
+        compressed, and optionally run the detection on the produced FF files.
+
+    Arguments:
+        config: [Config object] Configuration, the resolution and the FPS are taken from it.
+        blocks_num: [int] Number of 256-frame blocks to capture.
+        dir_path: [str] Directory where the FF files will be saved.
+
+    Keyword arguments:
+        seed: [int] Seed of the synthetic camera. 0 by default.
+        real_time: [bool] Generate the frames at the configured FPS instead of as fast as possible. False by
+            default.
+        detect: [bool] Run star extraction and meteor detection on the FF files. False by default.
+        timeout: [float] Maximum run time of the capture in seconds. 600 by default.
+
+    Return:
+        results: [dict] Measured values.
+    """
+
+    config.replay_real_time = real_time
+
+    frame_ring = FrameRing(config.frame_ring_blocks, 256, config.height, config.width)
+
+    bc = BufferedCapture(frame_ring, config, video_file='synthetic:{:d}'.format(seed))
+    compressor = Compressor(dir_path, frame_ring, config)
+
+    t_start = time.time()
+
+    bc.startCapture()
+    compressor.start()
+
+    # Wait until all blocks are compressed
+    while (len(listFF(dir_path)) < blocks_num) and (time.time() - t_start < timeout):
+        time.sleep(0.1)
+
+    bc.stopCapture()
+    compressor.stop()
+
+    ff_list = listFF(dir_path)[:blocks_num]
+
+
+    results = {
+        'width': config.width,
+        'height': config.height,
+        'fps': config.fps,
+        'seed': seed,
+        'real_time': real_time,
+        'compression_threads': config.compression_threads,
+        'frame_ring_blocks': frame_ring.blocks_num,
+        'blocks': len(ff_list),
+        'ring_starved': frame_ring.starved.value,
+        'ring_overwritten': frame_ring.overwritten.value
+        }
+
+
+    # Compute the throughput from the times the FF files were written, which excludes the startup time
+    if len(ff_list) > 1:
+
+        ff_times = [os.path.getmtime(os.path.join(dir_path, ff_name)) for ff_name in ff_list]
+        block_time = (ff_times[-1] - ff_times[0])/(len(ff_list) - 1)
+
+        results['block_time'] = block_time
+        results['frames_per_second'] = 256/block_time
+
+
+    # Run the detection on every FF file
+    if detect:
+
+        from RMS.DetectStarsAndMeteors import detectStarsAndMeteors
+
+        detection_times = []
+        meteors = 0
+        for ff_name in ff_list:
+
+            t1 = time.time()
+            _, _, meteor_list = detectStarsAndMeteors(dir_path, ff_name, config)
+            detection_times.append(time.time() - t1)
+
+            meteors += len(meteor_list)
+
+        results['detection_time'] = sum(detection_times)/len(detection_times)
+        results['meteors'] = meteors
+
+
+    return results
+
+
+
+
+if __name__ == "__main__":
+
+    ### COMMAND LINE ARGUMENTS
+
+    # Init the command line arguments parser
+    arg_parser = argparse.ArgumentParser(description="Measure the throughput of the capture pipeline on a \
+        synthetic camera.")
+
+    arg_parser.add_argument('-r', '--resolution', metavar='WIDTHxHEIGHT', type=str, default='1280x720', \
+        help="Resolution of the synthetic camera. 1280x720 by default.")
+
+    arg_parser.add_argument('-f', '--fps', metavar='FPS', type=float, default=25.0, \
+        help="Frame rate of the synthetic camera. 25 by default.")
+
+    arg_parser.add_argument('-b', '--blocks', metavar='BLOCKS', type=int, default=5, \
+        help="Number of 256-frame blocks to capture. 5 by default.")
+
+    arg_parser.add_argument('-s', '--seed', metavar='SEED', type=int, default=0, \
+        help="Seed of the synthetic camera. 0 by default.")
+
+    arg_parser.add_argument('-t', '--threads', metavar='THREADS', type=int, \
+        help="Number of compression threads. Taken from the config file by default.")
+
+    arg_parser.add_argument('--realtime', action="store_true", \
+        help="Generate the frames at the given FPS, instead of as fast as possible.")
+
+    arg_parser.add_argument('-d', '--detect', action="store_true", \
+        help="Run star extraction and meteor detection on the produced FF files.")
+
+    arg_parser.add_argument('-o', '--output', metavar='JSON_PATH', type=str, \
+        help="Save the results to the given JSON file.")
+
+    # Parse the command line arguments
+    cml_args = arg_parser.parse_args()
+
+    #########################
+
+
+    # Show the log on the screen
+    log = logging.getLogger("logger")
+    log.setLevel(logging.INFO)
+    log.addHandler(logging.StreamHandler(sys.stdout))
+
+
+    # Load the configuration file
+    config = cr.parse(".config")
+
+    config.width, config.height = [int(x) for x in cml_args.resolution.lower().split('x')]
+    config.width_device, config.height_device = config.width, config.height
+    config.fps = cml_args.fps
+
+    # Use the whole synthetic frame, not the region of interest of the real camera
+    config.roi_left, config.roi_right = 0, config.width
+    config.roi_up, config.roi_down = 0, config.height
+
+    if cml_args.threads is not None:
+        config.compression_threads = cml_args.threads
+
+
+    dir_path = tempfile.mkdtemp(prefix='rms_benchmark_')
+
+    try:
+        results = runBenchmark(config, cml_args.blocks, dir_path, seed=cml_args.seed,
+            real_time=cml_args.realtime, detect=cml_args.detect)
+
+    finally:
+        shutil.rmtree(dir_path, ignore_errors=True)
+
+
+    print()
+    print('Benchmark results:')
+    for key in sorted(results):
+        print('    {:s}: {:s}'.format(key, str(results[key])))
+
+
+    if cml_args.output is not None:
+        with open(cml_args.output, 'w') as f:
+            json.dump(results, f, indent=4, sort_keys=True)
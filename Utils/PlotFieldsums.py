@@ -27,6 +27,7 @@ import matplotlib.pyplot as plt
 import RMS.ConfigReader as cr
 from RMS.Formats.FieldIntensities import readFieldIntensitiesBin
 from RMS.Formats.FFfile import filenameToDatetime
+from RMS.Formats import FFnight
 
 
 def plotFieldsums(dir_path, config):
@@ -44,8 +45,8 @@ def plotFieldsums(dir_path, config):
     intensity_data_peak = []
     intensity_data_avg = []
 
-    # Get all fieldsum files in the directory
-    for file_name in sorted(os.listdir(dir_path)):
+    # Get all fieldsum files in the directory and in its night container
+    for file_name in FFnight.listFiles(dir_path):
 
         # Check if it is the fieldsum file
         if ('FS' in file_name) and ('_fieldsum.bin' in file_name):
@@ -10,7 +10,8 @@ kht_module = Extension("kht_module",
                                "Native/Hough/subdivision.cpp",
                                "Native/Hough/voting.cpp"],
                     include_dirs = ["Native/Hough/"],
-                    extra_compile_args=["-O3", "-Wall"], extra_link_args=["-O3", "-Wall"])
+                    extra_compile_args=["-O3", "-Wall", "-std=c++11", "-pthread"],
+                    extra_link_args=["-O3", "-Wall", "-pthread"])
 
 
 